@@ -8,6 +8,7 @@ import argparse
 import datetime
 
 import mds
+import profiling
 
 import measure
 import query
@@ -59,6 +60,14 @@ def setup_cli():
         action="store_true",
         help="Input and query times are local."
     )
+    parser.add_argument(
+        "--profile",
+        const="profiles",
+        nargs="?",
+        type=str,
+        help="Profile each stage of the calculation with cProfile and tracemalloc, printing the top hotspots at the end.\
+        Optionally provide the directory to write per-stage .pstats files to (default: profiles)."
+    )
     parser.add_argument(
         "--query",
         action="append",
@@ -163,13 +172,16 @@ def availability(provider_name, vehicle_type, start, end, **kwargs):
             **kwargs
         )
 
-        data = q.get()
+        with profiling.stage("query"):
+            data = q.get()
 
         log(debug, f"{len(data)} availability records in time period")
 
-        devices = measure.DeviceCounter(start, _end, **kwargs)
+        with profiling.stage("count"):
+            devices = measure.DeviceCounter(start, _end, **kwargs)
+            count = devices.count(data)
 
-        yield (start, _end, devices.count(data))
+        yield (start, _end, count)
 
         start = _end
 
@@ -211,19 +223,26 @@ if __name__ == "__main__":
 
     queries = dict(args.queries)
 
+    if args.profile:
+        profiling.configure(args.profile)
+
     kwargs = vars(args)
-    for key in ("start", "end", "duration", "queries"):
+    for key in ("start", "end", "duration", "queries", "profile"):
         del kwargs[key]
 
     if args.availability:
         for provider_name, vehicle_type in queries.items():
             for _start, _end, count in availability(provider_name, vehicle_type, start, end, **kwargs):
-                avg = count.average()
+                with profiling.stage("average"):
+                    avg = count.average()
 
                 if args.save:
-                    save_availability_count(args.save, provider_name, vehicle_type, _start, _end, avg, args.cutoff)
+                    with profiling.stage("save"):
+                        save_availability_count(args.save, provider_name, vehicle_type, _start, _end, avg, args.cutoff)
 
                 print(f"{provider_name},{vehicle_type},{_start.strftime('%Y-%m-%d')},{_end.strftime('%Y-%m-%d')},{avg},{args.cutoff}")
+
+        profiling.report()
     else:
         arg_parser.print_help()
         exit(0)
@@ -0,0 +1,41 @@
+"""
+Fake MDS Provider data shared by the benchmarks.
+"""
+
+import datetime
+import random
+import uuid
+
+import mds
+import mds.fake
+
+
+def fake_records(boundary, count, version, seed=0, devices=100):
+    """
+    Generate count status_changes records with the fake data generator.
+
+    A single day of service is generated, then repeated with fresh device_ids as needed to reach count.
+    """
+    random.seed(seed)
+
+    schema = mds.Schema(mds.TRIPS, version)
+    gen = mds.fake.ProviderDataGenerator(
+        boundary=boundary,
+        speed=5,
+        vehicle_types=schema.vehicle_types,
+        propulsion_types=schema.propulsion_types
+    )
+    fleet = gen.devices(devices, "bench", uuid.UUID(int=random.getrandbits(128)))
+    status_changes, _ = gen.service_day(fleet, datetime.datetime(2019, 1, 1), 7, 19, 0)
+
+    if len(status_changes) == 0:
+        raise ValueError("The fake data generator did not produce any records.")
+
+    records = []
+    for i in range(count):
+        record = dict(status_changes[i % len(status_changes)])
+        if i >= len(status_changes):
+            record["device_id"] = str(uuid.UUID(int=random.getrandbits(128)))
+        records.append(record)
+
+    return records
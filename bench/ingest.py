@@ -0,0 +1,340 @@
+"""
+End-to-end benchmark of the ingestion flow in ingest/main.py, over fixed-seed fake MDS Provider datasets:
+
+  - datasets of several fleet sizes and numbers of days are generated with fake/main.py, and cached
+  - each dataset is ingested with --source into a local Postgres, in a fresh process
+  - records/s, peak RSS and per-stage times are written to a JSON file, to diff between commits
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+
+import mds
+
+HERE = pathlib.Path(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, str(HERE / ".." / "ingest"))
+
+
+# fixed parameters for the generated data, so datasets only vary by devices, days and seed
+PROVIDER_NAME = "bench"
+PROVIDER_ID = uuid.UUID("00000000-0000-4000-8000-000000000000")
+START = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def setup_cli():
+    """
+    Create the cli argument interface, and parses incoming args.
+
+    Returns a tuple:
+        - the argument parser
+        - the parsed args
+    """
+    parser = argparse.ArgumentParser(description="Benchmark MDS data ingestion from files into Postgres.")
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        help="Passed to ingest: stream files through the flow in batches of this many files."
+    )
+    parser.add_argument(
+        "--boundary",
+        type=str,
+        help="Path to a data file with geographic bounds for the generated data. Overrides the MDS_BOUNDARY environment variable."
+    )
+    parser.add_argument(
+        "--data",
+        type=str,
+        default="data/bench",
+        help="Path to a directory to cache the generated datasets in."
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        nargs="+",
+        default=[1, 7],
+        help="Numbers of days of service to benchmark."
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        nargs="+",
+        default=[100, 1000],
+        help="Fleet sizes to benchmark."
+    )
+    parser.add_argument(
+        "--load_engine",
+        choices=["upsert", "copy"],
+        default="upsert",
+        help="Passed to ingest: how to load records into the database."
+    )
+    parser.add_argument(
+        "--no_load",
+        action="store_true",
+        help="Do not load into the database, benchmarking reading and validation only."
+    )
+    parser.add_argument(
+        "--no_validate",
+        action="store_true",
+        help="Passed to ingest: do not validate the data."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to the JSON results file. Defaults to data/bench/ingest_<commit>.json."
+    )
+    parser.add_argument(
+        "--prevalidate",
+        action="store_true",
+        help="Passed to ingest: pre-validate pages with columnar checks."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the fake data generator."
+    )
+    parser.add_argument(
+        "--truncate",
+        action="store_true",
+        help="Required to load: confirms the status_changes and trips tables may be truncated before each run."
+    )
+    parser.add_argument(
+        "--validation_workers",
+        type=int,
+        default=1,
+        help="Passed to ingest: number of processes used to validate payloads in parallel."
+    )
+    parser.add_argument(
+        "--version",
+        type=lambda v: mds.Version(v),
+        default=mds.Version("0.3.2"),
+        help="The release version at which to reference MDS, e.g. 0.3.2"
+    )
+
+    return parser, parser.parse_args()
+
+
+def commit():
+    """
+    Get the short hash of the current git commit, or None outside of a git checkout.
+    """
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except:
+        return None
+
+
+def dataset(directory, boundary, devices, days, seed, version):
+    """
+    Generate the dataset for a number of devices and days with fake/main.py, unless it is already cached.
+
+    Returns the path to the dataset directory.
+    """
+    path = pathlib.Path(directory, f"{devices}x{days}_seed{seed}_v{version}")
+    complete = path / ".complete"
+
+    if complete.exists():
+        print(f"Using cached dataset {path}")
+        return path
+
+    print(f"Generating dataset {path}")
+    path.mkdir(parents=True, exist_ok=True)
+
+    start = int(START.timestamp())
+    end = start + (days - 1) * 86400
+
+    subprocess.run(
+        [
+            sys.executable, str(HERE / ".." / "fake" / "main.py"),
+            "--boundary", boundary,
+            "--devices", str(devices),
+            "--start", str(start),
+            "--end", str(end),
+            "--inactivity", "0.05",
+            "--speed_mph", "10",
+            "--provider_name", PROVIDER_NAME,
+            "--provider_id", str(PROVIDER_ID),
+            "--seed", str(seed),
+            "--version", str(version),
+            "--output", str(path)
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL
+    )
+
+    complete.touch()
+    return path
+
+
+def _run_ingest(path, metrics_path, args):
+    """
+    Ingest the dataset at path, in this (child) process. Returns the number of valid records per record type.
+    """
+    argv = [
+        "main.py", PROVIDER_NAME,
+        "--source", str(path),
+        "--status_changes",
+        "--trips",
+        "--version", str(args.version),
+        "--load_engine", args.load_engine,
+        "--validation_workers", str(args.validation_workers),
+        "--metrics", str(metrics_path)
+    ]
+    if args.batch_size:
+        argv.extend(["--batch_size", str(args.batch_size)])
+    for flag in ["no_load", "no_validate", "prevalidate"]:
+        if getattr(args, flag):
+            argv.append(f"--{flag}")
+
+    sys.argv = argv
+
+    import database
+    import main
+    import metrics
+    import validation
+
+    _, ingest_args = main.setup_cli()
+    metrics.configure(jsonl=ingest_args.metrics)
+
+    record_types = [mds.STATUS_CHANGES, mds.TRIPS]
+
+    if not ingest_args.no_validate:
+        validation.warm_validators(ingest_args.version, record_types)
+
+    if not ingest_args.no_load:
+        engine = database.engine(pool_size=1)
+        with engine.begin() as connection:
+            connection.execute(f"TRUNCATE {', '.join(record_types)}")
+
+    kwargs = vars(ingest_args)
+
+    return { record_type: main.ingest(record_type, **kwargs) for record_type in record_types }
+
+
+def run(path, args):
+    """
+    Ingest the dataset at path in a fresh child process, measuring its wall time and peak RSS.
+
+    Returns a dict of results.
+    """
+    with tempfile.TemporaryDirectory() as temp:
+        metrics_path = pathlib.Path(temp, "metrics.jsonl")
+        result_path = pathlib.Path(temp, "result.json")
+
+        start = time.perf_counter()
+        pid = os.fork()
+
+        if pid == 0:
+            code = 0
+            try:
+                # keep the child's output out of the benchmark report
+                with open(os.devnull, "w") as devnull:
+                    os.dup2(devnull.fileno(), sys.stdout.fileno())
+                    records = _run_ingest(path, metrics_path, args)
+                with open(result_path, "w") as f:
+                    json.dump(records, f)
+            except:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+
+        _, status, usage = os.wait4(pid, 0)
+        seconds = time.perf_counter() - start
+
+        if (os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0) or not result_path.exists():
+            raise RuntimeError(f"Ingesting {path} failed.")
+
+        with open(result_path) as f:
+            records = json.load(f)
+
+        stages = {}
+        if metrics_path.exists():
+            with open(metrics_path) as f:
+                for line in f:
+                    m = json.loads(line)
+                    stage = stages.setdefault(m["record_type"], {}).setdefault(m["stage"], dict(seconds=0.0, records=0))
+                    stage["seconds"] += m["seconds"]
+                    stage["records"] += m["records"]
+
+        for record_type in stages.values():
+            for stage in record_type.values():
+                stage["seconds"] = round(stage["seconds"], 3)
+
+    total = sum(records.values())
+
+    return dict(
+        records=records,
+        seconds=round(seconds, 3),
+        records_per_second=round(total / seconds, 1) if seconds > 0 else None,
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb=round(usage.ru_maxrss / 1024, 1),
+        stages=stages
+    )
+
+
+if __name__ == "__main__":
+    arg_parser, args = setup_cli()
+
+    try:
+        boundary = args.boundary or os.environ["MDS_BOUNDARY"]
+    except:
+        print("A boundary file is required")
+        exit(1)
+
+    if not args.no_load and not args.truncate:
+        print("Loading truncates the status_changes and trips tables before each run.")
+        print("Pass --truncate to confirm, or --no_load to benchmark without the database.")
+        exit(1)
+
+    revision = commit()
+    output = pathlib.Path(args.output or pathlib.Path(args.data, f"ingest_{revision or 'local'}.json"))
+
+    results = []
+
+    for devices in args.devices:
+        for days in args.days:
+            path = dataset(args.data, boundary, devices, days, args.seed, args.version)
+
+            print(f"Ingesting {devices} devices x {days} days")
+            result = run(path, args)
+            results.append(dict(devices=devices, days=days, **result))
+
+            print(f"  {sum(result['records'].values())} records in {result['seconds']:.2f}s",
+                  f"({result['records_per_second']:.0f} records/s), peak RSS {result['peak_rss_mb']} MiB")
+
+    report = dict(
+        commit=revision,
+        python=platform.python_version(),
+        options=dict(
+            batch_size=args.batch_size,
+            load_engine=args.load_engine,
+            no_load=args.no_load,
+            no_validate=args.no_validate,
+            prevalidate=args.prevalidate,
+            seed=args.seed,
+            validation_workers=args.validation_workers,
+            version=str(args.version)
+        ),
+        results=results
+    )
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    print(f"Wrote results to {output}")
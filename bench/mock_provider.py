@@ -0,0 +1,93 @@
+"""
+A local mock MDS Provider server, serving status_changes in linked pages, for the benchmarks and the ingest tests.
+"""
+
+import csv
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import mds
+
+
+# the mock server's entry in the provider registry
+PROVIDER = "bench"
+PROVIDER_ID = "00000000-0000-4000-8000-000000000000"
+
+
+class MockProviderHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the server's records as linked status_changes pages, at /status_changes?page=N.
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.strip("/") != mds.STATUS_CHANGES:
+            self.send_error(404)
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        page = int(query.get("page", ["0"])[0])
+
+        if page == self.server.fail_page:
+            time.sleep(self.server.latency)
+            self.send_error(500)
+            return
+
+        size = self.server.page_size
+        records = self.server.records[page * size:(page + 1) * size]
+
+        links = {}
+        if (page + 1) * size < len(self.server.records):
+            links["next"] = f"http://{self.headers['Host']}/{mds.STATUS_CHANGES}?page={page + 1}"
+
+        body = json.dumps({
+            "version": str(self.server.version),
+            "data": { mds.STATUS_CHANGES: records },
+            "links": links
+        }).encode()
+
+        time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.mds.provider+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(records, version, page_size, latency, port=0, fail_page=None):
+    """
+    Start a mock provider server on a background thread. Returns the server; its MDS API URL is server.url.
+
+    With fail_page, requests for that page fail with status 500.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MockProviderHandler)
+    server.records = records
+    server.version = version
+    server.page_size = page_size
+    server.latency = latency
+    server.fail_page = fail_page
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def provider(url, directory):
+    """
+    Get an mds.Provider for the mock server at url, from a providers.csv registry written to directory.
+    """
+    registry = os.path.join(directory, "providers.csv")
+    with open(registry, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["provider_name", "provider_id", "url", "mds_api_url", "gbfs_api_url"])
+        writer.writerow([PROVIDER, PROVIDER_ID, url, url, ""])
+
+    return mds.Provider(PROVIDER, path=registry)
@@ -0,0 +1,159 @@
+"""
+Benchmark of prefetching pages (ingest/prefetch.py) against a local mock MDS Provider server:
+
+  - a mock server serves fake status_changes in linked pages, with a configurable latency per page
+  - the pages are fetched and validated serially, then with each prefetch depth
+  - the wall time, speedup and overlap of fetching with validation are reported
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import mds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ingest"))
+
+import common
+import fakes
+import mock_provider
+import prefetch
+import validation
+
+
+def setup_cli():
+    """
+    Create the cli argument interface, and parses incoming args.
+
+    Returns a tuple:
+        - the argument parser
+        - the parsed args
+    """
+    parser = argparse.ArgumentParser(description="Benchmark prefetching MDS pages from a mock provider.")
+
+    parser.add_argument(
+        "--boundary",
+        type=str,
+        help="Path to a data file with geographic bounds for the generated data. Overrides the MDS_BOUNDARY environment variable."
+    )
+    parser.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Prefetch depths (pages fetched ahead) to compare against serial fetching."
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="Seconds the mock server waits before responding with each page."
+    )
+    parser.add_argument(
+        "--load_latency",
+        type=float,
+        default=0,
+        help="Seconds to wait after validating each page, simulating a database load."
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=1000,
+        help="Number of records per page served."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=0,
+        help="Port for the mock server. Defaults to any free port."
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=20000,
+        help="Total number of records served."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the random number generator."
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Only run the mock server, until interrupted."
+    )
+    parser.add_argument(
+        "--version",
+        type=lambda v: mds.Version(v),
+        default=mds.Version("0.3.2"),
+        help="The release version at which to reference MDS, e.g. 0.3.2"
+    )
+
+    return parser, parser.parse_args()
+
+
+def run(provider, version, depth, load_latency):
+    """
+    Fetch and validate the pages from provider with `common.iter_data()`, with depth pages prefetched (0 to fetch serially).
+
+    Returns a tuple (seconds, valid records per page, prefetcher).
+    """
+    start = time.perf_counter()
+
+    prefetcher = None
+    client = mds.Client(provider, version=version)
+    pages = common.iter_data(mds.STATUS_CHANGES, client=client, version=version)
+    if depth > 0:
+        prefetcher = prefetch.Prefetcher(pages, depth)
+        pages = iter(prefetcher)
+
+    valid = []
+    for page in pages:
+        result = validation.validate(mds.STATUS_CHANGES, [page], version)
+        valid.append(sum([len(p["data"][mds.STATUS_CHANGES]) for p in result[0]]))
+        time.sleep(load_latency)
+
+    return time.perf_counter() - start, valid, prefetcher
+
+
+if __name__ == "__main__":
+    arg_parser, args = setup_cli()
+
+    try:
+        boundary = args.boundary or os.environ["MDS_BOUNDARY"]
+    except:
+        print("A boundary file is required")
+        exit(1)
+
+    records = fakes.fake_records(boundary, args.records, args.version, seed=args.seed)
+    server = mock_provider.serve(records, args.version, args.page_size, args.latency, port=args.port)
+    print(f"Serving {len(records)} records in pages of {args.page_size} at {server.url}, {args.latency}s per page")
+
+    if args.serve:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+            exit(0)
+
+    validation.warm_validators(args.version, [mds.STATUS_CHANGES])
+
+    with tempfile.TemporaryDirectory() as directory:
+        mock = mock_provider.provider(server.url, directory)
+
+        serial, expected, _ = run(mock, args.version, 0, args.load_latency)
+        print(f"serial: {len(expected)} pages, {sum(expected)} valid records in {serial:.2f}s")
+
+        for depth in args.depths:
+            seconds, valid, prefetcher = run(mock, args.version, depth, args.load_latency)
+            if valid != expected:
+                raise ValueError(f"Prefetching {depth} pages did not match the serial results.")
+
+            print(f"depth {depth}: {seconds:.2f}s ({serial / seconds:.2f}x), {prefetcher.report()}")
+
+    server.shutdown()
@@ -0,0 +1,241 @@
+"""
+Micro-benchmarks for the validation code in ingest/validation.py, over fake MDS Provider data:
+
+  - partitioning valid and invalid records within a page
+  - schema validation, serial vs. a pool of processes
+  - schema validation, with vs. without columnar pre-validation
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import mds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ingest"))
+
+import fakes
+import validation
+
+
+def setup_cli():
+    """
+    Create the cli argument interface, and parses incoming args.
+
+    Returns a tuple:
+        - the argument parser
+        - the parsed args
+    """
+    parser = argparse.ArgumentParser(description="Benchmark MDS data validation.")
+
+    parser.add_argument(
+        "--boundary",
+        type=str,
+        help="Path to a data file with geographic bounds for the generated data. Overrides the MDS_BOUNDARY environment variable."
+    )
+    parser.add_argument(
+        "--invalid",
+        type=float,
+        default=0.01,
+        help="The portion of records in each page marked invalid."
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=1000,
+        help="Number of records per page for the schema validation benchmark."
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=10000,
+        help="Total number of records for the schema validation benchmark."
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of times to repeat each measurement; the best time is reported."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the random number generator."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Page sizes (number of records) to benchmark."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[2, 4],
+        help="Process pool sizes to compare against serial schema validation."
+    )
+    parser.add_argument(
+        "--version",
+        type=lambda v: mds.Version(v),
+        default=mds.Version("0.3.2"),
+        help="The release version at which to reference MDS, e.g. 0.3.2"
+    )
+
+    return parser, parser.parse_args()
+
+
+def best_time(func, repeat):
+    """
+    Return the best wall-clock time, in seconds, of repeat calls to func.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _partition_by_index(records, invalid_idx):
+    """
+    The previous partitioning approach, using a linear scan per record.
+    """
+    valid = [r for r in records if records.index(r) not in invalid_idx]
+    invalid = [r for r in records if records.index(r) in invalid_idx]
+    return valid, invalid
+
+
+def bench_partition(records, invalid, repeat):
+    """
+    Time partitioning a page of records with a portion marked invalid.
+    """
+    invalid_idx = set(random.sample(range(len(records)), int(len(records) * invalid)))
+
+    result = dict(records=len(records), invalid=len(invalid_idx))
+    result["partition"] = best_time(lambda: validation._partition(records, invalid_idx), repeat)
+
+    # the quadratic approach is impractical beyond 10k records
+    if len(records) <= 10000:
+        result["partition_by_index"] = best_time(lambda: _partition_by_index(records, invalid_idx), 1)
+
+    return result
+
+
+def pages(records, page_size, version):
+    """
+    Split records into status_changes payloads of page_size records.
+    """
+    return [
+        { "version": str(version), "data": { mds.STATUS_CHANGES: records[i:i + page_size] } }
+        for i in range(0, len(records), page_size)
+    ]
+
+
+def bench_validate(payloads, version, workers, repeat):
+    """
+    Time schema validation of payloads serially and with each number of workers.
+
+    Returns a dict of workers => seconds, where 1 is the serial path.
+    """
+    validation.warm_validators(version, [mds.STATUS_CHANGES])
+
+    def _validate(w):
+        return validation.validate(mds.STATUS_CHANGES, payloads, version, workers=w)
+
+    serial = _validate(1)
+    results = { 1: best_time(lambda: _validate(1), repeat) }
+
+    for w in workers:
+        # prime the pool, and check the partition is the same as the serial path
+        valid, errors, removed = _validate(w)
+        if valid != serial[0] or removed != serial[2] or len(errors) != len(serial[1]):
+            raise ValueError(f"Validation with {w} workers did not match the serial results.")
+
+        results[w] = best_time(lambda: _validate(w), repeat)
+
+    return results
+
+
+def corrupt(payloads, invalid, seed=0):
+    """
+    Copy payloads, giving a portion of the records an invalid event_type.
+    """
+    rng = random.Random(seed)
+    copies = []
+
+    for payload in payloads:
+        records = []
+        for record in payload["data"][mds.STATUS_CHANGES]:
+            if rng.random() < invalid:
+                record = { **record, "event_type": "not_an_event_type" }
+            records.append(record)
+        copies.append({ **payload, "data": { mds.STATUS_CHANGES: records } })
+
+    return copies
+
+
+def bench_prevalidate(payloads, version, repeat):
+    """
+    Time schema validation of payloads with and without pre-validation.
+
+    Returns a dict { full, prevalidate, pages, passed }.
+    """
+    validation.warm_validators(version, [mds.STATUS_CHANGES])
+
+    def _validate(prevalidate):
+        return validation.validate(mds.STATUS_CHANGES, payloads, version, prevalidate=prevalidate)
+
+    # prime the page check
+    _validate(True)
+
+    check = validation._page_check(mds.STATUS_CHANGES, version)
+    pages, passed = check.pages, check.passed
+
+    return dict(
+        full=best_time(lambda: _validate(False), repeat),
+        prevalidate=best_time(lambda: _validate(True), repeat),
+        pages=pages,
+        passed=passed
+    )
+
+
+if __name__ == "__main__":
+    arg_parser, args = setup_cli()
+
+    try:
+        boundary = args.boundary or os.environ["MDS_BOUNDARY"]
+    except:
+        print("A boundary file is required")
+        exit(1)
+
+    print(f"Generating {max(args.sizes + [args.records])} records")
+    records = fakes.fake_records(boundary, max(args.sizes + [args.records]), args.version, seed=args.seed)
+
+    print()
+    print("Partitioning valid/invalid records")
+    for size in args.sizes:
+        result = bench_partition(records[:size], args.invalid, args.repeat)
+        line = f"  {result['records']:>7} records, {result['invalid']:>5} invalid: {result['partition'] * 1000:.2f}ms"
+        if "partition_by_index" in result:
+            line += f" (by index: {result['partition_by_index'] * 1000:.2f}ms)"
+        print(line)
+
+    print()
+    print(f"Schema validation, {args.records} records in pages of {args.page_size}")
+    results = bench_validate(pages(records[:args.records], args.page_size, args.version), args.version, args.workers, args.repeat)
+    for workers, seconds in results.items():
+        label = "serial" if workers == 1 else f"{workers} workers"
+        print(f"  {label:>10}: {seconds:.2f}s ({args.records / seconds:.0f} records/s, {results[1] / seconds:.2f}x)")
+
+    print()
+    print(f"Pre-validation, {args.records} records in pages of {args.page_size}, {args.invalid:.1%} invalid")
+    payloads = corrupt(pages(records[:args.records], args.page_size, args.version), args.invalid, seed=args.seed)
+    result = bench_prevalidate(payloads, args.version, args.repeat)
+    print(f"  {result['passed']} of {result['pages']} pages passed pre-validation")
+    print(f"  full validation: {result['full']:.2f}s, with pre-validation: {result['prevalidate']:.2f}s",
+          f"({result['full'] / result['prevalidate']:.2f}x)")
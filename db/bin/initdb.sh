@@ -10,4 +10,6 @@ psql -v ON_ERROR_STOP=1 \
     --file setup/trips.sql \
     --file setup/status_changes.sql \
     --file setup/vehicles.sql \
+    --file setup/ingest_jobs.sql \
+    --file setup/ingest_watermarks.sql \
     --file setup/migrations.sql
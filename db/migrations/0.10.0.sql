@@ -0,0 +1,20 @@
+BEGIN;
+
+/*
+ * The time (and largest sequence_id) up to which each provider's records were last successfully loaded,
+ * for incremental ingestion.
+ */
+
+CREATE TABLE IF NOT EXISTS ingest_watermarks (
+    provider text not null,
+    record_type text not null,
+    last_time timestamptz not null,
+    sequence_id bigint null,
+    updated timestamptz not null default now(),
+    PRIMARY KEY (provider, record_type)
+);
+
+INSERT INTO migrations (version, date)
+VALUES ('0.10.0', now());
+
+COMMIT;
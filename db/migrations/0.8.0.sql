@@ -0,0 +1,19 @@
+BEGIN;
+
+/*
+ * Indexes for looking up the existing records of a provider in a time range before loading.
+ */
+
+CREATE INDEX IF NOT EXISTS status_changes_provider_id_event_time_idx
+    ON status_changes (provider_id, event_time);
+
+CREATE INDEX IF NOT EXISTS trips_provider_id_end_time_idx
+    ON trips (provider_id, end_time);
+
+CREATE INDEX IF NOT EXISTS vehicles_provider_id_last_updated_idx
+    ON vehicles (provider_id, last_updated);
+
+INSERT INTO migrations (version, date)
+VALUES ('0.8.0', now());
+
+COMMIT;
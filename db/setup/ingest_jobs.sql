@@ -0,0 +1,28 @@
+DROP TABLE IF EXISTS ingest_jobs CASCADE;
+
+/*
+ * A queue of ingestion windows, claimed by ingest workers with SELECT ... FOR UPDATE SKIP LOCKED.
+ */
+
+CREATE TABLE ingest_jobs (
+    job_id bigserial primary key,
+    provider text not null,
+    record_type text not null,
+    start_time timestamptz not null,
+    end_time timestamptz not null,
+    status text not null default 'pending',
+    attempts integer not null default 0,
+    max_attempts integer not null default 3,
+    run_after timestamptz not null default now(),
+    worker text null,
+    heartbeat timestamptz null,
+    records integer null,
+    error text null,
+    created timestamptz not null default now(),
+    updated timestamptz not null default now(),
+    CONSTRAINT ingest_jobs_status_check CHECK (status IN ('pending', 'running', 'done', 'failed')),
+    CONSTRAINT unique_ingest_job UNIQUE (provider, record_type, start_time, end_time)
+);
+
+CREATE INDEX ingest_jobs_claim_idx
+    ON ingest_jobs (status, run_after);
@@ -0,0 +1,15 @@
+DROP TABLE IF EXISTS ingest_watermarks CASCADE;
+
+/*
+ * The time (and largest sequence_id) up to which each provider's records were last successfully loaded,
+ * for incremental ingestion.
+ */
+
+CREATE TABLE ingest_watermarks (
+    provider text not null,
+    record_type text not null,
+    last_time timestamptz not null,
+    sequence_id bigint null,
+    updated timestamptz not null default now(),
+    PRIMARY KEY (provider, record_type)
+);
@@ -17,3 +17,6 @@ CREATE TABLE status_changes (
     sequence_id bigserial not null,
     CONSTRAINT unique_event UNIQUE (provider_id, device_id, event_type, event_type_reason, event_time)
 );
+
+CREATE INDEX status_changes_provider_id_event_time_idx
+    ON status_changes (provider_id, event_time);
@@ -22,3 +22,6 @@ CREATE TABLE trips (
     sequence_id bigserial not null,
     CONSTRAINT pk_trips PRIMARY KEY (provider_id, trip_id)
 );
+
+CREATE INDEX trips_provider_id_end_time_idx
+    ON trips (provider_id, end_time);
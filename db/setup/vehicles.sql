@@ -18,3 +18,6 @@ CREATE TABLE vehicles (
     sequence_id bigserial not null,
     CONSTRAINT unique_vehicle_event UNIQUE (provider_id, device_id, last_updated)
 );
+
+CREATE INDEX vehicles_provider_id_last_updated_idx
+    ON vehicles (provider_id, last_updated);
@@ -103,6 +103,11 @@ def setup_cli():
         type=uuid.UUID,
         help="The ID of the fake mobility as a service provider"
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for the random number generator. Runs with the same seed and options generate the same data"
+    )
     parser.add_argument(
         "--start",
         type=str,
@@ -147,6 +152,36 @@ def setup_cli():
     return parser, args
 
 
+# the fields of the generated records holding uuids
+ID_FIELDS = ["device_id", "trip_id", "associated_trip"]
+
+
+def new_uuid(rng):
+    """
+    Get a version 4 uuid built from the bits of rng.
+    """
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def replace_ids(rng, *records):
+    """
+    Replace the uuids in each list of records with uuids from rng, consistently across the lists,
+    so the generated ids are reproducible.
+    """
+    ids, replaced = {}, set()
+
+    for record in [r for rs in records for r in rs]:
+        for field in [f for f in ID_FIELDS if record.get(f) is not None]:
+            value = str(record[field])
+            # records may share a dict (e.g. with their device), already replaced
+            if value in replaced:
+                continue
+            if value not in ids:
+                ids[value] = new_uuid(rng)
+                replaced.add(str(ids[value]))
+            record[field] = ids[value] if isinstance(record[field], uuid.UUID) else str(ids[value])
+
+
 if __name__ == "__main__":
     T0 = time.time()
 
@@ -159,10 +194,15 @@ if __name__ == "__main__":
         print("A boundary file is required")
         exit(1)
 
+    # the parameters of the run are drawn from rng; the generator draws from the random module,
+    # seeded from rng, and the uuids it creates are replaced with uuids from rng after generating
+    rng = random.Random(args.seed)
+    random.seed(rng.getrandbits(64))
+
     # collect the parameters for data generation
     provider_name = args.provider_name or f"provider_{util.random_string(3)}"
-    provider_id = args.provider_id or uuid.uuid4()
-    N = args.devices or random.randint(100, 500)
+    provider_id = args.provider_id or new_uuid(rng)
+    N = args.devices or rng.randint(100, 500)
 
     encoder = mds.JsonEncoder(date_format=args.date_format, version=args.version)
     decoder = mds.TimestampDecoder(version=args.version)
@@ -178,7 +218,7 @@ if __name__ == "__main__":
     hour_open = args.open
     hour_closed = args.close
 
-    inactivity = random.uniform(0, 0.05) if args.inactivity is None else args.inactivity
+    inactivity = rng.uniform(0, 0.05) if args.inactivity is None else args.inactivity
 
     # convert speed to meters/second
     ONE_MPH_METERSSEC = 0.44704
@@ -187,7 +227,7 @@ if __name__ == "__main__":
     elif args.speed_mph is not None:
         speed = args.speed_mph * ONE_MPH_METERSSEC
     else:
-        speed = random.uniform(8 * ONE_MPH_METERSSEC, 15 * ONE_MPH_METERSSEC)
+        speed = rng.uniform(8 * ONE_MPH_METERSSEC, 15 * ONE_MPH_METERSSEC)
 
     # setup a data directory
     outputdir = "data" if args.output is None else args.output
@@ -232,6 +272,9 @@ if __name__ == "__main__":
 
     print(f"Finished generating data ({time.time() - t1} s)")
 
+    if args.seed is not None:
+        replace_ids(rng, devices, status_changes, trips)
+
     if len(status_changes) > 0 or len(trips) > 0:
         print("Generating data files")
         t1 = time.time()
@@ -0,0 +1,377 @@
+"""
+Archive MDS Provider records to files, partitioned by provider and day:
+
+  - as compressed, newline-delimited JSON, laid out as
+
+    <directory>/provider=<provider>/record_type=<record_type>/date=<YYYY-MM-DD>/<part>.v<version>.ndjson.<gz|zst>
+
+    with one record per line. Invalid records are written alongside, to <part>.invalid.v<version>.ndjson.<gz|zst> files.
+    Payload-level columns (e.g. the last_updated and ttl of vehicles) are written with each record.
+
+  - as Parquet, with typed and flattened columns, laid out as
+
+    <directory>/<record_type>/provider=<provider>/date=<YYYY-MM-DD>/<part>-<n>.parquet
+"""
+
+import datetime
+import gzip
+import io
+import json
+import pathlib
+import re
+import threading
+import uuid
+
+import mds
+
+import database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EXTENSIONS = { "gzip": "gz", "zstd": "zst" }
+
+# <part>[.invalid].v<version>.ndjson[.gz|.zst]
+FILE_NAME = re.compile(r"^(?P<part>[^.]+)(?P<invalid>\.invalid)?\.v(?P<version>[0-9.]+?)\.ndjson(\.(?P<ext>gz|zst))?$")
+
+
+def is_ndjson(path):
+    """
+    True if path is the name of a file written by `NdjsonWriter`.
+    """
+    return FILE_NAME.match(pathlib.Path(path).name) is not None
+
+
+def open_file(path, mode="rt"):
+    """
+    Open an NDJSON file, decompressing or compressing by its extension.
+    """
+    path = pathlib.Path(path)
+
+    if path.suffix == ".gz":
+        return gzip.open(path, mode)
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise ImportError(f"The zstandard package is required to read or write {path}.")
+        if mode.startswith("r"):
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        else:
+            # each writer appends a new frame
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, mode[0] + "b"), closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode)
+
+
+def file_info(path):
+    """
+    Get a dict { record_type, version, invalid } describing an NDJSON file from its path, or None.
+    """
+    path = pathlib.Path(path)
+    match = FILE_NAME.match(path.name)
+    if match is None:
+        return None
+
+    record_type = None
+    for part in path.parts:
+        if part.startswith("record_type="):
+            record_type = part.split("=", 1)[1]
+
+    return dict(record_type=record_type, version=match.group("version"), invalid=match.group("invalid") is not None)
+
+
+class NdjsonWriter():
+    """
+    Append records to compressed NDJSON files, partitioned by provider, record type and day, as they arrive.
+
+    Each write appends a new gzip member (or zstd frame) to the files, so every completed write is readable
+    even if the run fails later.
+
+    The payload-level columns of the record type (see `database.PAYLOAD_COLUMNS`) are written with each record.
+    """
+
+    def __init__(self, directory, provider, record_type, version, compression="gzip"):
+        """
+        Initialize a new `NdjsonWriter` instance.
+
+        Required positional arguments:
+
+        :directory: Path to the root directory of the partitions.
+
+        :provider: The name of the provider of the records.
+
+        :record_type: The type of MDS records being written.
+
+        :version: The MDS version of the records.
+
+        Optional keyword arguments:
+
+        :compression: "gzip" (the default) or "zstd"; zstd requires the zstandard package.
+        """
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(EXTENSIONS.keys())}.")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("The zstandard package is required for zstd compression.")
+
+        self.directory = pathlib.Path(directory)
+        self.provider = provider
+        self.record_type = record_type
+        self.version = mds.Version(version)
+        self.extension = EXTENSIONS[compression]
+        self.data_key = mds.Schema(record_type).data_key
+        self.time_column = database.TIME_COLUMNS[record_type]
+        self.decoder = mds.encoding.TimestampDecoder(version=self.version)
+        self.part = uuid.uuid4().hex[:12]
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def _date(self, record):
+        try:
+            ts = self.decoder.decode(record[self.time_column])
+            if ts.tzinfo is not None:
+                ts = ts.astimezone(datetime.timezone.utc)
+            return ts.date().isoformat()
+        except:
+            return "unknown"
+
+    def path(self, date, invalid=False):
+        """
+        Get the path of the file for records on date.
+        """
+        name = f"{self.part}{'.invalid' if invalid else ''}.v{self.version}.ndjson.{self.extension}"
+        return pathlib.Path(
+            self.directory,
+            f"provider={self.provider}",
+            f"record_type={self.record_type}",
+            f"date={date}",
+            name
+        )
+
+    def write(self, payloads, invalid=False):
+        """
+        Append the records in payloads to their partitions' files.
+        """
+        lines = {}
+        for payload in payloads:
+            for record in database.payload_records(payload, self.record_type, self.data_key):
+                lines.setdefault(self._date(record), []).append(json.dumps(record, separators=(",", ":")))
+
+        with self.lock:
+            for date, _lines in lines.items():
+                path = self.path(date, invalid)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open_file(path, "at") as f:
+                    f.write("\n".join(_lines) + "\n")
+                self.records += len(_lines)
+
+
+# number of buffered rows that triggers writing Parquet files
+PARQUET_ROWS = 100000
+
+# the flattened Parquet columns of each record type, by type
+_VEHICLE_COLUMNS = [
+    ("provider_id", "string"),
+    ("provider_name", "string"),
+    ("device_id", "string"),
+    ("vehicle_id", "string"),
+    ("vehicle_type", "string"),
+    ("propulsion_type", "list")
+]
+
+PARQUET_COLUMNS = {
+    mds.STATUS_CHANGES: _VEHICLE_COLUMNS + [
+        ("event_type", "string"),
+        ("event_type_reason", "string"),
+        ("event_time", "timestamp"),
+        ("publication_time", "timestamp"),
+        ("event_location_lon", "float"),
+        ("event_location_lat", "float"),
+        ("battery_pct", "float"),
+        ("associated_trip", "string"),
+        ("associated_ticket", "string")
+    ],
+    mds.TRIPS: _VEHICLE_COLUMNS + [
+        ("trip_id", "string"),
+        ("trip_duration", "int"),
+        ("trip_distance", "int"),
+        ("accuracy", "int"),
+        ("start_time", "timestamp"),
+        ("end_time", "timestamp"),
+        ("publication_time", "timestamp"),
+        ("route_points", "int"),
+        ("route_start_lon", "float"),
+        ("route_start_lat", "float"),
+        ("route_end_lon", "float"),
+        ("route_end_lat", "float"),
+        ("parking_verification_url", "string"),
+        ("standard_cost", "int"),
+        ("actual_cost", "int"),
+        ("currency", "string")
+    ],
+    mds.VEHICLES: _VEHICLE_COLUMNS + [
+        ("last_event_time", "timestamp"),
+        ("last_event_type", "string"),
+        ("last_event_type_reason", "string"),
+        ("last_event_location_lon", "float"),
+        ("last_event_location_lat", "float"),
+        ("current_location_lon", "float"),
+        ("current_location_lat", "float"),
+        ("battery_pct", "float"),
+        ("last_updated", "timestamp"),
+        ("ttl", "int")
+    ]
+}
+PARQUET_COLUMNS[mds.EVENTS] = PARQUET_COLUMNS[mds.STATUS_CHANGES]
+
+
+def _point(feature):
+    """
+    Get the (lon, lat) of a GeoJSON Point Feature.
+    """
+    coordinates = (feature.get("geometry") or {}).get("coordinates") or [None, None]
+    return coordinates[0], coordinates[1]
+
+
+class ParquetSink():
+    """
+    Write validated records to Parquet files with typed, flattened columns, partitioned by provider and day.
+
+    GeoJSON Point features (e.g. event_location) are flattened to <field>_lon and <field>_lat columns,
+    and FeatureCollections (e.g. a trip's route) to a <field>_points count and the start and end coordinates.
+
+    The payload-level columns of the record type (e.g. the last_updated and ttl of vehicles) are filled from each payload.
+
+    Rows are buffered and written in files of up to PARQUET_ROWS rows; close() writes any remaining rows.
+    """
+
+    def __init__(self, directory, provider, record_type, version):
+        """
+        Initialize a new `ParquetSink` instance.
+
+        Required positional arguments:
+
+        :directory: Path to the root directory of the Parquet datasets.
+
+        :provider: The name of the provider of the records.
+
+        :record_type: The type of MDS records being written.
+
+        :version: The MDS version of the records.
+        """
+        if pyarrow is None:
+            raise ImportError("The pyarrow package is required to write Parquet files.")
+
+        types = {
+            "string": pyarrow.string(),
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+            "timestamp": pyarrow.timestamp("ms", tz="UTC"),
+            "list": pyarrow.list_(pyarrow.string())
+        }
+
+        self.directory = pathlib.Path(directory)
+        self.provider = provider
+        self.record_type = record_type
+        self.columns = PARQUET_COLUMNS[record_type]
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in self.columns])
+        self.data_key = mds.Schema(record_type).data_key
+        self.time_column = database.TIME_COLUMNS[record_type]
+        self.decoder = mds.encoding.TimestampDecoder(version=mds.Version(version))
+        self.part = uuid.uuid4().hex[:12]
+        self.files = 0
+        self.buffer = {}
+        self.buffered = 0
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def _timestamp(self, value):
+        try:
+            ts = self.decoder.decode(value)
+        except:
+            return None
+        return ts if ts.tzinfo is not None else ts.replace(tzinfo=datetime.timezone.utc)
+
+    def _flatten(self, record):
+        row = {}
+
+        for key, value in record.items():
+            if isinstance(value, dict) and value.get("type") == "Feature":
+                row[f"{key}_lon"], row[f"{key}_lat"] = _point(value)
+            elif isinstance(value, dict) and value.get("type") == "FeatureCollection":
+                features = value.get("features") or []
+                row[f"{key}_points"] = len(features)
+                if len(features) > 0:
+                    row[f"{key}_start_lon"], row[f"{key}_start_lat"] = _point(features[0])
+                    row[f"{key}_end_lon"], row[f"{key}_end_lat"] = _point(features[-1])
+            elif key in database.TIMESTAMP_COLUMNS and value is not None:
+                row[key] = self._timestamp(value)
+            else:
+                row[key] = value
+
+        return row
+
+    def _column(self, rows, name, kind):
+        values = [row.get(name) for row in rows]
+
+        def _coerce(value):
+            if value is None:
+                return None
+            if kind == "string":
+                return str(value)
+            if kind == "int":
+                return int(value)
+            if kind == "float":
+                return float(value)
+            if kind == "list":
+                return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+            return value
+
+        return [_coerce(v) for v in values]
+
+    def write(self, payloads):
+        """
+        Buffer the records in payloads, writing files when PARQUET_ROWS rows are buffered.
+        """
+        with self.lock:
+            for payload in payloads:
+                for record in database.payload_records(payload, self.record_type, self.data_key):
+                    row = self._flatten(record)
+                    ts = row.get(self.time_column)
+                    date = ts.astimezone(datetime.timezone.utc).date().isoformat() if ts else "unknown"
+                    self.buffer.setdefault(date, []).append(row)
+                    self.buffered += 1
+
+            if self.buffered >= PARQUET_ROWS:
+                self._flush()
+
+    def _flush(self):
+        for date, rows in self.buffer.items():
+            table = pyarrow.Table.from_pydict(
+                { name: self._column(rows, name, kind) for name, kind in self.columns },
+                schema=self.schema
+            )
+
+            path = pathlib.Path(self.directory, self.record_type, f"provider={self.provider}", f"date={date}")
+            path.mkdir(parents=True, exist_ok=True)
+            pyarrow.parquet.write_table(table, str(path / f"{self.part}-{self.files}.parquet"))
+
+            self.files += 1
+            self.records += len(rows)
+
+        self.buffer = {}
+        self.buffered = 0
+
+    def close(self):
+        """
+        Write any buffered rows.
+        """
+        with self.lock:
+            self._flush()
@@ -0,0 +1,221 @@
+"""
+Bulk load MDS provider data into a database with COPY, followed by a single set-based merge.
+"""
+
+import datetime
+import io
+import json
+import time
+import uuid
+
+import mds
+
+
+_NULL = "\\N"
+
+
+def _table_columns(cursor, table):
+    """
+    Get the [(column_name, data_type)] for a table, in table order.
+    """
+    cursor.execute(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,)
+    )
+    return cursor.fetchall()
+
+
+def _array(values):
+    """
+    Format a list of values as a Postgres array literal.
+    """
+    items = []
+    for v in values:
+        if v is None:
+            items.append("NULL")
+        else:
+            items.append('"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(items) + "}"
+
+
+def _timestamp(value, decoder):
+    """
+    Format an MDS timestamp as an ISO-8601 string in UTC.
+    """
+    ts = decoder.decode(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.isoformat()
+
+
+def _formatter(data_type, decoder):
+    """
+    Get a function formatting a record value as COPY text for a column of data_type, or None for NULL.
+    """
+    def _format(value):
+        if value is None:
+            return None
+        if data_type.startswith("timestamp"):
+            return _timestamp(value, decoder)
+        if data_type == "ARRAY":
+            return _array(value if isinstance(value, list) else [value])
+        if data_type in ("json", "jsonb") or isinstance(value, (dict, list)):
+            return json.dumps(value)
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value)
+
+    return _format
+
+
+def _rows(payloads, data_key, formatters):
+    """
+    Generate COPY rows from the records in payloads.
+    """
+    for payload in payloads:
+        for record in payload["data"][data_key]:
+            yield [fmt(record.get(column)) for column, fmt in formatters]
+
+
+def _csv(row):
+    """
+    Format a row of values as a line of CSV, quoting every value so only None is read as NULL by COPY.
+    """
+    return ",".join([_NULL if v is None else '"' + v.replace('"', '""') + '"' for v in row]) + "\n"
+
+
+class _CopyFile():
+    """
+    A read-only file object over the CSV of rows, for COPY FROM STDIN.
+
+    Rows are formatted as COPY reads them, so only about one read of CSV is held in memory at a time.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.count = 0
+
+    def read(self, size=-1):
+        """
+        Read up to size characters of CSV, or all that remain with a negative size.
+        """
+        while size < 0 or self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer.write(_csv(row))
+            self.count += 1
+
+        data = self.buffer.getvalue()
+        if size < 0:
+            size = len(data)
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(data[size:])
+
+        return data[:size]
+
+
+def load(payloads, record_type, table, columns, actions, version, engine, detect_changes=False):
+    """
+    Load the records from payloads into table:
+
+    1. COPY the records into a temporary staging table with the same column types as table
+    2. INSERT the distinct records from staging into table in one statement, with
+       ON CONFLICT (columns) DO UPDATE actions, or DO NOTHING without actions.
+
+    With detect_changes, conflicting rows are only updated where the values of the updated columns
+    (those present in the records) differ from the existing row's, and the rows inserted, updated
+    and left unchanged are counted.
+
+    Returns dict { staged, merged, stage_seconds, merge_seconds }, and { inserted, updated, unchanged } with detect_changes.
+    """
+    data_key = mds.Schema(record_type).data_key
+    decoder = mds.encoding.TimestampDecoder(version=version)
+    keys = set(k for p in payloads for r in p["data"][data_key] for k in r.keys())
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        # only the table's columns that are present in the records
+        table_columns = [(c, t) for c, t in _table_columns(cursor, table) if c in keys]
+        if len(table_columns) == 0:
+            raise ValueError(f"No columns of {table} were found in the {record_type} records.")
+
+        names = ", ".join([c for c, _ in table_columns])
+        formatters = [(c, _formatter(t, decoder)) for c, t in table_columns]
+        stage = f"{table}_stage_{uuid.uuid4().hex[:8]}"
+
+        # 1. stage
+        start = time.perf_counter()
+
+        cursor.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT {names} FROM {table} WITH NO DATA")
+
+        rows = _CopyFile(_rows(payloads, data_key, formatters))
+        cursor.copy_expert(f"COPY {stage} ({names}) FROM STDIN WITH (FORMAT csv, NULL '{_NULL}')", rows)
+        staged = rows.count
+
+        stage_seconds = time.perf_counter() - start
+
+        # 2. merge, keeping the first of any duplicate records
+        start = time.perf_counter()
+
+        key = ", ".join(columns)
+        if actions:
+            updates = ", ".join([f"{col} = {action}" for col, action in actions.items()])
+            conflict = f"ON CONFLICT ({key}) DO UPDATE SET {updates}"
+
+            # only compare the columns coming from the records, others (e.g. sequence_id) take their defaults
+            compared = [(col, action) for col, action in actions.items() if col in keys]
+            if detect_changes and len(compared) > 0:
+                existing = ", ".join([f"{table}.{col}" for col, _ in compared])
+                incoming = ", ".join([action for _, action in compared])
+                conflict += f" WHERE ({existing}) IS DISTINCT FROM ({incoming})"
+        else:
+            conflict = "ON CONFLICT DO NOTHING"
+
+        insert = f"""
+            INSERT INTO {table} ({names})
+            SELECT DISTINCT ON ({key}) {names} FROM {stage} ORDER BY {key}, ctid
+            {conflict}
+            """
+
+        result = {}
+
+        if detect_changes:
+            # xmax is 0 for newly inserted rows
+            cursor.execute(
+                f"""
+                WITH merged AS ({insert} RETURNING (xmax = 0) AS inserted)
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged
+                """
+            )
+            inserted, updated = cursor.fetchone()
+
+            cursor.execute(f"SELECT count(*) FROM (SELECT DISTINCT {key} FROM {stage}) AS distinct_keys")
+            distinct = cursor.fetchone()[0]
+
+            merged = inserted + updated
+            result = dict(inserted=inserted, updated=updated, unchanged=distinct - merged)
+        else:
+            cursor.execute(insert)
+            merged = cursor.rowcount
+
+        connection.commit()
+        merge_seconds = time.perf_counter() - start
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    return dict(result, staged=staged, merged=merged, stage_seconds=stage_seconds, merge_seconds=merge_seconds)
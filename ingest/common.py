@@ -5,13 +5,21 @@ Helper functions for shared functionality.
 import argparse
 import datetime
 import pathlib
+import time
 
 import mds
 
+import archive
+import metrics
+import sources
+
 
 DEFAULT_VERSION = mds.Version("0.3.2")
 VERSION_040 = mds.Version("0.4.0")
 
+# the query parameter of each endpoint requested by the hour, for version >= 0.4.0
+HOURLY_PARAMS = { mds.STATUS_CHANGES: "event_time", mds.TRIPS: "end_time" }
+
 
 def count_seconds(ts):
     """
@@ -32,20 +40,10 @@ def get_config(provider, config_path=None):
         return {}
 
 
-def get_data(record_type, **kwargs):
+def _api_kwargs(record_type, client, **kwargs):
     """
-    Get provider data as in-memory objects.
+    Build the keyword arguments for a request to the client's provider.
     """
-    # shortcut reading from file source(s)
-    if kwargs.get("source"):
-        source = kwargs.get("source")
-        print(f"Reading {record_type} from {source}")
-        payloads = mds.DataFile(record_type, source).load_payloads()
-        return payloads
-
-    # required for API calls
-    client = kwargs.pop("client")
-
     # dependent on version and record_type
     start_time = kwargs.get("start_time")
     end_time = kwargs.get("end_time")
@@ -84,7 +82,200 @@ def get_data(record_type, **kwargs):
             # currently no special query params for vehicles
             pass
 
-    return client.get(record_type, **api_kwargs)
+    return api_kwargs
+
+
+def _source_files(source):
+    """
+    Expand one or more paths to (directories containing) MDS Provider JSON file(s) into a sorted list of files.
+
+    Directories are also searched recursively for NDJSON files written by `archive.NdjsonWriter`,
+    except for those of invalid records.
+    """
+    paths = [source] if isinstance(source, str) else source
+    files = []
+
+    for s in paths:
+        path = pathlib.Path(s)
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.json")))
+            files.extend(sorted(
+                f for f in path.rglob("*.ndjson*") if archive.is_ndjson(f) and not archive.file_info(f)["invalid"]
+            ))
+        else:
+            files.append(path)
+
+    return files
+
+
+def batch(payloads, size):
+    """
+    Group a stream of payloads into lists of (at most) size payloads.
+    """
+    group = []
+
+    for payload in payloads:
+        group.append(payload)
+        if len(group) >= size:
+            yield group
+            group = []
+
+    if len(group) > 0:
+        yield group
+
+
+def get_data(record_type, **kwargs):
+    """
+    Get provider data as in-memory objects.
+
+    API requests go through `mds.Client.get()`, unless checked_paging, when pages are requested
+    with `request_pages()` (as with `iter_data()`) and a failed request raises rather than returning fewer pages.
+    """
+    # shortcut reading from file source(s)
+    if kwargs.get("source"):
+        source = kwargs.get("source")
+        print(f"Reading {record_type} from {source}")
+        workers = kwargs.get("source_workers") or 1
+        files = _source_files(source)
+        if workers > 1 or any([archive.is_ndjson(f) for f in files]):
+            return list(sources.read(record_type, files, workers=workers, provider=kwargs.get("provider", "source")))
+        payloads = mds.DataFile(record_type, source).load_payloads()
+        return payloads
+
+    if kwargs.get("checked_paging"):
+        return list(iter_data(record_type, **kwargs))
+
+    # required for API calls
+    client = kwargs.pop("client")
+
+    return client.get(record_type, **_api_kwargs(record_type, client, **kwargs))
+
+
+def iter_data(record_type, **kwargs):
+    """
+    Get provider data as a stream of payloads, one file or page at a time.
+
+    Unlike get_data(), only the current file or page is held in memory.
+
+    Pages are requested with `request_pages()`, so a failed request for any page (the first included) raises,
+    rather than ending the stream early. With a rate_limiter, a `scheduler.TokenBucket`, it is acquired for every page.
+
+    Files are read with `sources.read()`, in parallel with source_workers > 1,
+    and incrementally for files larger than source_stream_size megabytes.
+
+    The time and bytes taken to read each file ("read") or request each page ("http") are recorded in the metrics.
+    """
+    data_key = mds.Schema(record_type).data_key
+
+    # shortcut reading from file source(s)
+    if kwargs.get("source"):
+        source = kwargs.get("source")
+        print(f"Streaming {record_type} from {source}")
+        stream_size = kwargs.get("source_stream_size")
+        yield from sources.read(
+            record_type,
+            _source_files(source),
+            workers=kwargs.get("source_workers") or 1,
+            stream_size=stream_size * 2**20 if stream_size else None,
+            provider=kwargs.get("provider", "source")
+        )
+        return
+
+    # required for API calls
+    client = kwargs.pop("client")
+    provider = client.provider.provider_name
+    version = kwargs.get("version", DEFAULT_VERSION)
+    api_kwargs = _api_kwargs(record_type, client, **kwargs)
+
+    first = True
+    for page, seconds, size in request_pages(client, record_type, version, limiter=kwargs.get("rate_limiter"), **api_kwargs):
+        records = len(page.get("data", {}).get(data_key, []))
+        metrics.record("http", provider, record_type, seconds, records, size)
+
+        # the first page stands for the response even when empty, like mds.Client.get()
+        if first or records > 0:
+            yield page
+        first = False
+
+
+def request_pages(client, record_type, version, paging=True, rate_limit=None, limiter=None, **api_kwargs):
+    """
+    Request record_type from the client's provider, following next links with paging.
+
+    With a limiter, a `scheduler.TokenBucket` shared by everything requesting from the provider, a token is acquired
+    before every request. Otherwise, with rate_limit, this waits rate_limit seconds between pages.
+
+    Yields a tuple (page, seconds, bytes) per page. Every response is checked, the first included:
+    a failed request or a body that is not a JSON object raises a RuntimeError, and a page of a version other than
+    version raises `mds.versions.UnexpectedVersionError`, so a failure never looks like an empty result.
+
+    The requests are made on the provider's authenticated session from the private `mds.Client._session()`,
+    since `mds.Client.get()` returns no pages (and no error) when the first request fails.
+    """
+    session = client._session(client.provider)
+    url, params = _url(client.provider, record_type), _params(record_type, version, api_kwargs)
+
+    while url:
+        if limiter is not None:
+            limiter.acquire()
+
+        start = time.perf_counter()
+        r = session.get(url, params=params)
+        if r.status_code != 200:
+            raise RuntimeError(f"Requesting {url} failed with status {r.status_code}")
+
+        try:
+            page = r.json()
+        except ValueError:
+            page = None
+        if not isinstance(page, dict):
+            raise RuntimeError(f"Requesting {url} returned a body that is not an MDS payload")
+
+        page_version = mds.Version(page.get("version", "0.0.0"))
+        if page_version != version:
+            raise mds.versions.UnexpectedVersionError(page_version, version)
+
+        yield page, time.perf_counter() - start, len(r.content)
+
+        # next links carry their own query
+        url, params = (page.get("links") or {}).get("next") if paging else None, None
+        if url and rate_limit and limiter is None:
+            time.sleep(rate_limit)
+
+
+def _url(provider, record_type):
+    """
+    Get the URL of the provider's record_type endpoint.
+    """
+    url = provider.mds_api_url.rstrip("/")
+    suffix = getattr(provider, "mds_api_suffix", None)
+    if suffix:
+        url += "/" + suffix.strip("/")
+
+    return f"{url}/{record_type}"
+
+
+def _params(record_type, version, api_kwargs):
+    """
+    Encode the query parameters of a request for record_type at version.
+
+    Times are Unix milliseconds, or for the hourly endpoints of version >= 0.4.0, the UTC hour as YYYY-MM-DDTHH.
+    """
+    params = {}
+
+    for key, value in api_kwargs.items():
+        if value is None:
+            continue
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=datetime.timezone.utc)
+            if version >= VERSION_040 and key == HOURLY_PARAMS.get(record_type):
+                value = value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H")
+            else:
+                value = int(value.timestamp() * 1000)
+        params[key] = value
+
+    return params
 
 
 def parse_time_range(**kwargs):
@@ -164,6 +355,35 @@ def setup_cli(**kwargs):
         help="Write results to json files in this directory."
     )
 
+    parser.add_argument(
+        "--prevalidate",
+        action="store_true",
+        help="Check pages with fast, columnar checks of the schema's constraints first,\
+        only running full JSON Schema validation on the records that don't pass them."
+    )
+
+    parser.add_argument(
+        "--profile",
+        const="profiles",
+        nargs="?",
+        type=str,
+        help="Profile each stage of the run with cProfile and tracemalloc, printing the top hotspots at the end.\
+        Optionally provide the directory to write per-stage .pstats files to (default: profiles)."
+    )
+
+    parser.add_argument(
+        "--validation_chunk_size",
+        type=int,
+        help="With --validation_workers, split payloads into chunks of this many records for validation."
+    )
+
+    parser.add_argument(
+        "--validation_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to validate payloads in parallel."
+    )
+
     parser.add_argument(
         "--version",
         type=lambda v: mds.Version(v),
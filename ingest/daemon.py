@@ -0,0 +1,436 @@
+"""
+Run ingestion as a long-running daemon, polling the endpoints of every provider in the configuration file on their own schedules.
+
+Each (provider, record type) is polled by an asyncio task; the ingestion flow of each poll runs on a shared thread pool,
+with one database connection pool and one set of validators for the whole daemon.
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import json
+import pathlib
+import signal
+import time
+import traceback
+
+import mds
+
+import common
+import database
+import main
+import metrics
+import profiling
+import scheduler
+import validation
+import watermarks
+
+
+# keys of a provider's configuration read by the daemon, not passed to mds.Provider
+SCHEDULE_KEYS = ["schedule", "validation_sample", "validation_strata", "version"]
+
+# default seconds between polls of an endpoint
+DEFAULT_INTERVAL = 3600
+
+# the record types each version supports
+RECORD_TYPES = [mds.STATUS_CHANGES, mds.TRIPS]
+RECORD_TYPES_040 = RECORD_TYPES + [mds.EVENTS]
+RECORD_TYPES_041 = RECORD_TYPES_040 + [mds.VEHICLES]
+
+
+def setup_cli():
+    """
+    Create the cli argument interface, and parses incoming args.
+
+    Returns a tuple:
+        - the argument parser
+        - the parsed args
+    """
+    parser = common.setup_cli(description="Poll MDS data from all configured providers into a database.")
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        help="Stream each poll through validation and loading in batches of this many pages."
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="The number of a provider's endpoints polled at once. May also be set per provider\
+        with 'concurrency' in the provider's 'schedule' in the configuration file."
+    )
+
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help=f"Number of seconds between polls of each endpoint (default {DEFAULT_INTERVAL}). May also be set per provider,\
+        or per record type, with 'interval' in the provider's 'schedule' in the configuration file."
+    )
+
+    parser.add_argument(
+        "--load_engine",
+        choices=["upsert", "copy"],
+        default="upsert",
+        help="How to load records into the database, see main.py --help."
+    )
+
+    parser.add_argument(
+        "--lookback",
+        type=int,
+        help="Number of seconds before each poll to request, for time range queries. Defaults to the interval.\
+        May also be set per provider with 'lookback' in the provider's 'schedule' in the configuration file."
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Append a JSON line per stage measurement to this file."
+    )
+
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        help="Write the per-stage totals, and the time of each endpoint's last successful poll,\
+        to this Prometheus textfile after every poll."
+    )
+
+    parser.add_argument(
+        "--no_load",
+        action="store_true",
+        help="Do not attempt to load the returned data into a database."
+    )
+
+    parser.add_argument(
+        "--no_validate",
+        action="store_true",
+        help="Do not perform JSON Schema validation against the returned data."
+    )
+
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Poll every endpoint once, then exit."
+    )
+
+    parser.add_argument(
+        "--rate_limit",
+        type=int,
+        help="Number of seconds between page requests to a provider, across all of its endpoints polled at once.\
+        May also be set per provider with 'rate_limit' in the provider's 'schedule' in the configuration file."
+    )
+
+    parser.add_argument(
+        "--registry",
+        type=str,
+        help="Path to a providers.csv registry file to use instead of downloading from GitHub."
+    )
+
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Before loading, skip the records already in the database, see main.py --help."
+    )
+
+    parser.add_argument(
+        "--statement_timeout",
+        type=int,
+        help="Number of seconds after which a database statement is cancelled."
+    )
+
+    parser.add_argument(
+        "--watermarks",
+        action="store_true",
+        help="Advance each endpoint's watermark in the ingest_watermarks table after every successful poll,\
+        and after a restart, resume polling each endpoint from its watermark. See main.py --help for --incremental."
+    )
+
+    return parser, parser.parse_args()
+
+
+def record_types(version):
+    """
+    Get the record types supported at version.
+    """
+    if version < common.VERSION_040:
+        return RECORD_TYPES
+    if version < mds.Version._041_():
+        return RECORD_TYPES_040
+    return RECORD_TYPES_041
+
+
+def hourly(record_type, version):
+    """
+    True if record_type is requested one complete hour at a time at version.
+    """
+    return version >= common.VERSION_040 and record_type in [mds.STATUS_CHANGES, mds.TRIPS]
+
+
+def hours(start, now):
+    """
+    Get the start of each complete hour from the hour of start up to now.
+    """
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    complete = []
+
+    while hour + datetime.timedelta(hours=1) <= now:
+        complete.append(hour)
+        hour = hour + datetime.timedelta(hours=1)
+
+    return complete
+
+
+def time_range(record_type, version, now, lookback, polled=None):
+    """
+    Get the (start_time, end_time) to request of a record_type, when polling at now.
+
+    Time range queries request the lookback before now, or from polled (the end of the last successful poll)
+    if that is earlier, so no range is skipped after failed or late polls. Vehicles are not queried by time.
+    """
+    if version >= common.VERSION_040 and record_type == mds.VEHICLES:
+        return None, None
+
+    start = now - datetime.timedelta(seconds=lookback)
+    if polled is not None and polled < start:
+        start = polled
+
+    return start, now
+
+
+def providers(args):
+    """
+    Read the schedule of every provider in the configuration file.
+
+    Returns a list of dicts, one per provider.
+    """
+    config_path = pathlib.Path(args.config or "./config.json")
+    with open(config_path) as f:
+        names = list(json.load(f).keys())
+
+    schedules = []
+
+    for name in names:
+        config = common.get_config(name, str(config_path))
+        settings = { key: config.pop(key, None) for key in SCHEDULE_KEYS }
+        schedule = settings["schedule"] or {}
+
+        version = mds.Version(settings["version"] or args.version)
+        version.raise_if_unsupported()
+
+        if args.registry and pathlib.Path(args.registry).is_file():
+            provider = mds.Provider(name, path=args.registry, **config)
+        else:
+            provider = mds.Provider(name, ref=version, **config)
+
+        supported = record_types(version)
+        requested = schedule.get("record_types") or supported
+        unsupported = [r for r in requested if r not in supported]
+        if len(unsupported) > 0:
+            print(f"Not polling {', '.join(unsupported)} from {name}, unsupported at version {version}")
+
+        interval = schedule.get("interval") or args.interval
+        intervals = {
+            record_type: int(interval.get(record_type, args.interval) if isinstance(interval, dict) else interval)
+            for record_type in requested if record_type in supported
+        }
+
+        rate_limit = schedule.get("rate_limit") or args.rate_limit
+        validation_sample = settings["validation_sample"]
+
+        schedules.append(dict(
+            name=name,
+            provider=provider,
+            version=version,
+            intervals=intervals,
+            lookback=schedule.get("lookback") or args.lookback,
+            concurrency=int(schedule.get("concurrency") or args.concurrency),
+            rate_limit=rate_limit,
+            limiter=scheduler.bucket(name, rate_limit),
+            validation_sample=float(validation_sample) if validation_sample else None,
+            validation_strata=settings["validation_strata"],
+            polled={}
+        ))
+
+    return schedules
+
+
+def poll(source, record_type, **kwargs):
+    """
+    Run the ingestion flow for a provider's record_type, on the time range ending now.
+
+    For version >= 0.4.0, status_changes and trips are requested one complete hour at a time, for every hour since the
+    last successful poll (or within the lookback, at first), so hours aren't skipped after failed or late polls.
+
+    With watermarks, the end of the last successful poll is read from the endpoint's watermark at first (e.g. after a restart),
+    and the watermark is advanced after every successful poll (or hour). Otherwise, it is only kept in memory.
+
+    Runs on a thread of the daemon's pool. Returns the number of valid records.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lookback = source["lookback"] or source["intervals"][record_type]
+    polled = source["polled"].get(record_type)
+
+    # vehicles are not queried by time, and have no watermark
+    engine = database.engine() if kwargs.pop("watermarks", False) and record_type != mds.VEHICLES else None
+    name, provider_id = source["provider"].provider_name, source["provider"].provider_id
+
+    if polled is None and engine is not None:
+        mark = watermarks.get(name, record_type, engine)
+        if mark is not None:
+            polled = mark["last_time"]
+            print(f"{name} {record_type} watermark at {polled.isoformat()}, resuming from there")
+
+    # requests sessions are not thread-safe, use a new client per poll
+    client = mds.Client(source["provider"], version=source["version"])
+
+    def _ingest(start_time, end_time):
+        return main.ingest(
+            record_type,
+            **kwargs,
+            client=client,
+            version=source["version"],
+            start_time=start_time,
+            end_time=end_time,
+            rate_limit=source["rate_limit"],
+            rate_limiter=source["limiter"],
+            checked_paging=True,
+            validation_sample=source["validation_sample"],
+            validation_strata=source["validation_strata"]
+        )
+
+    if hourly(record_type, source["version"]):
+        total = 0
+        for hour in hours(polled or now - datetime.timedelta(seconds=lookback), now):
+            total += _ingest(None, hour)
+            source["polled"][record_type] = hour + datetime.timedelta(hours=1)
+            if engine is not None:
+                watermarks.advance(name, provider_id, record_type, hour, hour + datetime.timedelta(hours=1), engine)
+        return total
+
+    start_time, end_time = time_range(record_type, source["version"], now, lookback, polled)
+    total = _ingest(start_time, end_time)
+    if end_time is not None:
+        source["polled"][record_type] = end_time
+        if engine is not None:
+            watermarks.advance(name, provider_id, record_type, start_time, end_time, engine)
+
+    return total
+
+
+async def schedule(source, record_type, executor, semaphore, once=False, **kwargs):
+    """
+    Poll a provider's record_type every interval seconds, no more than the provider's concurrency at once.
+
+    A failed poll is reported, and the endpoint polled again at the next interval.
+    """
+    loop = asyncio.get_running_loop()
+    interval = source["intervals"][record_type]
+    name = source["name"]
+
+    while True:
+        started = time.monotonic()
+
+        async with semaphore:
+            print(f"Polling {record_type} from {name}")
+            try:
+                records = await loop.run_in_executor(executor, functools.partial(poll, source, record_type, **kwargs))
+                print(f"Polled {records} {record_type} from {name} in {time.monotonic() - started:.2f}s")
+                metrics.METRICS.gauge("mds_ingest_daemon_last_success", int(time.time()), provider=name, record_type=record_type)
+            except Exception:
+                print(f"Polling {record_type} from {name} failed:")
+                traceback.print_exc()
+                metrics.METRICS.gauge("mds_ingest_daemon_last_failure", int(time.time()), provider=name, record_type=record_type)
+
+        metrics.METRICS.write()
+
+        if once:
+            return
+
+        await asyncio.sleep(max(started + interval - time.monotonic(), 0))
+
+
+async def run(sources, workers, once=False, **kwargs):
+    """
+    Poll all of the sources until cancelled (or once each, with once).
+    """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    tasks = []
+    for source in sources:
+        semaphore = asyncio.Semaphore(source["concurrency"])
+        for record_type in source["intervals"].keys():
+            tasks.append(asyncio.ensure_future(schedule(source, record_type, executor, semaphore, once=once, **kwargs)))
+
+    # stop scheduling new polls on SIGTERM, as on Ctrl-C
+    gathered = asyncio.gather(*tasks)
+    try:
+        loop.add_signal_handler(signal.SIGTERM, gathered.cancel)
+    except NotImplementedError:
+        pass
+
+    try:
+        await gathered
+    except asyncio.CancelledError:
+        print("Stopping, waiting for polls in progress")
+    finally:
+        executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    now = datetime.datetime.utcnow()
+
+    arg_parser, args = setup_cli()
+
+    print(f"Starting ingestion daemon: {now.isoformat()}")
+
+    if args.watermarks and args.no_load:
+        print("--watermarks tracks what was loaded, it can't be used with --no_load.")
+        print("Run daemon.py --help for more information.")
+        print("Exiting.")
+        print()
+        exit(1)
+
+    metrics.configure(jsonl=args.metrics, prometheus=args.metrics_prom)
+
+    if args.profile:
+        profiling.configure(args.profile)
+
+    # registries, configuration and validators are loaded once, for every poll
+    sources = [s for s in providers(args) if len(s["intervals"]) > 0]
+    if len(sources) == 0:
+        print("No providers to poll in the configuration file.")
+        print("Exiting.")
+        print()
+        exit(1)
+
+    for source in sources:
+        schedule_info = ", ".join([f"{r} every {i}s" for r, i in source["intervals"].items()])
+        print(f"{source['name']} @ {source['version']}: {schedule_info}, {source['concurrency']} at once")
+
+    if not args.no_validate:
+        for version in set([str(s["version"]) for s in sources]):
+            validation.warm_validators(mds.Version(version), record_types(mds.Version(version)))
+
+    # one pooled database engine is shared by every poll
+    workers = sum([min(s["concurrency"], len(s["intervals"])) for s in sources])
+    if not args.no_load:
+        database.engine(pool_size=workers, statement_timeout=args.statement_timeout)
+
+    kwargs = vars(args)
+    for key in ["concurrency", "config", "interval", "lookback", "metrics", "metrics_prom", "once", "profile", "rate_limit",
+                "registry", "statement_timeout", "version"]:
+        kwargs.pop(key, None)
+
+    try:
+        asyncio.run(run(sources, workers, once=args.once, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+    main.print_pool_stats()
+    main.write_metrics()
+    profiling.report()
+    print(f"Finished ingestion daemon ({common.count_seconds(now)}s)")
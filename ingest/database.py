@@ -2,10 +2,16 @@
 Load MDS provider data from a variety of sources into a database.
 """
 
+import datetime
 import os
+import threading
+import time
 
 import mds
+import sqlalchemy
+import sqlalchemy.pool
 
+import bulk
 import common
 
 
@@ -17,6 +23,22 @@ COLUMNS = {
 }
 COLUMNS[mds.EVENTS] = COLUMNS[mds.STATUS_CHANGES]
 
+# columns recording the time of a record
+TIME_COLUMNS = {
+    mds.STATUS_CHANGES: "event_time",
+    mds.TRIPS: "end_time",
+    mds.VEHICLES: "last_updated"
+}
+TIME_COLUMNS[mds.EVENTS] = TIME_COLUMNS[mds.STATUS_CHANGES]
+
+# columns held by the payload rather than each record
+PAYLOAD_COLUMNS = {
+    mds.VEHICLES: ["last_updated", "ttl"]
+}
+
+# columns holding MDS timestamps
+TIMESTAMP_COLUMNS = set(["event_time", "publication_time", "start_time", "end_time", "last_event_time", "last_updated"])
+
 # default ON CONFLICT UPDATE actions
 UPDATE_ACTIONS = {
     mds.STATUS_CHANGES: {
@@ -53,6 +75,82 @@ UPDATE_ACTIONS = {
 UPDATE_ACTIONS[mds.EVENTS] = UPDATE_ACTIONS[mds.STATUS_CHANGES]
 
 
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """
+    A connection pool that records how long it takes to acquire connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.acquire_seconds = 0.0
+        self.acquire_max = 0.0
+        self._timing_lock = threading.Lock()
+
+    def connect(self):
+        start = time.perf_counter()
+        connection = super().connect()
+        elapsed = time.perf_counter() - start
+
+        with self._timing_lock:
+            self.acquired += 1
+            self.acquire_seconds += elapsed
+            self.acquire_max = max(self.acquire_max, elapsed)
+
+        return connection
+
+
+def engine(pool_size=5, max_overflow=5, statement_timeout=None):
+    """
+    Get the long-lived, pooled database engine shared by all loads in this process.
+
+    The engine is created on the first call, using the configuration from env() and the given pool options.
+    Later calls return the same engine and ignore their arguments.
+
+    :statement_timeout: Number of seconds after which a statement is cancelled by the server.
+    """
+    global _ENGINE
+
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            config = env()
+            uri = f"postgresql://{config['user']}:{config['password']}@{config['host']}:{config['port']}/{config['db']}"
+
+            connect_args = {}
+            if statement_timeout:
+                connect_args["options"] = f"-c statement_timeout={int(statement_timeout * 1000)}"
+
+            _ENGINE = sqlalchemy.create_engine(
+                uri,
+                poolclass=TimedQueuePool,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=True,
+                connect_args=connect_args
+            )
+
+        return _ENGINE
+
+
+def pool_stats():
+    """
+    Get connection acquire statistics for the shared engine's pool.
+
+    Returns dict { acquired, avg_ms, max_ms }, or None if the engine has not been created.
+    """
+    if _ENGINE is None or not isinstance(_ENGINE.pool, TimedQueuePool):
+        return None
+
+    pool = _ENGINE.pool
+    avg = pool.acquire_seconds / pool.acquired if pool.acquired > 0 else 0
+
+    return dict(acquired=pool.acquired, avg_ms=round(avg * 1000, 2), max_ms=round(pool.acquire_max * 1000, 2))
+
+
 def conflict_update_condition(columns):
     """
     Create the (condition) portion of the "ON CONFLICT (condition) DO UPDATE (actions)" statement.
@@ -112,9 +210,110 @@ def env():
     return dict(user=user, password=password, db=db, host=host, port=port)
 
 
+def payload_records(payload, record_type, data_key):
+    """
+    Get the records of a payload, with the payload's values of the PAYLOAD_COLUMNS of record_type (e.g. the last_updated
+    and ttl of vehicles) merged into each, as mds.Database does when loading. Values in the records take precedence.
+    """
+    fields = { c: payload[c] for c in PAYLOAD_COLUMNS.get(record_type, []) if c in payload }
+    records = payload["data"][data_key]
+
+    if len(fields) == 0:
+        return records
+
+    return [{ **fields, **record } for record in records]
+
+
+def _key_value(column, value, decoder):
+    """
+    Normalize a record value to compare with the same column of an existing key.
+    """
+    if value is None:
+        return None
+    if column in TIMESTAMP_COLUMNS:
+        ts = decoder.decode(value)
+        return ts if ts.tzinfo is not None else ts.replace(tzinfo=datetime.timezone.utc)
+
+    value = str(value)
+    # uuids come back from the database in lowercase
+    if len(value) == 36 and value.count("-") == 4:
+        value = value.lower()
+    return value
+
+
+def skip_existing(datasource, record_type, columns, version, engine):
+    """
+    Remove the records already in the database from datasource, comparing their columns.
+
+    The existing keys are fetched with a single query over the providers and time range of the records,
+    using the (provider_id, time column) index. Payload-level columns (e.g. the last_updated of vehicles)
+    are compared as part of each record.
+
+    Returns a tuple (datasource, skipped) with copies of the payloads that still have records,
+    and the number of records removed.
+    """
+    data_key = mds.Schema(record_type).data_key
+    decoder = mds.encoding.TimestampDecoder(version=version)
+    time_column = TIME_COLUMNS[record_type]
+
+    def _key(record):
+        return tuple(_key_value(c, record.get(c), decoder) for c in columns)
+
+    times, providers = [], set()
+    for payload in datasource:
+        for record in payload_records(payload, record_type, data_key):
+            if record.get(time_column) is not None:
+                times.append(_key_value(time_column, record[time_column], decoder))
+            if record.get("provider_id") is not None:
+                providers.add(str(record["provider_id"]))
+
+    if len(times) == 0 or len(providers) == 0:
+        return datasource, 0
+
+    select = ", ".join([c if c in TIMESTAMP_COLUMNS else f"{c}::text" for c in columns])
+    sql = f"""
+    SELECT {select} FROM {record_type}
+    WHERE provider_id = ANY(CAST(:providers AS uuid[])) AND {time_column} BETWEEN :start AND :end
+    """
+
+    with engine.connect() as connection:
+        rows = connection.execute(sqlalchemy.text(sql), providers=list(providers), start=min(times), end=max(times))
+        existing = set()
+        for row in rows:
+            existing.add(tuple(v if c in TIMESTAMP_COLUMNS else _key_value(c, v, decoder) for c, v in zip(columns, row)))
+
+    filtered, skipped = [], 0
+
+    for payload in datasource:
+        records = payload["data"][data_key]
+        keys = [_key(r) for r in payload_records(payload, record_type, data_key)]
+        new = [r for r, k in zip(records, keys) if k not in existing]
+        skipped += len(records) - len(new)
+
+        if len(new) == len(records):
+            filtered.append(payload)
+        elif len(new) > 0:
+            # create a copy to preserve the original payload
+            filtered.append({ **payload, "data": { data_key: new } })
+
+    return filtered, skipped
+
+
 def load(datasource, record_type, **kwargs):
     """
     Load data into a database.
+
+    With load_engine="copy", records are streamed into a staging table with COPY and merged in one statement;
+    otherwise (the default "upsert") they are loaded through mds.Database.
+
+    With skip_unchanged (COPY load engine only), conflicting rows are only updated if their data changed,
+    and the numbers of rows inserted, updated and unchanged are reported.
+
+    With skip_existing, records already in the database are removed before loading (see `skip_existing()`),
+    unless there are update actions; existing records then need to be updated.
+
+    Returns dict { records, seconds, rate, skipped, skip_seconds }, with the { staged, merged, stage_seconds, merge_seconds }
+    (and { inserted, updated, unchanged } with skip_unchanged) of the COPY load engine.
     """
     print(f"Loading {record_type}")
 
@@ -135,24 +334,63 @@ def load(datasource, record_type, **kwargs):
     if len(actions) == 1 and actions[0] is True:
         # flag-only option, use defaults
         actions = default_conflict_update_actions(record_type, version)
-    elif len(actions) > 1:
+    elif len(actions) > 0:
         # convert action tuples to dict, filtering any flag-only options
         actions = dict(filter(lambda x: x is not True, actions))
 
     stage_first = int(kwargs.pop("stage_first", True))
+    load_engine = kwargs.pop("load_engine", None) or "upsert"
+    skip_unchanged = kwargs.pop("skip_unchanged", False)
+
+    if skip_unchanged and load_engine != "copy":
+        raise ValueError("Skipping unchanged records requires the copy load engine.")
+
+    db = kwargs.get("db") or mds.Database(engine=engine(), stage_first=stage_first, version=version)
+
+    skipped, skip_seconds = 0, 0.0
+    if kwargs.pop("skip_existing", False):
+        if len(actions) > 0:
+            print("Not skipping existing records, existing records may need to be updated")
+        else:
+            start = time.perf_counter()
+            datasource, skipped = skip_existing(datasource, record_type, columns, version, db.engine)
+            skip_seconds = time.perf_counter() - start
+            print(f"Skipped {skipped} {record_type} already in the database ({skip_seconds:.2f}s)")
+
+    data_key = mds.Schema(record_type).data_key
+    records = sum([len(d["data"][data_key]) for d in datasource])
+
+    if records == 0:
+        print(f"No new {record_type} to load")
+        return dict(records=0, seconds=0.0, rate=0, skipped=skipped, skip_seconds=skip_seconds)
+
+    start = time.perf_counter()
+    result = {}
+
+    if load_engine == "copy":
+        # the copy load engine only reads the records, merge in any payload-level columns
+        datasource = [{ **d, "data": { data_key: payload_records(d, record_type, data_key) } } for d in datasource]
+        result = bulk.load(datasource, record_type, record_type, columns, actions, version, db.engine, detect_changes=skip_unchanged)
+        print(f"Staged {result['staged']} records in {result['stage_seconds']:.2f}s,",
+              f"merged {result['merged']} in {result['merge_seconds']:.2f}s")
+        if skip_unchanged:
+            print(f"Inserted {result['inserted']}, updated {result['updated']}, unchanged {result['unchanged']} {record_type}")
+    else:
+        load_config = dict(table=record_type, drop_duplicates=columns)
+        if len(actions) > 0:
+            load_config["on_conflict_update"] = conflict_update_condition(columns), actions
+
+        if record_type == mds.EVENTS:
+            db.load_events(datasource, **load_config)
+        elif record_type == mds.STATUS_CHANGES:
+            db.load_status_changes(datasource, **load_config)
+        elif record_type == mds.TRIPS:
+            db.load_trips(datasource, **load_config)
+        elif record_type == mds.VEHICLES:
+            db.load_vehicles(datasource, **load_config)
+
+    elapsed = time.perf_counter() - start
+    rate = records / elapsed if elapsed > 0 else 0
+    print(f"Loaded {records} {record_type} with {load_engine} in {elapsed:.2f}s ({rate:.0f} records/s)")
 
-    db_config = dict(stage_first=stage_first, version=version, **env())
-    db = kwargs.get("db", mds.Database(**db_config))
-
-    load_config = dict(table=record_type, drop_duplicates=columns)
-    if len(actions) > 0:
-        load_config["on_conflict_update"] = conflict_update_condition(columns), actions
-
-    if record_type == mds.EVENTS:
-        db.load_events(datasource, **load_config)
-    elif record_type == mds.STATUS_CHANGES:
-        db.load_status_changes(datasource, **load_config)
-    elif record_type == mds.TRIPS:
-        db.load_trips(datasource, **load_config)
-    elif record_type == mds.VEHICLES:
-        db.load_vehicles(datasource, **load_config)
+    return dict(result, records=records, seconds=elapsed, rate=rate, skipped=skipped, skip_seconds=skip_seconds)
@@ -0,0 +1,114 @@
+"""
+Suppress records seen more than once during a run, e.g. in the overlapping windows of a backfill.
+"""
+
+import threading
+
+import mds
+import sortedcontainers
+
+import database
+
+
+class SeenRecords():
+    """
+    Remember the unique keys of records already loaded during this run, so they can be skipped later.
+
+    Keys are only kept for records within a time horizon of the window being ingested, bounding memory use.
+    """
+
+    def __init__(self, record_type, version, columns=None, horizon=None):
+        """
+        Initialize a new `SeenRecords` instance.
+
+        Required positional arguments:
+
+        :record_type: The type of MDS records being seen.
+
+        :version: The MDS version of the records, used to decode their timestamps.
+
+        Optional keyword arguments:
+
+        :columns: The column names determining a unique record (default `database.COLUMNS[record_type]`).
+
+        :horizon: A `timedelta`; keys for records further than this outside of the current window are evicted.
+        Without a horizon, keys are never evicted.
+        """
+        self.columns = columns or database.COLUMNS[record_type]
+        self.time_column = database.TIME_COLUMNS[record_type]
+        self.data_key = mds.Schema(record_type).data_key
+        self.decoder = mds.encoding.TimestampDecoder(version=version)
+        self.horizon = horizon
+        self.keys = set()
+        self.times = sortedcontainers.SortedKeyList(key=lambda item: item[0])
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _key(self, record):
+        return tuple(record.get(c) for c in self.columns)
+
+    def _time(self, record):
+        try:
+            return self.decoder.decode(record[self.time_column])
+        except:
+            return None
+
+    def filter(self, payloads):
+        """
+        Remove records already seen from the payloads.
+
+        Returns a tuple (payloads, skipped) with copies of the payloads that still have records,
+        and the number of records removed.
+        """
+        filtered, skipped = [], 0
+
+        with self.lock:
+            for payload in payloads:
+                records = payload["data"][self.data_key]
+                unseen = [r for r in records if self._key(r) not in self.keys]
+                skipped += len(records) - len(unseen)
+
+                if len(unseen) == len(records):
+                    filtered.append(payload)
+                elif len(unseen) > 0:
+                    # create a copy to preserve the original payload
+                    filtered.append({ **payload, "data": { self.data_key: unseen } })
+
+            self.skipped += skipped
+
+        return filtered, skipped
+
+    def add(self, payloads):
+        """
+        Remember the records in the payloads as seen.
+        """
+        with self.lock:
+            for payload in payloads:
+                for record in payload["data"][self.data_key]:
+                    key = self._key(record)
+                    if key in self.keys:
+                        continue
+
+                    self.keys.add(key)
+
+                    time = self._time(record)
+                    if time is not None:
+                        self.times.add((time, key))
+
+    def evict(self, start, end):
+        """
+        Forget records further than the horizon outside of the window [start, end].
+        """
+        if self.horizon is None:
+            return
+
+        low, high = start - self.horizon, end + self.horizon
+
+        with self.lock:
+            while len(self.times) > 0 and self.times[0][0] < low:
+                self.keys.discard(self.times.pop(0)[1])
+            while len(self.times) > 0 and self.times[-1][0] > high:
+                self.keys.discard(self.times.pop()[1])
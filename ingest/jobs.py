@@ -0,0 +1,428 @@
+"""
+Scale ingestion out across processes and hosts with a queue of (provider, record type, window) jobs in the database.
+
+  - enqueue: add the windows of a backfill range to the ingest_jobs table
+  - work: claim jobs with SELECT ... FOR UPDATE SKIP LOCKED and run the ingestion flow for their windows,
+    heartbeating while they run, and retrying failed windows with backoff
+  - status: count the jobs by provider, record type and status
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+import traceback
+
+import mds
+import sqlalchemy
+
+import common
+import daemon
+import database
+import main
+import metrics
+import profiling
+import scheduler
+import validation
+
+
+# seconds between a running job's heartbeats
+HEARTBEAT = 30
+
+# running jobs without a heartbeat for this many seconds are reclaimed, e.g. after a worker crashed
+STALE = 300
+
+# seconds before retrying a failed job the first time, doubling with each attempt
+RETRY_DELAY = 60
+
+_CLAIM = """
+UPDATE ingest_jobs
+SET status = 'running', attempts = attempts + 1, worker = :worker, heartbeat = now(), updated = now()
+WHERE job_id = (
+    SELECT job_id FROM ingest_jobs
+    WHERE (status = 'pending' AND run_after <= now())
+        OR (status = 'running' AND heartbeat < now() - make_interval(secs => :stale) AND attempts < max_attempts)
+    ORDER BY run_after, job_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING job_id, provider, record_type, start_time, end_time, attempts, max_attempts
+"""
+
+_EXPIRE = """
+UPDATE ingest_jobs
+SET status = 'failed', error = 'No heartbeat from worker ' || worker || ' on the last attempt', updated = now()
+WHERE status = 'running' AND heartbeat < now() - make_interval(secs => :stale) AND attempts >= max_attempts
+RETURNING job_id
+"""
+
+_HEARTBEAT = """
+UPDATE ingest_jobs SET heartbeat = now() WHERE job_id = :job_id AND worker = :worker AND status = 'running'
+"""
+
+_DONE = """
+UPDATE ingest_jobs SET status = 'done', records = :records, error = NULL, updated = now()
+WHERE job_id = :job_id AND worker = :worker
+"""
+
+_FAILED = """
+UPDATE ingest_jobs
+SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END,
+    run_after = now() + make_interval(secs => :delay * power(2, attempts - 1)),
+    error = :error,
+    updated = now()
+WHERE job_id = :job_id AND worker = :worker
+"""
+
+_ENQUEUE = """
+INSERT INTO ingest_jobs (provider, record_type, start_time, end_time, max_attempts)
+VALUES (:provider, :record_type, :start_time, :end_time, :max_attempts)
+ON CONFLICT ON CONSTRAINT unique_ingest_job DO NOTHING
+"""
+
+_STATUS = """
+SELECT provider, record_type, status, count(*), min(start_time), max(end_time)
+FROM ingest_jobs
+GROUP BY provider, record_type, status
+ORDER BY provider, record_type, status
+"""
+
+
+def setup_cli():
+    """
+    Create the cli argument interface, and parses incoming args.
+
+    Returns a tuple:
+        - the argument parser
+        - the parsed args
+    """
+    parser = common.setup_cli(description="Queue and run MDS ingestion windows with workers on any number of hosts.")
+
+    commands = parser.add_subparsers(dest="command")
+
+    enqueue = commands.add_parser("enqueue", help="Add the windows of a backfill range to the queue.")
+    enqueue.add_argument("provider", type=str, help="The name or identifier of the provider.")
+    enqueue.add_argument(
+        "--duration",
+        type=int,
+        help="Number of seconds in each window. For version < 0.4.0, windows overlap by half, as with a backfill.\
+        For version >= 0.4.0, status_changes and trips are queued by the hour."
+    )
+    enqueue.add_argument("--end_time", type=str, required=True, help="The end of the range to queue.")
+    enqueue.add_argument("--events", action="store_true", help="Queue events.")
+    enqueue.add_argument("--max_attempts", type=int, default=3, help="Number of times to try each window.")
+    enqueue.add_argument("--start_time", type=str, required=True, help="The beginning of the range to queue.")
+    enqueue.add_argument("--status_changes", action="store_true", help="Queue status changes.")
+    enqueue.add_argument("--trips", action="store_true", help="Queue trips.")
+
+    work = commands.add_parser("work", help="Claim and run queued windows.")
+    work.add_argument("--batch_size", type=int, help="Stream each window through the flow in batches of this many pages.")
+    work.add_argument("--drain", action="store_true", help="Exit once no jobs are ready, instead of polling for more.")
+    work.add_argument(
+        "--heartbeat",
+        type=int,
+        default=HEARTBEAT,
+        help=f"Number of seconds between heartbeats of a running job (default {HEARTBEAT})."
+    )
+    work.add_argument("--load_engine", choices=["upsert", "copy"], default="upsert", help="How to load records into the database.")
+    work.add_argument("--metrics", type=str, help="Append a JSON line per stage measurement to this file.")
+    work.add_argument("--no_validate", action="store_true", help="Do not perform JSON Schema validation against the returned data.")
+    work.add_argument("--poll", type=int, default=10, help="Number of seconds to wait for new jobs when none are ready.")
+    work.add_argument("--registry", type=str, help="Path to a providers.csv registry file to use instead of downloading from GitHub.")
+    work.add_argument(
+        "--retry_delay",
+        type=int,
+        default=RETRY_DELAY,
+        help=f"Number of seconds before retrying a failed job, doubling with each attempt (default {RETRY_DELAY})."
+    )
+    work.add_argument("--skip_existing", action="store_true", help="Before loading, skip the records already in the database.")
+    work.add_argument(
+        "--stale",
+        type=int,
+        default=STALE,
+        help=f"Reclaim running jobs without a heartbeat for this many seconds (default {STALE})."
+    )
+    work.add_argument("--workers", type=int, default=1, help="Number of jobs to run at once in this process.")
+
+    commands.add_parser("status", help="Count the queued jobs by provider, record type and status.")
+
+    return parser, parser.parse_args()
+
+
+def windows(record_type, version, start, end, duration):
+    """
+    Generate the (start, end) windows of a record_type to queue between start and end.
+    """
+    if version < common.VERSION_040:
+        yield from scheduler.windows(start, end, duration)
+    elif record_type in [mds.STATUS_CHANGES, mds.TRIPS]:
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        while hour < end:
+            yield hour, hour + datetime.timedelta(hours=1)
+            hour += datetime.timedelta(hours=1)
+    else:
+        while start < end:
+            yield start, min(start + duration, end)
+            start += duration
+
+
+def enqueue(args):
+    """
+    Add the windows of the requested record types between start_time and end_time to the queue.
+
+    Windows already queued are left as they are.
+    """
+    config = common.get_config(args.provider, args.config)
+    version = mds.Version(config.get("version", args.version))
+    version.raise_if_unsupported()
+
+    record_types = [r for r, requested in [
+        (mds.EVENTS, args.events),
+        (mds.STATUS_CHANGES, args.status_changes),
+        (mds.TRIPS, args.trips)
+    ] if requested]
+
+    start, end = common.parse_time_range(start_time=args.start_time, end_time=args.end_time, version=version)
+    duration = datetime.timedelta(seconds=args.duration or 3600)
+
+    engine = database.engine(pool_size=1)
+    queued = 0
+
+    with engine.begin() as connection:
+        for record_type in record_types:
+            if record_type not in daemon.record_types(version):
+                print(f"Not queueing {record_type}, unsupported at version {version}")
+                continue
+            for _start, _end in windows(record_type, version, start, end, duration):
+                result = connection.execute(
+                    sqlalchemy.text(_ENQUEUE),
+                    provider=args.provider,
+                    record_type=record_type,
+                    start_time=_start,
+                    end_time=_end,
+                    max_attempts=args.max_attempts
+                )
+                queued += result.rowcount
+
+    print(f"Queued {queued} windows of {', '.join(record_types)} from {args.provider}, {start.isoformat()} to {end.isoformat()}")
+
+
+def status():
+    """
+    Print the number of jobs by provider, record type and status.
+    """
+    with database.engine(pool_size=1).connect() as connection:
+        rows = connection.execute(sqlalchemy.text(_STATUS)).fetchall()
+
+    if len(rows) == 0:
+        print("No jobs queued")
+
+    for provider, record_type, status, count, start, end in rows:
+        print(f"{provider} {record_type} {status}: {count} ({start.isoformat()} to {end.isoformat()})")
+
+
+class Worker():
+    """
+    Claim queued jobs and run the ingestion flow for their windows, until there are none left (with drain) or forever.
+    """
+
+    def __init__(self, args, name=None):
+        """
+        Initialize a new `Worker` instance.
+
+        Required positional arguments:
+
+        :args: The parsed work command args.
+
+        Optional keyword arguments:
+
+        :name: The name recorded on the jobs this worker claims, by default <host>:<pid>.
+        """
+        self.args = args
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.engine = database.engine()
+        self.providers = {}
+        self.lock = threading.Lock()
+
+    def _provider(self, name):
+        """
+        Get the (cached) mds.Provider and version for a provider name.
+        """
+        with self.lock:
+            if name not in self.providers:
+                config = common.get_config(name, self.args.config)
+                settings = { key: config.pop(key, None) for key in daemon.SCHEDULE_KEYS }
+                version = mds.Version(settings["version"] or self.args.version)
+
+                if self.args.registry and os.path.isfile(self.args.registry):
+                    provider = mds.Provider(name, path=self.args.registry, **config)
+                else:
+                    provider = mds.Provider(name, ref=version, **config)
+
+                self.providers[name] = (provider, version)
+
+            return self.providers[name]
+
+    def claim(self):
+        """
+        Claim the next ready job, returning it as a dict, or None.
+
+        Stale jobs are reclaimed, unless that was their last attempt; they are marked failed instead.
+        """
+        with self.engine.begin() as connection:
+            expired = connection.execute(sqlalchemy.text(_EXPIRE), stale=self.args.stale).fetchall()
+            for job_id, in expired:
+                print(f"Job {job_id} stopped heartbeating on its last attempt, giving up")
+
+            row = connection.execute(sqlalchemy.text(_CLAIM), worker=self.name, stale=self.args.stale).fetchone()
+        return dict(row) if row is not None else None
+
+    def _heartbeat(self, job, stop):
+        while not stop.wait(self.args.heartbeat):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(sqlalchemy.text(_HEARTBEAT), job_id=job["job_id"], worker=self.name)
+            except Exception as ex:
+                print(f"Heartbeat for job {job['job_id']} failed: {ex}")
+
+    def run_job(self, job):
+        """
+        Run the ingestion flow for a job's window, heartbeating while it runs, and record the outcome.
+
+        Pages are requested with checked_paging, so a failed request fails the job (to be retried),
+        rather than completing it with fewer records.
+        """
+        provider, version = self._provider(job["provider"])
+        record_type = job["record_type"]
+
+        start_time, end_time = job["start_time"], job["end_time"]
+        if version >= common.VERSION_040 and record_type in [mds.STATUS_CHANGES, mds.TRIPS]:
+            # hourly jobs request the hour starting at start_time
+            start_time, end_time = None, job["start_time"]
+
+        label = f"job {job['job_id']} ({job['provider']} {record_type} {job['start_time'].isoformat()} to {job['end_time'].isoformat()}," \
+            f" attempt {job['attempts']} of {job['max_attempts']})"
+        print(f"Running {label}")
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, stop), daemon=True)
+        heartbeat.start()
+
+        error = None
+        try:
+            records = main.ingest(
+                record_type,
+                client=mds.Client(provider, version=version),
+                version=version,
+                start_time=start_time,
+                end_time=end_time,
+                batch_size=self.args.batch_size,
+                checked_paging=True,
+                load_engine=self.args.load_engine,
+                no_validate=self.args.no_validate,
+                skip_existing=self.args.skip_existing,
+                output=self.args.output,
+                prevalidate=self.args.prevalidate,
+                validation_chunk_size=self.args.validation_chunk_size,
+                validation_workers=self.args.validation_workers
+            )
+        except Exception as ex:
+            traceback.print_exc()
+            error = f"{type(ex).__name__}: {ex}"
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if error is not None:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    sqlalchemy.text(_FAILED), job_id=job["job_id"], worker=self.name, delay=self.args.retry_delay, error=error
+                )
+            retry = "giving up" if job["attempts"] >= job["max_attempts"] else "will retry"
+            print(f"Failed {label}, {retry}")
+            return False
+
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(_DONE), job_id=job["job_id"], worker=self.name, records=records)
+
+        print(f"Completed {label}: {records} records")
+        return True
+
+    def run(self):
+        """
+        Claim and run jobs until there are none ready (with drain), or forever.
+        """
+        while True:
+            job = self.claim()
+
+            if job is None:
+                if self.args.drain:
+                    return
+                time.sleep(self.args.poll)
+                continue
+
+            self.run_job(job)
+
+
+def versions(args):
+    """
+    Get the versions jobs may run at: that of each provider in the configuration file, and the --version default.
+    """
+    config_path = pathlib.Path(args.config or "./config.json")
+    names = []
+    if config_path.is_file():
+        with open(config_path) as f:
+            names = list(json.load(f).keys())
+
+    configured = [common.get_config(name, str(config_path)).get("version") for name in names]
+
+    return set([str(args.version)] + [str(v) for v in configured if v])
+
+
+def work(args):
+    """
+    Run worker threads claiming jobs from the queue, sharing one database connection pool.
+    """
+    # the pool holds a connection per running job, and one per heartbeat
+    database.engine(pool_size=2 * args.workers)
+    metrics.configure(jsonl=args.metrics)
+
+    if args.profile:
+        profiling.configure(args.profile)
+
+    if not args.no_validate:
+        for version in versions(args):
+            validation.warm_validators(version)
+
+    host = f"{socket.gethostname()}:{os.getpid()}"
+    workers = [Worker(args, name=f"{host}:{i}") for i in range(args.workers)]
+    threads = [threading.Thread(target=w.run) for w in workers]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    profiling.report()
+
+
+if __name__ == "__main__":
+    now = datetime.datetime.utcnow()
+
+    arg_parser, args = setup_cli()
+
+    if args.command == "enqueue":
+        enqueue(args)
+    elif args.command == "work":
+        print(f"Starting ingestion worker: {now.isoformat()}")
+        work(args)
+        main.print_pool_stats()
+        print(f"Finished ingestion worker ({common.count_seconds(now)}s)")
+    elif args.command == "status":
+        status()
+    else:
+        arg_parser.print_help()
+        exit(1)
@@ -9,15 +9,25 @@ Command-line interface implementing various MDS Provider data ingestion flows, i
 All fully customizable through extensive parameterization and configuration options.
 """
 
+import concurrent.futures
 import datetime
+import functools
 import pathlib
-import time
+import threading
 
 import mds
 
+import archive
 import common
 import database
+import dedupe
+import metrics
+import prefetch
+import profiling
+import scheduler
 import validation
+import watermarks
+import writer
 
 
 def setup_cli():
@@ -36,6 +46,27 @@ def setup_cli():
         help="The name or identifier of the provider to query."
     )
 
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        help="Stream data through validation, output and loading in batches of this many pages (or files with --source)\
+        instead of acquiring the entire time range up front. Memory use is bounded by the batch size."
+    )
+
+    parser.add_argument(
+        "--backfill_state",
+        type=str,
+        help="Path to a directory recording the windows completed by a backfill.\
+        Rerunning the same backfill skips windows already completed."
+    )
+
+    parser.add_argument(
+        "--backfill_workers",
+        type=int,
+        default=1,
+        help="Number of backfill windows to ingest concurrently."
+    )
+
     parser.add_argument(
         "--columns",
         type=str,
@@ -77,12 +108,47 @@ def setup_cli():
         At least one of --events, --status_changes, --trips, or --vehicles is required."
     )
 
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Path to a file to append per-stage timing and throughput metrics to, as JSON lines."
+    )
+
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        help="Path to a Prometheus textfile collector file (e.g. ingest.prom) to write the run's metrics to."
+    )
+
     parser.add_argument(
         "--no_load",
         action="store_true",
         help="Do not attempt to load the returned data into a database."
     )
 
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Request each record type from its watermark, the time up to which it was last successfully loaded,\
+        less --safety_margin, up to --end_time (default now); and advance the watermark after each successful load.\
+        Without a watermark yet, starts from --start_time, or --duration before the end."
+    )
+
+    parser.add_argument(
+        "--load_engine",
+        choices=["upsert", "copy"],
+        default="upsert",
+        help="How to load records into the database. 'upsert' (default) loads through mds.Database.\
+        'copy' streams records into a staging table with COPY, then merges them in a single statement;\
+        always stages first."
+    )
+
+    parser.add_argument(
+        "--no_dedupe",
+        action="store_true",
+        help="During a backfill, do not skip records already loaded by an overlapping window."
+    )
+
     parser.add_argument(
         "--no_paging",
         action="store_true",
@@ -96,6 +162,49 @@ def setup_cli():
         help="Do not perform JSON Schema validation against the returned data."
     )
 
+    parser.add_argument(
+        "--output_compression",
+        choices=["gzip", "zstd"],
+        default="gzip",
+        help="With --output_format ndjson, the compression of the files. zstd requires the zstandard package."
+    )
+
+    parser.add_argument(
+        "--output_format",
+        choices=["json", "ndjson"],
+        default="json",
+        help="With --output, 'json' (default) writes each page as a JSON payload file.\
+        'ndjson' appends one record per line to compressed files partitioned by provider, record type and day,\
+        which can be read back with --source."
+    )
+
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Run the requested record types concurrently, each with its own API client and database connection."
+    )
+
+    parser.add_argument(
+        "--parquet",
+        type=str,
+        help="Also write valid records to Parquet files in this directory, with typed and flattened columns,\
+        partitioned by record type, provider and day. Requires the pyarrow package."
+    )
+
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        help="Number of database connections to keep open for loading, shared by all record types and backfill windows.\
+        Defaults to the number of record types and/or backfill windows that may load concurrently."
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="With --batch_size, fetch up to this many pages ahead on a background thread\
+        while the current batch is validated and loaded."
+    )
+
     parser.add_argument(
         "--rate_limit",
         type=int,
@@ -110,6 +219,28 @@ def setup_cli():
         help="Path to a providers.csv registry file to use instead of downloading from GitHub."
     )
 
+    parser.add_argument(
+        "--safety_margin",
+        type=int,
+        default=3600,
+        help="With --incremental, the number of seconds before the watermark to start requesting from,\
+        to pick up late-arriving records (default 3600)."
+    )
+
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Before loading, look up the records already in the database for the providers and time range\
+        of each batch, and skip them. Ignored with -U/--on_conflict_update."
+    )
+
+    parser.add_argument(
+        "--skip_unchanged",
+        action="store_true",
+        help="With -U/--on_conflict_update and --load_engine copy, only update existing records whose data changed,\
+        reporting the records inserted, updated and unchanged."
+    )
+
     parser.add_argument(
         "--source",
         type=str,
@@ -117,6 +248,19 @@ def setup_cli():
         help="One or more paths to (directories containing) MDS Provider JSON file(s)"
     )
 
+    parser.add_argument(
+        "--source_stream_size",
+        type=int,
+        help="With --source and --batch_size, parse single payload files larger than this many megabytes incrementally,\
+        in pages of 10000 records, to bound memory use. Requires the ijson package."
+    )
+
+    parser.add_argument(
+        "--source_workers",
+        type=int,
+        help="With --source, the number of processes used to parse files in parallel."
+    )
+
     parser.add_argument(
         "--stage_first",
         default=True,
@@ -134,6 +278,12 @@ def setup_cli():
         For version >= 0.4.0, only valid for --events."
     )
 
+    parser.add_argument(
+        "--statement_timeout",
+        type=int,
+        help="Number of seconds after which a database statement is cancelled."
+    )
+
     parser.add_argument(
         "--status_changes",
         action="store_true",
@@ -163,6 +313,21 @@ def setup_cli():
         Make a distinct request per record type to overcome this limitation."
     )
 
+    parser.add_argument(
+        "--validation_sample",
+        type=float,
+        help="Validate only this portion (between 0 and 1) of the records in each page, assuming the rest are valid.\
+        Switches to full validation for the rest of the run once any sampled record fails; unexpected properties\
+        are only stripped from the sampled records. May also be set per provider with 'validation_sample' in the configuration file."
+    )
+
+    parser.add_argument(
+        "--validation_strata",
+        type=str,
+        help="With --validation_sample, stratify the sample by the values of this field (e.g. vehicle_type).\
+        May also be set per provider with 'validation_strata' in the configuration file."
+    )
+
     parser.add_argument(
         "--vehicle_id",
         type=str,
@@ -176,6 +341,33 @@ def setup_cli():
         At least one of --events, --status_changes, --trips, or --vehicles is required."
     )
 
+    parser.add_argument(
+        "--writer",
+        action="store_true",
+        help="Load into the database on a background thread, coalescing batches into larger loads,\
+        so fetching and validation don't wait on the database."
+    )
+
+    parser.add_argument(
+        "--writer_queue",
+        type=int,
+        help=f"With --writer, the number of batches that may wait to be loaded before the flow blocks.\
+        Defaults to {writer.WRITER_QUEUE}."
+    )
+
+    parser.add_argument(
+        "--writer_records",
+        type=int,
+        help=f"With --writer, load once at least this many records are waiting. Defaults to {writer.WRITER_RECORDS}."
+    )
+
+    parser.add_argument(
+        "--writer_seconds",
+        type=float,
+        help=f"With --writer, load once the oldest waiting records have waited this many seconds.\
+        Defaults to {writer.WRITER_SECONDS:.0f}."
+    )
+
     return parser, parser.parse_args()
 
 
@@ -203,6 +395,14 @@ def backfill(record_type, **kwargs):
     * 2018-12-30T21:00:00 to 2018-12-31T03:00:00
 
     Only valid for version < 0.4.0.
+
+    With backfill_workers > 1, that many windows are ingested concurrently.
+    Pages are requested no more often than once every rate_limit seconds per provider, across all windows in flight.
+
+    With backfill_state, completed windows are recorded in a file in that directory,
+    and skipped when the same backfill is run again.
+
+    Unless no_dedupe, records loaded by one window are skipped when they appear again in an overlapping window.
     """
     version = kwargs.pop("version")
     if version >= common.VERSION_040:
@@ -210,22 +410,131 @@ def backfill(record_type, **kwargs):
 
     kwargs["version"] = version
     kwargs["no_paging"] = False
-    rate_limit = kwargs.get("rate_limit")
 
     duration = datetime.timedelta(seconds=kwargs.pop("duration"))
-    offset = duration / 2
-    end = kwargs.pop("end_time") + offset
+    end = kwargs.pop("end_time")
     start = kwargs.pop("start_time")
+    workers = kwargs.pop("backfill_workers", 1) or 1
+    state_dir = kwargs.pop("backfill_state", None)
+
+    client = kwargs.get("client")
+    provider = client.provider.provider_name if client else "source"
+
+    state = None
+    if state_dir:
+        state = scheduler.WindowState(pathlib.Path(state_dir, f"{provider}_{record_type}.json"))
+
+    # every page request of every window takes a token from the provider's bucket
+    limiter = scheduler.bucket(provider, kwargs.get("rate_limit"))
+    if limiter is not None and client:
+        kwargs["rate_limiter"] = limiter
+        kwargs["checked_paging"] = True
+
+    # windows in flight at once overlap each other by up to workers * duration/2
+    seen = None
+    if not kwargs.pop("no_dedupe", False):
+        seen = dedupe.SeenRecords(record_type, version, columns=kwargs.get("columns"), horizon=workers * duration / 2)
+
+    # all windows append to the same NDJSON files
+    if kwargs.get("output") and kwargs.get("output_format") == "ndjson":
+        kwargs["ndjson"] = archive.NdjsonWriter(
+            kwargs["output"], provider, record_type, version, compression=kwargs.get("output_compression") or "gzip"
+        )
+
+    # all windows write to the same Parquet files
+    if kwargs.get("parquet"):
+        kwargs["parquet_sink"] = archive.ParquetSink(kwargs["parquet"], provider, record_type, version)
+
+    # escalation to full validation applies to the rest of the backfill
+    sampler = None
+    if not kwargs.get("no_validate") and kwargs.get("validation_sample"):
+        sampler = validation.Sampler(kwargs["validation_sample"], strata=kwargs.get("validation_strata"))
+
+    # requests sessions are not thread-safe, use a dedicated client per worker thread
+    local = threading.local()
+
+    def _ingest(_start, _end):
+        _kwargs = dict(kwargs)
+        if workers > 1 and client:
+            if not hasattr(local, "client"):
+                local.client = mds.Client(client.provider, version=version)
+            _kwargs["client"] = local.client
+        if seen is not None:
+            seen.evict(_start, _end)
+        return ingest(record_type, **_kwargs, start_time=_start, end_time=_end, seen=seen, sampler=sampler)
+
+    print(f"Beginning backfill: {start.isoformat()} to {(end + duration / 2).isoformat()}, size {duration.total_seconds()}s")
+
+    backfill_scheduler = scheduler.Scheduler(workers=workers, state=state, label=f"{record_type} ")
+    try:
+        backfill_scheduler.run(_ingest, scheduler.windows(start, end, duration))
+    finally:
+        if kwargs.get("parquet_sink"):
+            kwargs["parquet_sink"].close()
+
+    if seen is not None:
+        print(f"{record_type} backfill skipped {seen.skipped} duplicate records from overlapping windows")
+
+
+def incremental(record_type, **kwargs):
+    """
+    Run the ingestion flow from the provider's watermark for record_type, less safety_margin seconds, up to end_time (or now),
+    advancing the watermark after each successful load. Pages are requested with checked_paging, so a failure fetching
+    any page (the first included) raises before the watermark advances, and records are loaded (even with writer)
+    by the time ingest() returns.
+
+    Without a watermark, start from start_time, or duration seconds before the end.
+
+    For version >= 0.4.0, status_changes and trips are requested one complete hour at a time,
+    advancing the watermark after each hour. Vehicles are not queried by time, and have no watermark.
+    """
+    version = kwargs["version"]
+    provider = kwargs["client"].provider.provider_name
+    provider_id = kwargs["client"].provider.provider_id
+
+    # an empty result must mean no records, not a failed request
+    kwargs["checked_paging"] = True
+
+    if record_type == mds.VEHICLES:
+        print("vehicles are not queried by time, ingesting without a watermark")
+        return ingest(record_type, **kwargs)
+
+    margin = datetime.timedelta(seconds=kwargs.pop("safety_margin", None) or 0)
+    duration = kwargs.pop("duration", None)
+    end = watermarks.utc(kwargs.pop("end_time", None) or datetime.datetime.utcnow())
+    start = kwargs.pop("start_time", None)
+
+    engine = database.engine()
+    mark = watermarks.get(provider, record_type, engine)
+
+    if mark is not None:
+        start = mark["last_time"] - margin
+        print(f"{provider} {record_type} watermark at {mark['last_time'].isoformat()}, starting from {start.isoformat()}")
+    elif start is not None:
+        start = watermarks.utc(start)
+        print(f"No {provider} {record_type} watermark yet, starting from {start.isoformat()}")
+    elif duration:
+        start = end - datetime.timedelta(seconds=duration)
+        print(f"No {provider} {record_type} watermark yet, starting from {start.isoformat()}")
+    else:
+        raise ValueError(f"No {provider} {record_type} watermark yet, --start_time or --duration is required to start from.")
 
-    print(f"Beginning backfill: {start.isoformat()} to {end.isoformat()}, size {duration.total_seconds()}s")
+    if version >= common.VERSION_040 and record_type in [mds.STATUS_CHANGES, mds.TRIPS]:
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        total = 0
+        while hour + datetime.timedelta(hours=1) <= end:
+            total += ingest(record_type, **kwargs, end_time=hour)
+            watermarks.advance(provider, provider_id, record_type, hour, hour + datetime.timedelta(hours=1), engine)
+            hour = hour + datetime.timedelta(hours=1)
+        return total
 
-    while end >= start:
-        _start = end - duration
-        ingest(record_type, **kwargs, start_time=_start, end_time=end)
-        end = end - offset
+    if start >= end:
+        print(f"{provider} {record_type} is up to date")
+        return 0
 
-        if rate_limit:
-            time.sleep(rate_limit)
+    total = ingest(record_type, **kwargs, start_time=start, end_time=end)
+    watermarks.advance(provider, provider_id, record_type, start, end, engine)
+    return total
 
 
 def ingest(record_type, **kwargs):
@@ -236,45 +545,256 @@ def ingest(record_type, **kwargs):
     2. optionally validate data, filtering invalid records
     3. optionally write data to output files
     4. optionally load valid records into the database
+
+    With a batch_size, data is streamed through steps 2-4 batch_size pages at a time.
+    With prefetch, up to that many pages are fetched ahead on a background thread while a batch is processed.
+
+    With seen, a `dedupe.SeenRecords`, records already seen are skipped before step 2,
+    and records that completed the flow are added to it.
+
+    With a sampler, a `validation.Sampler`, or a validation_sample rate, only a sample of each page is validated.
+
+    With output_format="ndjson", output is appended to compressed NDJSON files partitioned by provider,
+    record type and day, through an `archive.NdjsonWriter` (ndjson, or a new one).
+
+    With parquet, a directory, valid records are also written to Parquet files partitioned by provider and day,
+    through an `archive.ParquetSink` (parquet_sink, or a new one closed at the end).
+
+    With writer, loading is done by a `writer.Writer` thread, coalescing batches into loads of writer_records records,
+    or every writer_seconds, so the flow doesn't wait on the database.
+
+    The time, records and bytes of each stage are recorded in the metrics, by provider and record type.
+
+    Returns the number of valid records.
     """
     version = mds.Version(kwargs.pop("version", common.DEFAULT_VERSION))
     version.raise_if_unsupported()
 
-    datasource = common.get_data(record_type, **kwargs, version=version)
+    client = kwargs.get("client")
+    provider = client.provider.provider_name if client else kwargs.get("provider", "source")
     data_key = mds.Schema(record_type).data_key
 
-    # validation and filtering
-    if not kwargs.pop("no_validate", False):
-        print(f"Validating {record_type} @ {version}")
+    batch_size = kwargs.pop("batch_size", None)
+    prefetcher = None
+    if batch_size:
+        print(f"Streaming {record_type} in batches of {batch_size} pages")
+        datasource = common.iter_data(record_type, **kwargs, version=version)
+        if kwargs.get("prefetch"):
+            print(f"Prefetching up to {kwargs['prefetch']} pages")
+            prefetcher = prefetch.Prefetcher(datasource, kwargs["prefetch"])
+            datasource = iter(prefetcher)
+        batches = profiling.iterate("fetch", common.batch(datasource, batch_size))
+    else:
+        with profiling.stage("fetch"), metrics.timed("fetch", provider, record_type) as m:
+            batches = [common.get_data(record_type, **kwargs, version=version)]
+            m["records"] = sum([len(d["data"][data_key]) for d in batches[0]])
+    validating = not kwargs.pop("no_validate", False)
+    output = kwargs.pop("output", None)
+    loading = not kwargs.pop("no_load", False)
+    seen_records = kwargs.pop("seen", None)
+
+    ndjson = kwargs.pop("ndjson", None)
+    if output and ndjson is None and kwargs.get("output_format") == "ndjson":
+        ndjson = archive.NdjsonWriter(output, provider, record_type, version, compression=kwargs.get("output_compression") or "gzip")
+
+    parquet = kwargs.pop("parquet_sink", None)
+    close_parquet = parquet is None and kwargs.get("parquet")
+    if close_parquet:
+        parquet = archive.ParquetSink(kwargs["parquet"], provider, record_type, version)
+
+    sampler = kwargs.pop("sampler", None)
+    if sampler is None and validating and kwargs.get("validation_sample"):
+        sampler = validation.Sampler(kwargs["validation_sample"], strata=kwargs.get("validation_strata"))
+
+    background = None
+    if loading and kwargs.get("writer"):
+        background = writer.Writer(
+            record_type,
+            provider,
+            max_records=kwargs.get("writer_records") or writer.WRITER_RECORDS,
+            max_seconds=kwargs.get("writer_seconds") or writer.WRITER_SECONDS,
+            queue_size=kwargs.get("writer_queue") or writer.WRITER_QUEUE,
+            **kwargs,
+            version=version
+        )
+
+    if not validating:
+        print("Skipping data validation")
 
-        valid, errors, removed = validation.validate(record_type, datasource, version=version)
+    seen, passed, failed, total = 0, 0, 0, 0
+    flow_error = None
+
+    try:
+        for datasource in batches:
+            # skip records already seen in this run
+            if seen_records is not None:
+                datasource, skipped = seen_records.filter(datasource)
+                if skipped > 0:
+                    print(f"Skipping {skipped} duplicate {record_type} already loaded in this run")
+
+            # validation and filtering
+            if validating:
+                print(f"Validating {record_type} @ {version}")
+
+                _seen = sum([len(d["data"][data_key]) for d in datasource])
+
+                with profiling.stage("validate"), metrics.timed("validate", provider, record_type) as m:
+                    valid, errors, removed = validation.validate(
+                        record_type,
+                        datasource,
+                        version=version,
+                        workers=kwargs.get("validation_workers"),
+                        chunk_size=kwargs.get("validation_chunk_size"),
+                        prevalidate=kwargs.get("prevalidate"),
+                        sampler=sampler
+                    )
+                    m["records"] = _seen
+
+                _passed = sum([len(v["data"][data_key]) for v in valid])
+                _failed = sum([len(r["data"][data_key]) for r in removed])
+
+                print(f"{_seen} records, {_passed} passed, {_failed} failed")
+
+                seen, passed, failed = seen + _seen, passed + _passed, failed + _failed
+            else:
+                valid = datasource
+                removed = None
+
+            _valid = sum([len(v["data"][data_key]) for v in valid])
+            total += _valid
+
+            # output to files if needed
+            if output:
+                with profiling.stage("dump"), metrics.timed("dump", provider, record_type) as m:
+                    if ndjson is not None:
+                        ndjson.write(valid)
+                        if removed:
+                            ndjson.write(removed, invalid=True)
+                    else:
+                        f = mds.DataFile(record_type, output)
+                        f.dump_payloads(valid)
+                        if removed:
+                            f.dump_payloads(removed)
+                    m["records"] = _valid + (_failed if removed else 0)
+
+            # archive valid records to Parquet if needed
+            if parquet is not None:
+                with profiling.stage("parquet"), metrics.timed("parquet", provider, record_type) as m:
+                    parquet.write(valid)
+                    m["records"] = _valid
+
+            # load to database, records are only seen once their load is committed
+            if loading and len(valid) > 0 and background is not None:
+                done = functools.partial(seen_records.add, valid) if seen_records is not None else None
+                background.put(valid, _valid, done=done)
+            else:
+                if loading and len(valid) > 0:
+                    writer.load(valid, record_type, provider, **kwargs, version=version)
+                else:
+                    print("Skipping data load")
+
+                if seen_records is not None:
+                    seen_records.add(valid)
+    except Exception as ex:
+        flow_error = ex
+        raise
+    finally:
+        try:
+            # load whatever the writer has waiting even if the flow failed, raising any error loading
+            if background is not None:
+                try:
+                    background.close()
+                except Exception as close_error:
+                    # don't replace the error that stopped the flow
+                    if flow_error is None:
+                        raise
+                    print(f"Loading the waiting {record_type} also failed: {type(close_error).__name__}: {close_error}")
+                finally:
+                    print(background.report())
+        finally:
+            # write the rows buffered for Parquet even if the flow failed
+            if close_parquet:
+                with profiling.stage("parquet"):
+                    parquet.close()
+
+    if prefetcher is not None:
+        print(prefetcher.report())
+        metrics.METRICS.gauge("mds_ingest_prefetch_overlap", round(prefetcher.overlap, 3), provider=provider, record_type=record_type)
+
+    if batch_size and validating:
+        print(f"{record_type} totals: {seen} records, {passed} passed, {failed} failed")
+
+    if sampler is not None:
+        print(f"Validated a sample of {sampler.sampled} of {sampler.records} {record_type} ({sampler.achieved_rate:.1%})",
+              "before escalating to full validation" if sampler.escalated else "")
 
-        seen = sum([len(d["data"][data_key]) for d in datasource])
-        passed = sum([len(v["data"][data_key]) for v in valid])
-        failed = sum([len(r["data"][data_key]) for r in removed])
+    print(f"{record_type} complete")
 
-        print(f"{seen} records, {passed} passed, {failed} failed")
-    else:
-        print("Skipping data validation")
-        valid = datasource
-        removed = None
+    return total
 
-    # output to files if needed
-    output = kwargs.pop("output", None)
-    if output:
-        f = mds.DataFile(record_type, output)
-        f.dump_payloads(valid)
-        if removed:
-            f.dump_payloads(removed)
 
-    # load to database
-    loading = not kwargs.pop("no_load", False)
-    if loading and len(valid) > 0:
-        database.load(valid, record_type, **kwargs, version=version)
+def print_pool_stats():
+    """
+    Print the database connection acquire latency for this run.
+    """
+    stats = database.pool_stats()
+    if stats:
+        print(f"Database connections: {stats['acquired']} acquired, {stats['avg_ms']}ms average, {stats['max_ms']}ms max")
+
+
+def write_metrics():
+    """
+    Print a summary of the per-stage metrics for this run, and write them to the Prometheus textfile if configured.
+    """
+    if not metrics.enabled():
+        return
+
+    stats = database.pool_stats()
+    if stats:
+        metrics.METRICS.gauge("mds_ingest_db_connections_acquired", stats["acquired"])
+        metrics.METRICS.gauge("mds_ingest_db_connection_acquire_avg_ms", stats["avg_ms"])
+        metrics.METRICS.gauge("mds_ingest_db_connection_acquire_max_ms", stats["max_ms"])
+
+    print("Stage metrics:")
+    for line in metrics.METRICS.summary():
+        print(f"  {line}")
+
+    metrics.METRICS.write()
+
+
+def run(flow, record_types, **kwargs):
+    """
+    Run the ingestion flow (e.g. ingest or backfill) for each of the record_types, printing per-type timings.
+
+    With parallel, the record types run concurrently on a thread pool.
+    Each thread gets its own API client, so paging and rate limits are independent per endpoint.
+    """
+    parallel = kwargs.pop("parallel", False)
+    timings = {}
+
+    def _run(record_type):
+        start = datetime.datetime.utcnow()
+        _kwargs = dict(kwargs)
+
+        # requests sessions are not thread-safe, use a dedicated client per record type
+        if parallel and "client" in kwargs:
+            _kwargs["client"] = mds.Client(kwargs["client"].provider, version=kwargs["version"])
+
+        flow(record_type, **_kwargs)
+        timings[record_type] = common.count_seconds(start)
+
+    if parallel and len(record_types) > 1:
+        print(f"Running {', '.join(record_types)} in parallel")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(record_types)) as executor:
+            futures = [executor.submit(_run, record_type) for record_type in record_types]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
     else:
-        print("Skipping data load")
+        for record_type in record_types:
+            _run(record_type)
 
-    print(f"{record_type} complete")
+    for record_type in record_types:
+        print(f"{record_type} finished in {timings[record_type]}s")
 
 
 if __name__ == "__main__":
@@ -293,62 +813,117 @@ if __name__ == "__main__":
 
     print(f"Starting ingestion run: {now.isoformat()}")
 
+    metrics.configure(jsonl=args.metrics, prometheus=args.metrics_prom)
+
+    if args.profile:
+        profiling.configure(args.profile)
+
     config = common.get_config(args.provider, args.config)
 
     # assert the version parameter
     args.version = mds.Version(config.pop("version", args.version))
     args.version.raise_if_unsupported()
 
+    # per-provider validation sampling
+    validation_sample = config.pop("validation_sample", args.validation_sample)
+    args.validation_sample = float(validation_sample) if validation_sample else None
+    args.validation_strata = config.pop("validation_strata", args.validation_strata) or None
+
+    # the polling schedule is only read by the daemon
+    config.pop("schedule", None)
+
     print(f"Referencing MDS @ {args.version}")
 
+    if args.incremental and (args.no_load or args.source):
+        print("--incremental tracks what was loaded from the API, it can't be used with --no_load or --source.")
+        print("Run main.py --help for more information.")
+        print("Exiting.")
+        print()
+        exit(1)
+
+    if args.skip_unchanged and args.load_engine != "copy":
+        print("--skip_unchanged requires --load_engine copy.")
+        print("Run main.py --help for more information.")
+        print("Exiting.")
+        print()
+        exit(1)
+
+    if args.prefetch and not args.batch_size:
+        print("--prefetch requires --batch_size.")
+        print("Run main.py --help for more information.")
+        print("Exiting.")
+        print()
+        exit(1)
+
+    record_types = [
+        record_type for record_type, requested in [
+            (mds.EVENTS, args.events),
+            (mds.STATUS_CHANGES, args.status_changes),
+            (mds.TRIPS, args.trips),
+            (mds.VEHICLES, args.vehicles)
+        ]
+        if requested
+    ]
+
+    # validators are created once, and shared by all record types and backfill windows in this run
+    if not args.no_validate:
+        with profiling.stage("warm"):
+            validation.warm_validators(args.version, record_types)
+
+    # one pooled database engine is shared by all loads in this run
+    if not args.no_load:
+        concurrency = (len(record_types) if args.parallel else 1) * args.backfill_workers
+        database.engine(pool_size=args.pool_size or concurrency, statement_timeout=args.statement_timeout)
+
     # shortcut for loading from files
     if args.source:
-        if args.events:
-            ingest(mds.EVENTS, **vars(args))
-        if args.status_changes:
-            ingest(mds.STATUS_CHANGES, **vars(args))
-        if args.trips:
-            ingest(mds.TRIPS, **vars(args))
-        if args.vehicles:
-            ingest(mds.VEHICLES, **vars(args))
+        run(ingest, record_types, **vars(args))
         # finished
+        print_pool_stats()
+        write_metrics()
+        profiling.report()
         print(f"Finished ingestion ({common.count_seconds(now)}s)")
         exit(0)
 
-    # assert the time range parameters
-    if args.version < common.VERSION_040:
-        if args.start_time is None and args.end_time is None:
-            print("One or both of --end_time or --start_time is required.")
-            print("Run main.py --help for more information.")
-            print("Exiting.")
-            print()
-            exit(1)
-        elif (args.start_time is None or args.end_time is None) and args.duration is None:
-            print("With only one of --end_time or --start_time, --duration is required.")
-            print("Run main.py --help for more information.")
-            print("Exiting.")
-            print()
-            exit(1)
-    else:
-        if args.events and (args.start_time is None or args.end_time is None) and args.duration is None:
-            print("Requesting events requires a time query range.")
-            print("With only one of --end_time or --start_time, --duration is required.")
-            print("Run main.py --help for more information.")
-            print("Exiting.")
-            print()
-            exit(1)
-        elif any([args.status_changes, args.trips]) and args.end_time is None:
-            print("Requesting status_changes or trips requires an --end_time.")
-            print("Run main.py --help for more information.")
-            print("Exiting.")
-            print()
-            exit(1)
+    # assert the time range parameters, with --incremental each record type's range starts from its watermark
+    if not args.incremental:
+        if args.version < common.VERSION_040:
+            if args.start_time is None and args.end_time is None:
+                print("One or both of --end_time or --start_time is required.")
+                print("Run main.py --help for more information.")
+                print("Exiting.")
+                print()
+                exit(1)
+            elif (args.start_time is None or args.end_time is None) and args.duration is None:
+                print("With only one of --end_time or --start_time, --duration is required.")
+                print("Run main.py --help for more information.")
+                print("Exiting.")
+                print()
+                exit(1)
+        else:
+            if args.events and (args.start_time is None or args.end_time is None) and args.duration is None:
+                print("Requesting events requires a time query range.")
+                print("With only one of --end_time or --start_time, --duration is required.")
+                print("Run main.py --help for more information.")
+                print("Exiting.")
+                print()
+                exit(1)
+            elif any([args.status_changes, args.trips]) and args.end_time is None:
+                print("Requesting status_changes or trips requires an --end_time.")
+                print("Run main.py --help for more information.")
+                print("Exiting.")
+                print()
+                exit(1)
 
     # backfill mode for version < 0.4.0 if all 3 time parameters given
-    backfill_mode = all([args.version < common.VERSION_040, args.start_time, args.end_time, args.duration])
+    backfill_mode = all([args.version < common.VERSION_040, args.start_time, args.end_time, args.duration]) and not args.incremental
 
     # parse into a valid range
-    args.start_time, args.end_time = common.parse_time_range(**vars(args))
+    if args.incremental:
+        args.start_time = common.parse_time_range(start_time=args.start_time, version=args.version)[0] if args.start_time else None
+        args.end_time = common.parse_time_range(end_time=args.end_time, version=args.version)[1] if args.end_time else None
+    else:
+        args.start_time, args.end_time = common.parse_time_range(**vars(args))
 
     # acquire the Provider instance
     if args.registry and pathlib.Path(args.registry).is_file():
@@ -366,18 +941,14 @@ if __name__ == "__main__":
     kwargs = dict(client=client, **vars(args))
 
     if backfill_mode:
-        if args.status_changes:
-            backfill(mds.STATUS_CHANGES, **kwargs)
-        if args.trips:
-            backfill(mds.TRIPS, **kwargs)
+        record_types = [r for r in record_types if r in [mds.STATUS_CHANGES, mds.TRIPS]]
+        run(backfill, record_types, **kwargs)
+    elif args.incremental:
+        run(incremental, record_types, **kwargs)
     else:
-        if args.events:
-            ingest(mds.EVENTS, **kwargs)
-        if args.status_changes:
-            ingest(mds.STATUS_CHANGES, **kwargs)
-        if args.trips:
-            ingest(mds.TRIPS, **kwargs)
-        if args.vehicles:
-            ingest(mds.VEHICLES, **kwargs)
+        run(ingest, record_types, **kwargs)
 
+    print_pool_stats()
+    write_metrics()
+    profiling.report()
     print(f"Finished ingestion ({common.count_seconds(now)}s)")
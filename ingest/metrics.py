@@ -0,0 +1,180 @@
+"""
+Collect per-stage timing and throughput metrics for ingestion runs, written as JSON lines and/or a Prometheus textfile.
+"""
+
+import contextlib
+import datetime
+import json
+import pathlib
+import threading
+import time
+
+
+def _label(value):
+    """
+    Escape a Prometheus label value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    """
+    Format [(name, value)] as Prometheus labels.
+    """
+    return ",".join([f'{k}="{_label(v)}"' for k, v in labels])
+
+
+class Metrics():
+    """
+    Per-stage metrics, broken down by provider and record type.
+    """
+
+    def __init__(self, jsonl=None, prometheus=None):
+        """
+        Initialize a new `Metrics` instance.
+
+        Optional keyword arguments:
+
+        :jsonl: Path to a file to append a JSON line to for every measurement, as it is recorded.
+
+        :prometheus: Path to a Prometheus textfile-collector file, (over)written with the totals by `write()`.
+        """
+        self.jsonl = pathlib.Path(jsonl) if jsonl else None
+        self.prometheus = pathlib.Path(prometheus) if prometheus else None
+        self.totals = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.jsonl is not None or self.prometheus is not None
+
+    def record(self, stage, provider, record_type, seconds, records=0, bytes=0):
+        """
+        Record a measurement of a stage.
+        """
+        key = (provider, record_type, stage)
+
+        with self.lock:
+            total = self.totals.setdefault(key, dict(count=0, seconds=0.0, records=0, bytes=0))
+            total["count"] += 1
+            total["seconds"] += seconds
+            total["records"] += records
+            total["bytes"] += bytes
+
+            if self.jsonl:
+                line = dict(
+                    time=datetime.datetime.utcnow().isoformat(),
+                    provider=provider,
+                    record_type=record_type,
+                    stage=stage,
+                    seconds=round(seconds, 6),
+                    records=records,
+                    bytes=bytes,
+                    records_per_second=round(records / seconds, 2) if seconds > 0 else None
+                )
+                with open(self.jsonl, "a") as f:
+                    f.write(json.dumps(line) + "\n")
+
+    def gauge(self, name, value, **labels):
+        """
+        Set a gauge, e.g. a queue depth, reported in the Prometheus file.
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextlib.contextmanager
+    def time(self, stage, provider, record_type):
+        """
+        Time the enclosed block as a stage. Yields a dict, to be updated with the records and bytes handled.
+        """
+        result = dict(records=0, bytes=0)
+        start = time.perf_counter()
+        yield result
+        self.record(stage, provider, record_type, time.perf_counter() - start, result["records"], result["bytes"])
+
+    def summary(self):
+        """
+        Get a list of lines summarizing the totals per provider, record type and stage.
+        """
+        lines = []
+        with self.lock:
+            for (provider, record_type, stage), total in sorted(self.totals.items()):
+                rate = total["records"] / total["seconds"] if total["seconds"] > 0 else 0
+                lines.append(
+                    f"{provider} {record_type} {stage}: {total['count']}x, {total['seconds']:.2f}s, "
+                    f"{total['records']} records ({rate:.0f}/s), {total['bytes']} bytes"
+                )
+        return lines
+
+    def write(self):
+        """
+        Write the totals to the Prometheus textfile, if configured.
+        """
+        if not self.prometheus:
+            return
+
+        series = [
+            ("mds_ingest_stage_runs_total", "counter", "Number of times the stage ran.", "count"),
+            ("mds_ingest_stage_seconds_total", "counter", "Seconds spent in the stage.", "seconds"),
+            ("mds_ingest_stage_records_total", "counter", "Records handled by the stage.", "records"),
+            ("mds_ingest_stage_bytes_total", "counter", "Bytes handled by the stage.", "bytes")
+        ]
+
+        lines = []
+        with self.lock:
+            for name, kind, help, field in series:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (provider, record_type, stage), total in sorted(self.totals.items()):
+                    labels = _labels([("provider", provider), ("record_type", record_type), ("stage", stage)])
+                    lines.append(f"{name}{{{labels}}} {total[field]}")
+
+            # one TYPE line per gauge, before all of its series
+            gauge = None
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name != gauge:
+                    lines.append(f"# TYPE {name} gauge")
+                    gauge = name
+                lines.append(f"{name}{{{_labels(labels)}}} {value}")
+
+        # write atomically, so the collector never reads a partial file
+        self.prometheus.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.prometheus.with_suffix(".tmp")
+        with open(temp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        temp.replace(self.prometheus)
+
+
+# the metrics for this process, see configure()
+METRICS = Metrics()
+
+
+def configure(jsonl=None, prometheus=None):
+    """
+    Set up the metrics for this process to be written to the given paths.
+    """
+    global METRICS
+    METRICS = Metrics(jsonl=jsonl, prometheus=prometheus)
+    return METRICS
+
+
+def enabled():
+    """
+    True if this process's metrics are written anywhere.
+    """
+    return METRICS.enabled
+
+
+def record(stage, provider, record_type, seconds, records=0, bytes=0):
+    """
+    Record a measurement of a stage in this process's metrics.
+    """
+    METRICS.record(stage, provider, record_type, seconds, records=records, bytes=bytes)
+
+
+def timed(stage, provider, record_type):
+    """
+    Time a block as a stage in this process's metrics, see `Metrics.time()`.
+    """
+    return METRICS.time(stage, provider, record_type)
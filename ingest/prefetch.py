@@ -0,0 +1,94 @@
+"""
+Fetch pages ahead of processing on a background thread, overlapping HTTP round-trips with validation and loading.
+"""
+
+import queue
+import threading
+import time
+
+
+_DONE = object()
+
+
+class Prefetcher():
+    """
+    Iterate over a stream of pages, getting up to depth pages ahead of the consumer on a background thread.
+
+    The bounded queue applies backpressure: once depth pages are waiting, fetching pauses until one is consumed.
+    """
+
+    def __init__(self, pages, depth):
+        """
+        Initialize a new `Prefetcher` instance, and start fetching.
+
+        Required positional arguments:
+
+        :pages: An iterable of pages, e.g. from `common.iter_data()`; it is consumed on the background thread.
+
+        :depth: The maximum number of pages fetched ahead of the consumer.
+        """
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stop = threading.Event()
+        self.pages = 0
+        self.fetch_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.thread = threading.Thread(target=self._fetch, args=(iter(pages),), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch(self, pages):
+        try:
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    break
+                self.fetch_seconds += time.perf_counter() - start
+                self._put((page, None))
+        except Exception as error:
+            self._put((None, error))
+            return
+
+        self._put((_DONE, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                page, error = self.queue.get()
+                self.wait_seconds += time.perf_counter() - start
+
+                if error is not None:
+                    raise error
+                if page is _DONE:
+                    return
+
+                self.pages += 1
+                yield page
+        finally:
+            # stop fetching if the consumer stops early
+            self.stop.set()
+
+    @property
+    def overlap(self):
+        """
+        The portion of the time spent fetching that was hidden behind the consumer's processing.
+        """
+        if self.fetch_seconds == 0:
+            return 0
+        return max(0.0, 1 - self.wait_seconds / self.fetch_seconds)
+
+    def report(self):
+        """
+        Get a line summarizing the pages prefetched and the overlap achieved.
+        """
+        return f"Prefetched {self.pages} pages: {self.fetch_seconds:.2f}s fetching, {self.wait_seconds:.2f}s waiting," \
+            f" {self.overlap:.0%} of fetching overlapped with processing"
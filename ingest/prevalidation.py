@@ -0,0 +1,229 @@
+"""
+Vectorized pre-validation of MDS payloads, to skip full JSON Schema validation of the records that are clean.
+
+Each check is derived from the record type's JSON Schema, and is never more lenient than it:
+a record passing the checks is valid under the full schema. Records that fail any check must go through
+full validation, as must whole pages that the checks can't reason about.
+"""
+
+import jsonschema
+import mds
+import pandas
+
+
+# keywords that don't constrain an instance
+_ANNOTATIONS = set(["$id", "$schema", "$comment", "title", "description", "examples", "default"])
+
+# keywords the columnar checks handle
+_COLUMNAR = set(["type", "enum", "const", "pattern", "minimum", "maximum"])
+
+# keywords the item-level checks handle
+_ITEM = set(["type", "properties", "required", "additionalProperties"])
+
+# python types for scalar JSON Schema types; bools are not numbers, and floats are not (certainly) integers
+_TYPES = {
+    "string": [str],
+    "number": [int, float],
+    "integer": [int],
+    "boolean": [bool],
+    "null": [type(None)]
+}
+
+_MISSING = object()
+
+
+class PageCheck():
+    """
+    Cheap, columnar checks over a page of records, derived from a record type's JSON Schema.
+    """
+
+    def __init__(self, record_type, version):
+        """
+        Initialize a new `PageCheck` for the record_type and version.
+
+        If the schema can't be broken down into columnar checks, the checks are disabled and every page fails them.
+        """
+        schema = mds.Schema(record_type, version).schema
+
+        self.data_key = mds.Schema(record_type).data_key
+        self.cls = jsonschema.validators.validator_for(schema)
+        self.resolver = jsonschema.RefResolver.from_schema(schema)
+        self.envelope = self.cls(schema, resolver=self.resolver)
+        self.enabled = True
+        self.pages = 0
+        self.passed = 0
+
+        try:
+            data = self._resolve(self._resolve(schema)["properties"]["data"])
+            items = self._resolve(self._resolve(data["properties"][self.data_key])["items"])
+        except (KeyError, TypeError):
+            self.enabled = False
+            return
+
+        self._setup(items)
+
+    def _resolve(self, subschema):
+        """
+        Follow any $ref from subschema.
+        """
+        while isinstance(subschema, dict) and "$ref" in subschema:
+            _, subschema = self.resolver.resolve(subschema["$ref"])
+        return subschema
+
+    def _sub_validator(self, subschema):
+        return self.cls(subschema, resolver=self.resolver, format_checker=jsonschema.FormatChecker())
+
+    def _setup(self, items):
+        """
+        Break the item schema down into item-level, columnar and per-value checks.
+        """
+        if not isinstance(items, dict) or items.get("type") not in (None, "object"):
+            self.enabled = False
+            return
+
+        properties = items.get("properties", {})
+        additional = items.get("additionalProperties", True)
+
+        if not isinstance(additional, bool) or "patternProperties" in items:
+            self.enabled = False
+            return
+
+        self.properties = set(properties.keys())
+        self.required = set(items.get("required", []))
+        self.additional = additional
+
+        # any other item-level keywords (e.g. oneOf), checked per record without the property constraints
+        residual = { k: v for k, v in items.items() if k not in _ITEM and k not in _ANNOTATIONS }
+        self.residual = self._sub_validator(residual) if residual else None
+
+        # columnar checks for simple properties, and sub-validators for the rest (e.g. GeoJSON)
+        self.columns, self.complex = {}, {}
+
+        for name, subschema in properties.items():
+            subschema = self._resolve(subschema)
+            column = self._columnar(subschema)
+
+            if column is None:
+                self.complex[name] = self._sub_validator(subschema)
+            else:
+                self.columns[name] = column
+
+    def _columnar(self, subschema):
+        """
+        Get the columnar check for a property subschema, or None if it can't be checked columnwise.
+        """
+        if not isinstance(subschema, dict):
+            return None
+
+        keywords = set(subschema.keys()) - _ANNOTATIONS
+        if not keywords <= _COLUMNAR:
+            return None
+
+        types = subschema.get("type", list(_TYPES.keys()))
+        types = [types] if isinstance(types, str) else types
+        if not all([t in _TYPES for t in types]):
+            return None
+
+        enum = subschema.get("enum")
+        if "const" in subschema:
+            enum = [subschema["const"]]
+        if enum is not None and not all([isinstance(e, str) for e in enum]):
+            return None
+
+        return dict(
+            types=[pt for t in types for pt in _TYPES[t]],
+            enum=enum,
+            pattern=subschema.get("pattern"),
+            minimum=subschema.get("minimum"),
+            maximum=subschema.get("maximum")
+        )
+
+    def _check_column(self, values, column):
+        """
+        Check a column of values in bulk.
+
+        Returns a boolean Series, True for the values failing the check.
+        """
+        present = values[values.map(lambda v: v is not _MISSING)]
+        failed = pandas.Series(False, index=values.index)
+        if len(present) == 0:
+            return failed
+
+        types = present.map(type)
+        bad = ~types.isin(column["types"])
+
+        if column["enum"] is not None:
+            typed = present[~bad]
+            bad[typed.index] |= ~typed.isin(column["enum"])
+
+        strings = present[(types == str) & ~bad]
+        if column["pattern"] is not None and len(strings) > 0:
+            bad[strings.index] |= ~strings.str.contains(column["pattern"], regex=True)
+
+        numbers = present[types.isin([int, float]) & ~bad]
+        if len(numbers) > 0:
+            numbers = pandas.to_numeric(numbers)
+            if column["minimum"] is not None:
+                bad[numbers.index] |= ~(numbers >= column["minimum"])
+            if column["maximum"] is not None:
+                bad[numbers.index] |= ~(numbers <= column["maximum"])
+
+        failed[bad.index] = bad
+        return failed
+
+    def flagged(self, source):
+        """
+        Check the records of a source payload.
+
+        Returns a sorted list of the indices of the records failing any check, which need full validation
+        (empty if the payload is certainly valid), or None if the whole payload needs full validation.
+        """
+        if not self.enabled:
+            return None
+
+        self.pages += 1
+        records = source.get("data", {}).get(self.data_key)
+
+        if not isinstance(records, list) or not all([isinstance(r, dict) for r in records]):
+            return None
+
+        # everything but the records
+        envelope = { **source, "data": { **source["data"], self.data_key: [] } }
+        if not self.envelope.is_valid(envelope):
+            return None
+
+        failed = set()
+
+        # item-level keys
+        for idx, record in enumerate(records):
+            if not self.required <= record.keys() or (not self.additional and not record.keys() <= self.properties):
+                failed.add(idx)
+
+        # simple properties, columnwise
+        for name, column in self.columns.items():
+            values = pandas.Series([r.get(name, _MISSING) for r in records], dtype=object)
+            mask = self._check_column(values, column)
+            failed.update(mask[mask].index)
+
+        # complex properties, valuewise
+        for name, validator in self.complex.items():
+            failed.update([
+                idx for idx, r in enumerate(records) if idx not in failed and name in r and not validator.is_valid(r[name])
+            ])
+
+        # other item-level constraints
+        if self.residual is not None:
+            failed.update([idx for idx, r in enumerate(records) if idx not in failed and not self.residual.is_valid(r)])
+
+        if len(failed) == 0:
+            self.passed += 1
+
+        return sorted(failed)
+
+    def check(self, source):
+        """
+        Check a source payload.
+
+        Returns True if the payload is certainly valid, False if it needs full validation.
+        """
+        return self.flagged(source) == []
@@ -0,0 +1,216 @@
+"""
+Schedule backfill windows concurrently, with progress reporting and resumable state,
+and the per-provider token buckets rate limiting their requests.
+"""
+
+import concurrent.futures
+import datetime
+import json
+import pathlib
+import threading
+import time
+
+
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+class TokenBucket():
+    """
+    A thread-safe token bucket rate limiter.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        Initialize a new `TokenBucket` instance.
+
+        Required positional arguments:
+
+        :rate: The number of tokens added to the bucket per second.
+
+        Optional keyword arguments:
+
+        :capacity: The maximum number of tokens the bucket holds, e.g. the size of a burst (default 1).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def bucket(provider, rate_limit):
+    """
+    Get the shared `TokenBucket` for a provider, allowing one request every rate_limit seconds.
+
+    Returns None if there is no rate_limit.
+    """
+    if not rate_limit:
+        return None
+
+    with _BUCKETS_LOCK:
+        if provider not in _BUCKETS:
+            _BUCKETS[provider] = TokenBucket(1.0 / rate_limit)
+        return _BUCKETS[provider]
+
+
+def windows(start, end, duration):
+    """
+    Generate (start, end) windows of size duration, stepping backwards from end to start.
+
+    Subsequent windows overlap the previous window by duration/2.
+    """
+    offset = duration / 2
+    end = end + offset
+
+    while end >= start:
+        yield end - duration, end
+        end = end - offset
+
+
+class WindowState():
+    """
+    The set of completed windows for a backfill, persisted to a JSON file so an interrupted backfill can resume.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize a new `WindowState`, loading any windows previously completed from path.
+
+        Without a path, the state is kept in memory only.
+        """
+        self.path = pathlib.Path(path) if path else None
+        self.completed = set()
+        self.lock = threading.Lock()
+
+        if self.path and self.path.exists():
+            with open(self.path, "r") as f:
+                self.completed = set(tuple(w) for w in json.load(f))
+
+    @staticmethod
+    def _key(window):
+        return tuple(w.isoformat() for w in window)
+
+    def __contains__(self, window):
+        return self._key(window) in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def complete(self, window):
+        """
+        Mark the window completed, persisting the state if needed.
+        """
+        with self.lock:
+            self.completed.add(self._key(window))
+
+            if self.path:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                temp = self.path.with_suffix(".tmp")
+                with open(temp, "w") as f:
+                    json.dump(sorted(self.completed), f, indent=2)
+                temp.replace(self.path)
+
+
+class Progress():
+    """
+    Track and print the progress, throughput and ETA of a backfill.
+    """
+
+    def __init__(self, total, label=""):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.records = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, window, records=0):
+        """
+        Record the completion of a window, printing a progress line.
+        """
+        with self.lock:
+            self.done += 1
+            self.records += records or 0
+
+            elapsed = time.monotonic() - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0
+            eta = datetime.timedelta(seconds=round((self.total - self.done) / rate)) if rate > 0 else "unknown"
+
+            print(f"{self.label}[{self.done}/{self.total}] {window[0].isoformat()} to {window[1].isoformat()} complete;",
+                  f"{rate * 60:.1f} windows/min, {self.records / elapsed if elapsed > 0 else 0:.1f} records/s, ETA {eta}")
+
+
+class Scheduler():
+    """
+    Run a function over backfill windows, keeping a number of windows in flight at once.
+    """
+
+    def __init__(self, workers=1, state=None, label=""):
+        """
+        Initialize a new `Scheduler` instance.
+
+        Optional keyword arguments:
+
+        :workers: The number of windows to process concurrently (default 1).
+
+        :state: A `WindowState` tracking completed windows; these are skipped.
+
+        :label: A prefix for progress messages.
+        """
+        self.workers = max(1, workers or 1)
+        self.state = state if state is not None else WindowState()
+        self.label = label
+
+    def run(self, func, windows):
+        """
+        Call func(start, end) exactly once for each window not already completed.
+
+        func should return the number of records processed, for throughput reporting.
+
+        Windows that raise are not marked completed, and are reported together once all other windows finish.
+        """
+        windows = list(windows)
+        pending = [w for w in windows if w not in self.state]
+
+        if len(pending) < len(windows):
+            print(f"{self.label}Resuming backfill, {len(windows) - len(pending)} of {len(windows)} windows already complete")
+
+        progress = Progress(len(pending), label=self.label)
+        failures = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(func, *w): w for w in pending}
+
+            for future in concurrent.futures.as_completed(futures):
+                window = futures[future]
+                try:
+                    records = future.result()
+                except Exception as ex:
+                    print(f"{self.label}{window[0].isoformat()} to {window[1].isoformat()} failed: {ex}")
+                    failures.append((window, ex))
+                    continue
+
+                self.state.complete(window)
+                progress.update(window, records)
+
+        if len(failures) > 0:
+            raise RuntimeError(f"{len(failures)} of {len(pending)} backfill windows failed; rerun to retry them.")
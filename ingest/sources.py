@@ -0,0 +1,191 @@
+"""
+Read MDS Provider payloads from files, parsing files in parallel and streaming payloads as they are parsed.
+
+Files larger than a threshold are parsed incrementally with ijson (if installed),
+yielding payloads of a bounded number of records (with the fields of the file's payload) instead of the whole file at once.
+So are NDJSON files written by `archive.NdjsonWriter`, whose payload-level columns are restored to the payloads.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import time
+
+import mds
+
+import archive
+import database
+import metrics
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# number of records per payload when parsing a file incrementally
+STREAM_RECORDS = 10000
+
+
+def _parse(path, data_key):
+    """
+    Parse a file in full, returning a tuple (payloads, seconds, bytes) with the payloads holding data_key records.
+    """
+    start = time.perf_counter()
+
+    with open(path) as f:
+        content = json.load(f)
+
+    payloads = content if isinstance(content, list) else [content]
+    payloads = [p for p in payloads if isinstance(p, dict) and data_key in (p.get("data") or {})]
+
+    return payloads, time.perf_counter() - start, os.path.getsize(path)
+
+
+def _envelope(path, keys=("version",)):
+    """
+    Get the fields of a single payload file other than its data, or None if the file isn't a single payload.
+
+    Parsing stops at the data once all of keys have been read, so the data isn't parsed twice when they come first
+    (as in most payloads). Otherwise it continues through the data, up to the next field after all of keys have been read;
+    fields after that point (e.g. links after the data) are left out.
+    """
+    envelope, key, builder, data = {}, None, None, False
+
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == "":
+                if event == "map_key":
+                    data = data or value == "data"
+                    if data and all([k in envelope for k in keys]):
+                        return envelope
+                    key, builder = value, ijson.ObjectBuilder()
+                    continue
+                if event == "start_map":
+                    continue
+                if event == "end_map":
+                    return envelope
+                return None
+
+            if key == "data":
+                continue
+
+            builder.event(event, value)
+            if prefix == key and event not in ("start_map", "start_array"):
+                envelope[key] = builder.value
+
+    return None
+
+
+def _json_records(path, data_key):
+    """
+    Parse the records of a single payload file incrementally.
+    """
+    with open(path, "rb") as f:
+        yield from ijson.items(f, f"data.{data_key}.item", use_float=True)
+
+
+def _ndjson_records(path):
+    """
+    Parse the records of an NDJSON file, one line at a time.
+    """
+    with archive.open_file(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _chunks(records, data_key, envelope, payload_columns=None):
+    """
+    Group a stream of records into payloads of (at most) STREAM_RECORDS records, with the fields of envelope.
+
+    The payload_columns of each record are moved back to its payload, starting a new payload when their values change.
+    """
+    chunk, fields = [], {}
+    payload_columns = payload_columns or []
+
+    for record in records:
+        _fields = { c: record.pop(c) for c in payload_columns if c in record }
+        if _fields != fields and len(chunk) > 0:
+            yield { **envelope, **fields, "data": { data_key: chunk } }
+            chunk = []
+        fields = _fields
+
+        chunk.append(record)
+        if len(chunk) >= STREAM_RECORDS:
+            yield { **envelope, **fields, "data": { data_key: chunk } }
+            chunk = []
+
+    if len(chunk) > 0:
+        yield { **envelope, **fields, "data": { data_key: chunk } }
+
+
+def read(record_type, files, workers=1, stream_size=None, provider="source"):
+    """
+    Generate the record_type payloads from files, in file order.
+
+    With workers > 1, up to 2 * workers files are parsed ahead in a pool of processes,
+    and the payloads of each file are yielded as soon as it (and the files before it) are parsed.
+
+    With stream_size (bytes), single payload files larger than this are parsed incrementally in this process,
+    if ijson is installed. NDJSON files are always parsed incrementally, skipping those of other record types.
+
+    The time, records and bytes to read each file are recorded in the metrics as the "read" stage.
+    """
+    data_key = mds.Schema(record_type).data_key
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = collections.deque()
+
+    if stream_size and ijson is None:
+        print("ijson is not installed, large files will be parsed in full")
+
+    def _results(payloads, seconds, size):
+        records = sum([len(p["data"][data_key]) for p in payloads])
+        metrics.record("read", provider, record_type, seconds, records, size)
+        return payloads
+
+    try:
+        for path in files:
+            chunks = None
+
+            if archive.is_ndjson(path):
+                info = archive.file_info(path)
+                if info["record_type"] not in (None, record_type):
+                    continue
+                payload_columns = database.PAYLOAD_COLUMNS.get(record_type, [])
+                chunks = _chunks(_ndjson_records(path), data_key, { "version": info["version"] }, payload_columns)
+            elif stream_size and ijson is not None and os.path.getsize(path) > stream_size:
+                envelope = _envelope(path, ["version", *database.PAYLOAD_COLUMNS.get(record_type, [])])
+                if envelope is not None and envelope.get("version") is not None:
+                    chunks = _chunks(_json_records(path, data_key), data_key, envelope)
+
+            if chunks is not None:
+                # keep file order, everything before this file comes first
+                while len(pending) > 0:
+                    yield from _results(*pending.popleft().result())
+
+                print(f"Streaming {record_type} from {path}")
+                seconds, records = 0.0, 0
+                while True:
+                    # only time the parsing, not the consumer
+                    start = time.perf_counter()
+                    payload = next(chunks, None)
+                    seconds += time.perf_counter() - start
+                    if payload is None:
+                        break
+                    records += len(payload["data"][data_key])
+                    yield payload
+                metrics.record("read", provider, record_type, seconds, records, os.path.getsize(path))
+            elif executor is not None:
+                pending.append(executor.submit(_parse, path, data_key))
+                if len(pending) >= 2 * workers:
+                    yield from _results(*pending.popleft().result())
+            else:
+                yield from _results(*_parse(path, data_key))
+
+        while len(pending) > 0:
+            yield from _results(*pending.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,33 @@
+"""
+Tests for archiving MDS records to files.
+"""
+
+import pytest
+
+pytest.importorskip("mds")
+pyarrow = pytest.importorskip("pyarrow")
+
+import pyarrow.parquet
+
+import archive
+
+
+def test_parquet_vehicles_payload_columns(tmp_path):
+    payload = {
+        "version": "0.4.1",
+        "last_updated": 1577836800000,
+        "ttl": 60000,
+        "data": { "vehicles": [{ "device_id": "a" }, { "device_id": "b" }] }
+    }
+
+    sink = archive.ParquetSink(tmp_path, "provider", "vehicles", "0.4.1")
+    sink.write([payload])
+    sink.close()
+
+    files = list(tmp_path.rglob("*.parquet"))
+    assert [f.parent.name for f in files] == ["date=2020-01-01"]
+
+    table = pyarrow.parquet.read_table(str(files[0])).to_pydict()
+    assert table["device_id"] == ["a", "b"]
+    assert table["ttl"] == [60000, 60000]
+    assert all([ts is not None for ts in table["last_updated"]])
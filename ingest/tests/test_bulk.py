@@ -0,0 +1,101 @@
+"""
+Tests for formatting records as COPY text for the copy load engine.
+"""
+
+import datetime
+
+import pytest
+
+mds = pytest.importorskip("mds")
+
+import bulk
+
+
+@pytest.fixture
+def decoder():
+    return mds.encoding.TimestampDecoder(version=mds.Version("0.3.2"))
+
+
+def _format(data_type, value, decoder):
+    return bulk._formatter(data_type, decoder)(value)
+
+
+def test_null(decoder):
+    for data_type in ["text", "bigint", "jsonb", "ARRAY", "timestamp with time zone"]:
+        assert _format(data_type, None, decoder) is None
+
+
+def test_timestamp(decoder):
+    assert _format("timestamp with time zone", 1577836800000, decoder) == "2020-01-01T00:00:00+00:00"
+    assert _format("timestamp with time zone", 1577836800123, decoder) == "2020-01-01T00:00:00.123000+00:00"
+
+
+def test_naive_timestamp_is_utc():
+    class Decoder():
+        def decode(self, value):
+            return datetime.datetime(2020, 1, 1, 12)
+
+    assert bulk._timestamp(1577880000000, Decoder()) == "2020-01-01T12:00:00+00:00"
+
+
+def test_geometry(decoder):
+    point = { "type": "Feature", "geometry": { "type": "Point", "coordinates": [-118.4, 34.0] }, "properties": {} }
+
+    assert _format("json", point, decoder) == '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [-118.4, 34.0]}, "properties": {}}'
+    assert _format("USER-DEFINED", point, decoder) == _format("json", point, decoder)
+
+
+def test_json(decoder):
+    assert _format("jsonb", { "a": [1, None, "b\"c"] }, decoder) == '{"a": [1, null, "b\\"c"]}'
+    assert _format("jsonb", "text", decoder) == '"text"'
+    assert _format("jsonb", 1, decoder) == "1"
+
+
+def test_array(decoder):
+    assert _format("ARRAY", ["a", "b"], decoder) == '{"a","b"}'
+    assert _format("ARRAY", "a", decoder) == '{"a"}'
+    assert _format("ARRAY", [], decoder) == "{}"
+    assert _format("ARRAY", ["a", None], decoder) == '{"a",NULL}'
+    assert _format("ARRAY", ['say "hi"', "back\\slash", "a,b"], decoder) == '{"say \\"hi\\"","back\\\\slash","a,b"}'
+
+
+def test_scalars(decoder):
+    assert _format("boolean", True, decoder) == "true"
+    assert _format("boolean", False, decoder) == "false"
+    assert _format("double precision", 1.5, decoder) == "1.5"
+    assert _format("uuid", "0e8f3a43-4e4a-4c6f-9fb4-4a1c7e4b2d6f", decoder) == "0e8f3a43-4e4a-4c6f-9fb4-4a1c7e4b2d6f"
+
+
+def test_csv_quoting():
+    row = [None, "\\N", "", 'a "quote"', "a,comma", "a\nnewline"]
+
+    text = bulk._csv(row)
+
+    # only the unquoted marker is NULL to COPY, a quoted "\N" or "" is text
+    assert text == '\\N,"\\N","","a ""quote""","a,comma","a\nnewline"\n'
+
+
+def test_copy_file_reads_in_bounded_chunks():
+    rows = [[str(i), "x" * 10] for i in range(1000)]
+    expected = "".join([f'"{i}","xxxxxxxxxx"\n' for i in range(1000)])
+
+    copy_file = bulk._CopyFile(iter(rows))
+    chunks = []
+    while True:
+        chunk = copy_file.read(100)
+        if chunk == "":
+            break
+        assert len(chunk) <= 100
+        assert len(copy_file.buffer.getvalue()) < 100 + 20
+        chunks.append(chunk)
+
+    assert "".join(chunks) == expected
+    assert copy_file.count == 1000
+
+
+def test_copy_file_reads_all():
+    copy_file = bulk._CopyFile([["a", "1"], ["b", None]])
+
+    assert copy_file.read() == '"a","1"\n"b",\\N\n'
+    assert copy_file.read() == ""
+    assert copy_file.count == 2
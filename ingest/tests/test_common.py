@@ -0,0 +1,138 @@
+"""
+Tests for requesting provider data.
+"""
+
+import datetime
+import types
+
+import pytest
+
+mds = pytest.importorskip("mds")
+pytest.importorskip("sqlalchemy")
+
+import common
+
+
+def _page(record_type, n, next_url=None, version="0.3.2"):
+    return { "version": version, "data": { record_type: [{ "page": n }] }, "links": { "next": next_url } if next_url else {} }
+
+
+def _response(status_code, page=None):
+    def _json():
+        if page is None:
+            raise ValueError("not JSON")
+        return page
+    return types.SimpleNamespace(status_code=status_code, json=_json, content=b"{}")
+
+
+class Client():
+    """
+    A stand-in for mds.Client, whose session serves the given responses in order.
+    """
+
+    def __init__(self, responses):
+        self.provider = types.SimpleNamespace(provider_name="provider", mds_api_url="https://provider.test/mds/")
+        self.responses = list(responses)
+        self.requests = []
+        self.gets = 0
+
+    def get(self, record_type, **kwargs):
+        self.gets += 1
+        return []
+
+    def _session(self, provider):
+        def _get(url, params=None):
+            self.requests.append((url, params))
+            return self.responses.pop(0)
+        return types.SimpleNamespace(get=_get)
+
+
+def test_iter_data_pages():
+    client = Client([_response(200, _page(mds.TRIPS, 0, "page1")), _response(200, _page(mds.TRIPS, 1))])
+
+    pages = list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")))
+
+    assert [p["data"][mds.TRIPS] for p in pages] == [[{ "page": 0 }], [{ "page": 1 }]]
+    assert [url for url, _ in client.requests] == ["https://provider.test/mds/trips", "page1"]
+
+
+def test_iter_data_raises_on_failed_page():
+    client = Client([_response(200, _page(mds.TRIPS, 0, "page1")), _response(500)])
+
+    with pytest.raises(RuntimeError):
+        list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")))
+
+
+def test_iter_data_raises_on_failed_first_page():
+    client = Client([_response(503)])
+
+    with pytest.raises(RuntimeError):
+        list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")))
+
+
+def test_iter_data_raises_on_body_not_json():
+    client = Client([_response(200, _page(mds.TRIPS, 0, "page1")), _response(200)])
+
+    with pytest.raises(RuntimeError):
+        list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")))
+
+
+def test_iter_data_raises_on_unexpected_version():
+    client = Client([_response(200, _page(mds.TRIPS, 0, version="0.2.0"))])
+
+    with pytest.raises(mds.versions.UnexpectedVersionError):
+        list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")))
+
+
+def test_get_data_uses_the_client():
+    client = Client([])
+
+    assert common.get_data(mds.TRIPS, client=client, version=mds.Version("0.3.2")) == []
+    assert client.gets == 1 and client.requests == []
+
+
+def test_get_data_checked_paging_raises_on_failed_page():
+    client = Client([_response(503)])
+
+    with pytest.raises(RuntimeError):
+        common.get_data(mds.TRIPS, client=client, version=mds.Version("0.3.2"), checked_paging=True)
+
+
+def test_params():
+    hour = datetime.datetime(2019, 1, 1, 5, tzinfo=datetime.timezone.utc)
+
+    assert common._params(mds.TRIPS, mds.Version("0.4.0"), dict(end_time=hour)) == { "end_time": "2019-01-01T05" }
+    assert common._params(mds.EVENTS, mds.Version("0.4.0"), dict(start_time=hour, end_time=None)) == { "start_time": 1546318800000 }
+    assert common._params(mds.STATUS_CHANGES, mds.Version("0.3.2"), dict(end_time=hour.replace(tzinfo=None))) == { "end_time": 1546318800000 }
+
+
+def test_incremental_failed_first_page_keeps_watermark(monkeypatch):
+    import main
+    import watermarks
+
+    advanced = []
+    monkeypatch.setattr(main.database, "engine", lambda **kwargs: None)
+    monkeypatch.setattr(watermarks, "get", lambda provider, record_type, engine: None)
+    monkeypatch.setattr(watermarks, "advance", lambda *args: advanced.append(args))
+
+    client = Client([_response(503)])
+    client.provider.provider_id = "00000000-0000-4000-8000-000000000000"
+    end = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+    with pytest.raises(RuntimeError):
+        main.incremental(mds.STATUS_CHANGES, client=client, version=mds.Version("0.3.2"), end_time=end, duration=3600,
+                         no_validate=True, no_load=True)
+
+    assert advanced == []
+    assert client.gets == 0
+
+
+def test_request_pages_acquires_limiter_per_page():
+    client = Client([_response(200, _page(mds.TRIPS, 0, "page1")), _response(200, _page(mds.TRIPS, 1))])
+    acquired = []
+    limiter = types.SimpleNamespace(acquire=lambda: acquired.append(len(client.requests)))
+
+    pages = list(common.iter_data(mds.TRIPS, client=client, version=mds.Version("0.3.2"), rate_limit=60, rate_limiter=limiter))
+
+    assert len(pages) == 2
+    assert acquired == [0, 1]
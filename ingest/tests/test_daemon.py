@@ -0,0 +1,128 @@
+"""
+Tests for the polling schedule of the daemon.
+"""
+
+import datetime
+import types
+
+import pytest
+
+mds = pytest.importorskip("mds")
+pytest.importorskip("sqlalchemy")
+
+import daemon
+
+
+UTC = datetime.timezone.utc
+
+
+def _source(version):
+    return dict(
+        provider=types.SimpleNamespace(provider_name="provider", provider_id="id"),
+        version=mds.Version(version),
+        intervals={ mds.STATUS_CHANGES: 3600 },
+        lookback=None,
+        limiter=None,
+        rate_limit=None,
+        validation_sample=None,
+        validation_strata=None,
+        polled={}
+    )
+
+
+def _poll(monkeypatch, source, now, fail=(), **kwargs):
+    requested = []
+
+    def _ingest(record_type, **kwargs):
+        if kwargs["end_time"] in fail:
+            raise RuntimeError("poll failed")
+        requested.append((kwargs["start_time"], kwargs["end_time"]))
+        return 0
+
+    class _datetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(daemon.main, "ingest", _ingest)
+    monkeypatch.setattr(daemon.mds, "Client", lambda *args, **kwargs: None, raising=False)
+    monkeypatch.setattr(daemon.datetime, "datetime", _datetime)
+
+    try:
+        daemon.poll(source, mds.STATUS_CHANGES, **kwargs)
+    except RuntimeError:
+        pass
+
+    return requested
+
+
+def test_hours():
+    start = datetime.datetime(2020, 1, 1, 10, 30, tzinfo=UTC)
+    now = datetime.datetime(2020, 1, 1, 13, 5, tzinfo=UTC)
+
+    assert daemon.hours(start, now) == [datetime.datetime(2020, 1, 1, h, tzinfo=UTC) for h in (10, 11, 12)]
+
+
+def test_hourly_polls_catch_up(monkeypatch):
+    source = _source("0.4.0")
+    hour = lambda h: datetime.datetime(2020, 1, 1, h, tzinfo=UTC)
+
+    # the first poll requests the last complete hour
+    assert _poll(monkeypatch, source, hour(10).replace(minute=5)) == [(None, hour(9))]
+
+    # a poll failing on its second hour resumes from there
+    assert _poll(monkeypatch, source, hour(12).replace(minute=5), fail=[hour(11)]) == [(None, hour(10))]
+
+    # a late poll requests every hour missed
+    assert _poll(monkeypatch, source, hour(14).replace(minute=5)) == [(None, hour(h)) for h in (11, 12, 13)]
+
+
+def test_time_range_polls_catch_up(monkeypatch):
+    source = _source("0.3.2")
+    start = datetime.datetime(2020, 1, 1, 10, tzinfo=UTC)
+    later = lambda seconds: start + datetime.timedelta(seconds=seconds)
+
+    assert _poll(monkeypatch, source, start) == [(later(-3600), start)]
+
+    # a failed poll's range is requested by the next
+    _poll(monkeypatch, source, later(3600), fail=[later(3600)])
+    assert _poll(monkeypatch, source, later(7200)) == [(start, later(7200))]
+
+
+@pytest.mark.parametrize("version", ["0.3.2", "0.4.0"])
+def test_polls_resume_from_watermark(monkeypatch, version):
+    source = _source(version)
+    hour = lambda h: datetime.datetime(2020, 1, 1, h, tzinfo=UTC)
+    marks = { ("provider", mds.STATUS_CHANGES): hour(6) }
+
+    def _advance(provider, provider_id, record_type, start_time, end_time, engine):
+        marks[(provider, record_type)] = end_time
+
+    monkeypatch.setattr(daemon.database, "engine", lambda: "engine")
+    monkeypatch.setattr(daemon.watermarks, "get", lambda provider, record_type, engine: { "last_time": marks[(provider, record_type)] })
+    monkeypatch.setattr(daemon.watermarks, "advance", _advance)
+
+    now = hour(9).replace(minute=5)
+
+    # after a restart, the first poll requests from the watermark, not the lookback, advancing it up to a failure
+    requested = _poll(monkeypatch, source, now, fail=[hour(8)], watermarks=True)
+
+    if version == "0.4.0":
+        assert requested == [(None, hour(6)), (None, hour(7))]
+        assert marks[("provider", mds.STATUS_CHANGES)] == hour(8)
+    else:
+        assert requested == [(hour(6), now)]
+        assert marks[("provider", mds.STATUS_CHANGES)] == now
+
+
+def test_polls_without_watermarks_kept_in_memory(monkeypatch):
+    source = _source("0.4.0")
+    hour = lambda h: datetime.datetime(2020, 1, 1, h, tzinfo=UTC)
+
+    def _engine():
+        raise AssertionError("The database was used without --watermarks")
+
+    monkeypatch.setattr(daemon.database, "engine", _engine)
+
+    assert _poll(monkeypatch, source, hour(10).replace(minute=5)) == [(None, hour(9))]
+    assert source["polled"] == { mds.STATUS_CHANGES: hour(10) }
@@ -0,0 +1,58 @@
+"""
+Tests for suppressing records seen more than once during a run.
+"""
+
+import datetime
+
+import pytest
+
+mds = pytest.importorskip("mds")
+pytest.importorskip("sortedcontainers")
+pytest.importorskip("sqlalchemy")
+
+import dedupe
+
+
+START = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _record(hour, device="d"):
+    event_time = int((START + datetime.timedelta(hours=hour)).timestamp() * 1000)
+    return { "provider_id": "p", "device_id": device, "event_time": event_time, "event_type": "available", "event_type_reason": "x" }
+
+
+def _payload(records):
+    return { "version": "0.3.2", "data": { mds.STATUS_CHANGES: records } }
+
+
+def test_filter_skips_seen():
+    seen = dedupe.SeenRecords(mds.STATUS_CHANGES, mds.Version("0.3.2"))
+    seen.add([_payload([_record(0), _record(1)])])
+
+    payloads, skipped = seen.filter([_payload([_record(1), _record(2)]), _payload([_record(0)])])
+
+    assert skipped == 2
+    assert payloads == [_payload([_record(2)])]
+    assert seen.skipped == 2
+
+
+def test_evict_outside_horizon():
+    seen = dedupe.SeenRecords(mds.STATUS_CHANGES, mds.Version("0.3.2"), horizon=datetime.timedelta(hours=1))
+    seen.add([_payload([_record(h) for h in range(10)])])
+
+    seen.evict(START + datetime.timedelta(hours=4), START + datetime.timedelta(hours=6))
+
+    assert len(seen) == 5
+    payloads, skipped = seen.filter([_payload([_record(h) for h in range(10)])])
+    assert skipped == 5
+    assert [r["event_time"] for r in payloads[0]["data"][mds.STATUS_CHANGES]] == \
+        [_record(h)["event_time"] for h in [0, 1, 2, 8, 9]]
+
+
+def test_evict_without_horizon():
+    seen = dedupe.SeenRecords(mds.STATUS_CHANGES, mds.Version("0.3.2"))
+    seen.add([_payload([_record(h) for h in range(10)])])
+
+    seen.evict(START, START)
+
+    assert len(seen) == 10
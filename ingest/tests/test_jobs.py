@@ -0,0 +1,171 @@
+"""
+Tests for the database-independent logic of the job queue workers.
+"""
+
+import contextlib
+import datetime
+import json
+import threading
+import types
+
+import pytest
+
+mds = pytest.importorskip("mds")
+pytest.importorskip("sqlalchemy")
+
+import jobs
+import test_common
+
+
+UTC = datetime.timezone.utc
+
+
+class Engine():
+    """
+    A stand-in for a SQLAlchemy engine, recording the statements executed and returning the given rows.
+    """
+
+    def __init__(self, rows=None):
+        self.executed = []
+        self.rows = rows or {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, statement, **params):
+        with self.lock:
+            self.executed.append((str(statement), params))
+        rows = self.rows.get(str(statement), [])
+        return types.SimpleNamespace(fetchall=lambda: rows, fetchone=lambda: rows[0] if rows else None)
+
+    def statements(self, sql):
+        return [params for statement, params in self.executed if statement == sql]
+
+
+def _args(**kwargs):
+    args = dict(
+        batch_size=None, config=None, drain=True, heartbeat=30, load_engine="upsert", no_validate=True, output=None,
+        poll=0, prevalidate=False, registry=None, retry_delay=60, skip_existing=False, stale=300,
+        validation_chunk_size=None, validation_workers=None, version=mds.Version("0.3.2")
+    )
+    args.update(kwargs)
+    return types.SimpleNamespace(**args)
+
+
+def _worker(monkeypatch, engine, **kwargs):
+    monkeypatch.setattr(jobs.database, "engine", lambda **kw: engine)
+    worker = jobs.Worker(_args(**kwargs), name="worker")
+    provider = types.SimpleNamespace(provider_name="provider", mds_api_url="https://provider.test")
+    monkeypatch.setattr(worker, "_provider", lambda name: (provider, mds.Version("0.3.2")))
+    return worker
+
+
+def _job(attempts=1, max_attempts=3):
+    return dict(
+        job_id=1,
+        provider="provider",
+        record_type=mds.STATUS_CHANGES,
+        start_time=datetime.datetime(2019, 1, 1, tzinfo=UTC),
+        end_time=datetime.datetime(2019, 1, 1, 6, tzinfo=UTC),
+        attempts=attempts,
+        max_attempts=max_attempts
+    )
+
+
+def test_windows():
+    start, end = datetime.datetime(2019, 1, 1, 0, 30, tzinfo=UTC), datetime.datetime(2019, 1, 1, 3, tzinfo=UTC)
+    hour = datetime.timedelta(hours=1)
+
+    hourly = list(jobs.windows(mds.TRIPS, mds.Version("0.4.0"), start, end, hour))
+    assert [s.hour for s, _ in hourly] == [0, 1, 2]
+    assert all([e - s == hour for s, e in hourly])
+
+    events = list(jobs.windows(mds.EVENTS, mds.Version("0.4.0"), start, end, hour))
+    assert events[0] == (start, start + hour) and events[-1][1] == end
+
+
+def test_claim_expires_stale_jobs_first(monkeypatch):
+    job = _job()
+    engine = Engine({ jobs._EXPIRE: [(7,)], jobs._CLAIM: [job] })
+    worker = _worker(monkeypatch, engine)
+
+    assert worker.claim() == job
+    assert [statement for statement, _ in engine.executed] == [jobs._EXPIRE, jobs._CLAIM]
+    assert engine.statements(jobs._CLAIM) == [dict(worker="worker", stale=300)]
+
+
+def test_claim_none_ready(monkeypatch):
+    worker = _worker(monkeypatch, Engine())
+
+    assert worker.claim() is None
+
+
+def test_run_job_done(monkeypatch):
+    engine = Engine()
+    worker = _worker(monkeypatch, engine)
+    requested = []
+    monkeypatch.setattr(jobs.mds, "Client", lambda provider, version: None, raising=False)
+    monkeypatch.setattr(jobs.main, "ingest", lambda record_type, **kwargs: requested.append(kwargs) or 5)
+
+    assert worker.run_job(_job())
+    assert engine.statements(jobs._DONE) == [dict(job_id=1, worker="worker", records=5)]
+    assert engine.statements(jobs._FAILED) == []
+    assert requested[0]["checked_paging"]
+
+
+def test_run_job_failed_first_page_retries(monkeypatch):
+    engine = Engine()
+    worker = _worker(monkeypatch, engine)
+    client = test_common.Client([test_common._response(503)])
+    monkeypatch.setattr(jobs.mds, "Client", lambda provider, version: client, raising=False)
+
+    assert not worker.run_job(_job())
+    assert engine.statements(jobs._DONE) == []
+
+    [failed] = engine.statements(jobs._FAILED)
+    assert failed["delay"] == 60 and failed["error"].startswith("RuntimeError")
+
+
+def test_run_job_heartbeats(monkeypatch):
+    engine = Engine()
+    worker = _worker(monkeypatch, engine, heartbeat=0.01)
+    beats = threading.Event()
+
+    def _ingest(record_type, **kwargs):
+        beats.wait(5)
+        return 0
+
+    def _execute(statement, **params):
+        if str(statement) == jobs._HEARTBEAT:
+            beats.set()
+        return Engine.execute(engine, statement, **params)
+
+    monkeypatch.setattr(engine, "execute", _execute)
+    monkeypatch.setattr(jobs.mds, "Client", lambda provider, version: None, raising=False)
+    monkeypatch.setattr(jobs.main, "ingest", _ingest)
+
+    assert worker.run_job(_job())
+    assert engine.statements(jobs._HEARTBEAT)[0] == dict(job_id=1, worker="worker")
+
+
+def test_run_drains(monkeypatch):
+    engine = Engine({ jobs._CLAIM: [_job()] })
+    worker = _worker(monkeypatch, engine)
+    claims = iter([_job(), None])
+    ran = []
+    monkeypatch.setattr(worker, "claim", lambda: next(claims))
+    monkeypatch.setattr(worker, "run_job", ran.append)
+
+    worker.run()
+
+    assert ran == [_job()]
+
+
+def test_versions(monkeypatch, tmp_path):
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({ "a": { "version": "0.4.0" }, "b": {} }))
+    monkeypatch.setattr(jobs.common, "get_config", lambda name, path: json.loads(config.read_text())[name])
+
+    assert jobs.versions(_args(config=str(config))) == { "0.3.2", "0.4.0" }
@@ -0,0 +1,86 @@
+"""
+Tests for the ingestion flow.
+"""
+
+import pytest
+
+mds = pytest.importorskip("mds")
+pytest.importorskip("sqlalchemy")
+
+import main
+
+
+def _page(n):
+    return { "version": "0.3.2", "data": { mds.TRIPS: [{ "trip_id": f"t{n}" }] } }
+
+
+def _failing_pages(record_type, **kwargs):
+    yield _page(0)
+    raise RuntimeError("fetch failed")
+
+
+class ParquetSink():
+    """
+    A stand-in for archive.ParquetSink, recording what was written and whether it was closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.written = []
+        self.closed = False
+        SINKS.append(self)
+
+    def write(self, payloads):
+        self.written.extend(payloads)
+
+    def close(self):
+        self.closed = True
+
+
+SINKS = []
+
+
+def test_parquet_closed_when_flow_fails(monkeypatch):
+    SINKS.clear()
+    monkeypatch.setattr(main.common, "iter_data", _failing_pages)
+    monkeypatch.setattr(main.archive, "ParquetSink", ParquetSink)
+
+    with pytest.raises(RuntimeError):
+        main.ingest(mds.TRIPS, batch_size=1, parquet="parquet", no_validate=True, no_load=True, provider="source")
+
+    [sink] = SINKS
+    assert sink.written == [_page(0)]
+    assert sink.closed
+
+
+class Writer():
+    """
+    A stand-in for writer.Writer, whose close() raises a load error.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+
+    def put(self, payloads, records, done=None):
+        self.batches.append(payloads)
+
+    def close(self):
+        raise ValueError("load failed")
+
+    def report(self):
+        return "Writer: report"
+
+
+def test_writer_error_keeps_flow_error(monkeypatch):
+    monkeypatch.setattr(main.common, "iter_data", _failing_pages)
+    monkeypatch.setattr(main.writer, "Writer", Writer)
+
+    with pytest.raises(RuntimeError, match="fetch failed"):
+        main.ingest(mds.TRIPS, batch_size=1, writer=True, no_validate=True, provider="source")
+
+
+def test_writer_error_raised(monkeypatch):
+    monkeypatch.setattr(main.common, "iter_data", lambda record_type, **kwargs: iter([_page(0)]))
+    monkeypatch.setattr(main.writer, "Writer", Writer)
+
+    with pytest.raises(ValueError, match="load failed"):
+        main.ingest(mds.TRIPS, batch_size=1, writer=True, no_validate=True, provider="source")
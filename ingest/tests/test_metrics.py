@@ -0,0 +1,123 @@
+"""
+Tests for the per-stage metrics, written as JSON lines and a Prometheus textfile.
+"""
+
+import json
+import pathlib
+
+import metrics
+
+
+def test_jsonl_records(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    m = metrics.Metrics(jsonl=path)
+
+    m.record("validate", "provider", "trips", 0.5, records=100, bytes=2048)
+    m.record("load", "provider", "trips", 0.0)
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+
+    assert len(lines) == 2
+    assert set(lines[0].keys()) == set(["time", "provider", "record_type", "stage", "seconds", "records", "bytes", "records_per_second"])
+    assert { k: v for k, v in lines[0].items() if k != "time" } == dict(
+        provider="provider", record_type="trips", stage="validate", seconds=0.5, records=100, bytes=2048, records_per_second=200.0
+    )
+    assert lines[1]["stage"] == "load" and lines[1]["records_per_second"] is None
+
+
+def test_totals(tmp_path):
+    m = metrics.Metrics(prometheus=tmp_path / "metrics.prom")
+
+    m.record("validate", "provider", "trips", 1.0, records=10)
+    m.record("validate", "provider", "trips", 2.0, records=20, bytes=5)
+
+    assert m.totals[("provider", "trips", "validate")] == dict(count=2, seconds=3.0, records=30, bytes=5)
+    assert m.summary() == ["provider trips validate: 2x, 3.00s, 30 records (10/s), 5 bytes"]
+
+
+def test_prometheus_textfile(tmp_path):
+    path = tmp_path / "textfile" / "metrics.prom"
+    m = metrics.Metrics(prometheus=path)
+
+    m.record("load", "provider", "trips", 1.5, records=10, bytes=100)
+    m.write()
+
+    lines = path.read_text().splitlines()
+
+    assert "# TYPE mds_ingest_stage_seconds_total counter" in lines
+    assert 'mds_ingest_stage_runs_total{provider="provider",record_type="trips",stage="load"} 1' in lines
+    assert 'mds_ingest_stage_seconds_total{provider="provider",record_type="trips",stage="load"} 1.5' in lines
+    assert 'mds_ingest_stage_records_total{provider="provider",record_type="trips",stage="load"} 10' in lines
+    assert 'mds_ingest_stage_bytes_total{provider="provider",record_type="trips",stage="load"} 100' in lines
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_prometheus_textfile_replaced_atomically(tmp_path, monkeypatch):
+    path = tmp_path / "metrics.prom"
+    path.write_text("previous\n")
+    m = metrics.Metrics(prometheus=path)
+    m.record("load", "provider", "trips", 1.0)
+
+    replace, seen = pathlib.Path.replace, []
+
+    def _replace(self, target):
+        # the complete file is written before it replaces the previous one
+        seen.append((pathlib.Path(target).read_text(), self.read_text()))
+        return replace(self, target)
+
+    monkeypatch.setattr(pathlib.Path, "replace", _replace)
+
+    m.write()
+
+    assert len(seen) == 1
+    assert seen[0][0] == "previous\n"
+    assert seen[0][1] == path.read_text()
+    assert path.read_text().endswith("\n")
+
+
+def test_prometheus_label_escaping(tmp_path):
+    path = tmp_path / "metrics.prom"
+    m = metrics.Metrics(prometheus=path)
+
+    m.record("load", 'Scoot "Co"\\ Ltd\nInc', "trips", 1.0)
+    m.gauge("mds_ingest_daemon_last_success", 1, provider='a"b')
+    m.write()
+
+    lines = path.read_text().splitlines()
+
+    assert 'mds_ingest_stage_runs_total{provider="Scoot \\"Co\\"\\\\ Ltd\\nInc",record_type="trips",stage="load"} 1' in lines
+    assert 'mds_ingest_daemon_last_success{provider="a\\"b"} 1' in lines
+
+
+def test_gauges_overwritten(tmp_path):
+    path = tmp_path / "metrics.prom"
+    m = metrics.Metrics(prometheus=path)
+
+    m.gauge("mds_ingest_writer_queue", 5, provider="a", record_type="trips")
+    m.gauge("mds_ingest_writer_queue", 2, record_type="trips", provider="a")
+    m.gauge("mds_ingest_writer_queue", 7, provider="b", record_type="trips")
+    m.write()
+
+    lines = [l for l in path.read_text().splitlines() if "mds_ingest_writer_queue" in l]
+
+    # the last value of each set of labels (in any order), under a single TYPE line
+    assert lines == [
+        "# TYPE mds_ingest_writer_queue gauge",
+        'mds_ingest_writer_queue{provider="a",record_type="trips"} 2',
+        'mds_ingest_writer_queue{provider="b",record_type="trips"} 7'
+    ]
+
+    m.gauge("mds_ingest_writer_queue", 0, provider="a", record_type="trips")
+    m.write()
+
+    assert 'mds_ingest_writer_queue{provider="a",record_type="trips"} 0' in path.read_text().splitlines()
+
+
+def test_disabled(tmp_path):
+    m = metrics.Metrics()
+
+    m.record("load", "provider", "trips", 1.0)
+    m.write()
+
+    assert not m.enabled
+    assert list(tmp_path.iterdir()) == []
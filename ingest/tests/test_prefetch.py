@@ -0,0 +1,70 @@
+"""
+Tests for prefetching pages, against the benchmarks' local mock provider server.
+"""
+
+import pathlib
+import sys
+import types
+
+import pytest
+
+mds = pytest.importorskip("mds")
+requests = pytest.importorskip("requests")
+pytest.importorskip("sqlalchemy")
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.parent / "bench"))
+
+import common
+import mock_provider
+import prefetch
+
+
+VERSION = mds.Version("0.3.2")
+
+
+class Client():
+    """
+    A stand-in for mds.Client, with an unauthenticated session to the mock server.
+    """
+
+    def __init__(self, url):
+        self.provider = types.SimpleNamespace(provider_name="mock", mds_api_url=url)
+
+    def _session(self, provider):
+        return requests.Session()
+
+
+@pytest.fixture
+def server(request):
+    fail_page = getattr(request, "param", None)
+    server = mock_provider.serve([{ "i": i } for i in range(25)], VERSION, 4, 0.01, fail_page=fail_page)
+    yield server
+    server.shutdown()
+
+
+def _pages(server, depth):
+    pages = common.iter_data(mds.STATUS_CHANGES, client=Client(server.url), version=VERSION)
+    if depth > 0:
+        return prefetch.Prefetcher(pages, depth)
+    return pages
+
+
+@pytest.mark.parametrize("depth", [1, 3])
+def test_prefetched_pages_match_serial(server, depth):
+    serial = list(_pages(server, 0))
+    prefetcher = _pages(server, depth)
+
+    assert list(prefetcher) == serial
+    assert [r["i"] for p in serial for r in p["data"][mds.STATUS_CHANGES]] == list(range(25))
+    assert prefetcher.pages == 7
+
+
+@pytest.mark.parametrize("server", [3], indirect=True)
+def test_prefetched_page_error_raised(server):
+    received = []
+
+    with pytest.raises(RuntimeError, match="status 500"):
+        for page in _pages(server, 2):
+            received.append(page)
+
+    assert len(received) == 3
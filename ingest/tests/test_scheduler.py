@@ -0,0 +1,94 @@
+"""
+Tests for scheduling backfill windows: rate limiting, window splitting and resumable state.
+"""
+
+import datetime
+import threading
+import time
+
+import scheduler
+
+
+UTC = datetime.timezone.utc
+
+
+def test_token_bucket_rate():
+    bucket = scheduler.TokenBucket(20)
+
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+
+    # the first token is in the bucket, the other four take 1/20s each
+    assert 0.18 <= elapsed < 1
+
+
+def test_token_bucket_shared_across_threads():
+    bucket = scheduler.TokenBucket(50)
+    times = []
+
+    def _acquire():
+        for _ in range(5):
+            bucket.acquire()
+            times.append(time.monotonic())
+
+    threads = [threading.Thread(target=_acquire) for _ in range(4)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 20 tokens at 50/s, the first free: no faster with 4 threads than with one
+    assert max(times) - start >= 19 / 50 - 0.02
+
+
+def test_bucket_per_provider():
+    assert scheduler.bucket("a", None) is None
+    assert scheduler.bucket("a", 2) is scheduler.bucket("a", 2)
+    assert scheduler.bucket("a", 2) is not scheduler.bucket("b", 2)
+
+
+def test_windows():
+    start = datetime.datetime(2019, 1, 1, tzinfo=UTC)
+    end = start + datetime.timedelta(hours=12)
+    duration = datetime.timedelta(hours=6)
+
+    windows = list(scheduler.windows(start, end, duration))
+
+    assert windows[0] == (end - datetime.timedelta(hours=3), end + datetime.timedelta(hours=3))
+    assert windows[-1][0] <= start - datetime.timedelta(hours=3)
+    assert all([e - s == duration for s, e in windows])
+    # each window overlaps the previous one by half
+    assert all([a[0] - b[0] == duration / 2 for a, b in zip(windows, windows[1:])])
+
+
+def test_window_state_resumes(tmp_path):
+    path = tmp_path / "state" / "provider_trips.json"
+    start = datetime.datetime(2019, 1, 1, tzinfo=UTC)
+    windows = list(scheduler.windows(start, start + datetime.timedelta(hours=6), datetime.timedelta(hours=2)))
+    fail = windows[2]
+    ran = []
+
+    def _func(_start, _end):
+        if (_start, _end) == fail:
+            raise RuntimeError("interrupted")
+        ran.append((_start, _end))
+        return 1
+
+    try:
+        scheduler.Scheduler(state=scheduler.WindowState(path)).run(_func, windows)
+        assert False, "the failed window should raise"
+    except RuntimeError:
+        pass
+
+    state = scheduler.WindowState(path)
+    assert len(state) == len(windows) - 1
+    assert fail not in state
+
+    fail, ran = None, []
+    scheduler.Scheduler(state=state, workers=2).run(_func, windows)
+
+    assert ran == [windows[2]]
+    assert len(scheduler.WindowState(path)) == len(windows)
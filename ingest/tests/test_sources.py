@@ -0,0 +1,108 @@
+"""
+Tests for reading MDS payloads from files.
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip("ijson")
+pytest.importorskip("mds")
+
+import archive
+import sources
+
+
+def _write(path, records, **payload):
+    with open(path, "w") as f:
+        json.dump({ **payload, "data": { "status_changes": records } }, f)
+
+
+def test_envelope(tmp_path):
+    path = tmp_path / "vehicles.json"
+    links = { "next": "https://provider/vehicles?page=2" }
+    _write(path, [{ "device_id": "a" }], version="0.4.1", last_updated=1577836800000, ttl=60000, links=links)
+
+    assert sources._envelope(path) == { "version": "0.4.1", "last_updated": 1577836800000, "ttl": 60000, "links": links }
+
+
+def test_envelope_after_data(tmp_path):
+    path = tmp_path / "status_changes.json"
+    with open(path, "w") as f:
+        f.write('{ "data": { "status_changes": [] }, "version": "0.3.2" }')
+
+    assert sources._envelope(path) == { "version": "0.3.2" }
+
+
+def test_envelope_stops_at_data(tmp_path):
+    path = tmp_path / "status_changes.json"
+    with open(path, "w") as f:
+        f.write('{ "version": "0.3.2", "links": {}, "data": { "status_changes": [ not parsed')
+
+    assert sources._envelope(path) == { "version": "0.3.2", "links": {} }
+
+
+def test_envelope_stops_after_keys(tmp_path):
+    path = tmp_path / "vehicles.json"
+    with open(path, "w") as f:
+        f.write('{ "version": "0.4.1", "data": { "vehicles": [] }, "last_updated": 1, "ttl": 60, "links": not parsed')
+
+    assert sources._envelope(path, ["version", "last_updated", "ttl"]) == { "version": "0.4.1", "last_updated": 1, "ttl": 60 }
+
+
+def test_envelope_of_list(tmp_path):
+    path = tmp_path / "status_changes.json"
+    with open(path, "w") as f:
+        json.dump([{ "version": "0.3.2", "data": { "status_changes": [] } }], f)
+
+    assert sources._envelope(path) is None
+
+
+def test_chunks_restore_payload_columns():
+    records = [
+        { "device_id": "a", "last_updated": 1, "ttl": 60 },
+        { "device_id": "b", "last_updated": 1, "ttl": 60 },
+        { "device_id": "c", "last_updated": 2, "ttl": 60 }
+    ]
+
+    payloads = list(sources._chunks(records, "vehicles", { "version": "0.4.1" }, ["last_updated", "ttl"]))
+
+    assert payloads == [
+        { "version": "0.4.1", "last_updated": 1, "ttl": 60, "data": { "vehicles": [{ "device_id": "a" }, { "device_id": "b" }] } },
+        { "version": "0.4.1", "last_updated": 2, "ttl": 60, "data": { "vehicles": [{ "device_id": "c" }] } }
+    ]
+
+
+def test_large_file_streamed_in_chunks(tmp_path, monkeypatch):
+    path = tmp_path / "status_changes.json"
+    records = [{ "device_id": str(i), "event_time": i } for i in range(25)]
+    _write(path, records, version="0.3.2", links={})
+
+    def _parse(path, data_key):
+        raise AssertionError("The file was parsed in full")
+
+    monkeypatch.setattr(sources, "STREAM_RECORDS", 10)
+    monkeypatch.setattr(sources, "_parse", _parse)
+
+    payloads = list(sources.read("status_changes", [str(path)], stream_size=1))
+
+    assert [len(p["data"]["status_changes"]) for p in payloads] == [10, 10, 5]
+    assert all([p["version"] == "0.3.2" and p["links"] == {} for p in payloads])
+    assert [r for p in payloads for r in p["data"]["status_changes"]] == records
+
+
+def test_ndjson_vehicles_round_trip(tmp_path):
+    payload = {
+        "version": "0.4.1",
+        "last_updated": 1577836800000,
+        "ttl": 60000,
+        "data": { "vehicles": [{ "device_id": "a" }, { "device_id": "b" }] }
+    }
+
+    writer = archive.NdjsonWriter(tmp_path, "provider", "vehicles", "0.4.1")
+    writer.write([payload])
+
+    files = list(tmp_path.rglob("*.ndjson.gz"))
+    assert [f.parent.name for f in files] == ["date=2020-01-01"]
+
+    assert list(sources.read("vehicles", files)) == [payload]
@@ -0,0 +1,303 @@
+"""
+Tests for the validation of MDS payloads, and the classification of errors against recorded error fixtures.
+"""
+
+import copy
+import json
+import os
+import pathlib
+import re
+import types
+
+import pytest
+
+jsonschema = pytest.importorskip("jsonschema")
+pytest.importorskip("mds")
+
+import prevalidation
+import validation
+
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures" / "errors"
+
+# payloads validated against the published schemas of each version by mds-provider
+SCHEMAS = pathlib.Path(__file__).parent / "fixtures" / "schemas"
+
+
+def _schema(data_key, items):
+    """
+    A payload schema, with records of data_key matching items.
+    """
+    return {
+        "type": "object",
+        "required": ["version", "data"],
+        "properties": {
+            "version": { "type": "string" },
+            "data": {
+                "type": "object",
+                "properties": { data_key: { "type": "array", "items": items } }
+            }
+        }
+    }
+
+
+class SchemaValidator():
+    """
+    A stand-in for mds.DataValidator, validating payloads against a small schema.
+    """
+
+    def __init__(self, data_key, items):
+        schema = _schema(data_key, items)
+        self.data_key = data_key
+        self.validator = jsonschema.validators.validator_for(schema)(schema)
+
+    def validate(self, source):
+        yield from self.validator.iter_errors(source)
+
+
+def _fixture(path):
+    """
+    Read a fixture, and the schema and payload it describes.
+    """
+    with open(path) as f:
+        fixture = json.load(f)
+
+    schema = _schema(fixture["data_key"], fixture["items"])
+    payload = { "version": fixture.get("version", "0.3.2"), "data": { fixture["data_key"]: fixture["records"] } }
+
+    return fixture, schema, payload
+
+
+@pytest.mark.parametrize("path", sorted(FIXTURES.glob("*.json")), ids=lambda p: p.stem)
+def test_failure(path):
+    fixture, schema, payload = _fixture(path)
+    errors = list(jsonschema.validators.validator_for(schema)(schema).iter_errors(payload))
+
+    assert len(errors) == 1
+
+    failure, idx = validation._failure(errors[0])
+    expected = fixture["expected"]
+
+    assert failure == expected["failure"]
+    assert idx == expected["index"]
+    assert payload["data"][fixture["data_key"]] == expected["records"]
+
+
+# the classification by regular expressions over error.describe() that _failure replaced
+_LEGACY_FILTER = [re.compile(r"Item error")]
+_LEGACY_KEEP = [
+    re.compile(r"Item error in status_changes\[\d+\]\s+\{(?!.*'associated_trip').+\} is not valid under any of the given schemas"),
+    re.compile(r"valid under each of \{'required': \['associated_trip'\]\}")
+]
+_LEGACY_UNEXPECTED = re.compile(r"\('(\w+)' was unexpected\)")
+
+
+def _legacy_failure(error):
+    description = os.linesep.join(error.describe())
+
+    unexpected_prop = _LEGACY_UNEXPECTED.search(description)
+    if unexpected_prop:
+        del error.instance[unexpected_prop.group(1)]
+        return False, None
+
+    if any([ex.search(description) for ex in _LEGACY_KEEP]):
+        return False, None
+
+    if any([ex.search(description) for ex in _LEGACY_FILTER]):
+        return False, [i for i in error.path if isinstance(i, int)][0]
+
+    return True, None
+
+
+def _schema_cases():
+    for path in sorted(SCHEMAS.glob("*.json")):
+        with open(path) as f:
+            fixture = json.load(f)
+        for name, case in fixture["cases"].items():
+            yield pytest.param(fixture["record_type"], fixture["version"], case, id=f"{path.stem}-{name}")
+
+
+@pytest.mark.parametrize("record_type, version, case", list(_schema_cases()))
+def test_failure_matches_legacy_on_published_schemas(record_type, version, case):
+    if not hasattr(validation.mds, "DataValidator"):
+        pytest.skip("requires mds-provider and the published MDS schemas")
+
+    payload = case.get("payload") or { "version": version, "data": { record_type: case["records"] } }
+    validator = validation._validator(record_type, validation.mds.Version(version))
+
+    def _classify(failure):
+        source = copy.deepcopy(payload)
+        errors = list(validator.validate(source))
+        return [failure(error) for error in errors], source
+
+    assert _classify(validation._failure) == _classify(_legacy_failure)
+
+
+def test_patterns_compiled_once():
+    assert validation._pattern("^x_") is validation._pattern("^x_")
+
+
+def _validate_serially(monkeypatch, validator):
+    """
+    Run the parallel path's chunks in this process, with validator.
+    """
+    monkeypatch.setattr(validation, "_pool", lambda workers: types.SimpleNamespace(map=map))
+    monkeypatch.setattr(validation, "_validate_chunk", lambda args: validation._validate_source(validator, args[2]))
+
+
+def test_parallel_offsets_record_errors(monkeypatch):
+    validator = SchemaValidator("trips", { "type": "object", "properties": { "trip_duration": { "type": "integer" } } })
+    _validate_serially(monkeypatch, validator)
+
+    records = [{ "trip_duration": 1 }, { "trip_duration": 2 }, { "trip_duration": 3 }, { "trip_duration": "x" }]
+    sources = [{ "version": "0.3.2", "data": { "trips": records } }]
+
+    [(valid, invalid, errors, invalid_source)] = validation._validate_parallel("trips", sources, "0.3.2", "trips", 2, 2)
+
+    assert valid == records[:3]
+    assert invalid == records[3:]
+    assert [list(e.path) for e in errors] == [["data", "trips", 3, "trip_duration"]]
+    assert not invalid_source
+
+
+def test_parallel_reports_payload_errors_once(monkeypatch):
+    validator = SchemaValidator("trips", { "type": "object" })
+    _validate_serially(monkeypatch, validator)
+
+    records = [{ "trip_duration": i } for i in range(5)]
+    sources = [{ "version": 3, "data": { "trips": records } }]
+
+    [(_, _, errors, invalid_source)] = validation._validate_parallel("trips", sources, "0.3.2", "trips", 2, 2)
+
+    assert [list(e.path) for e in errors] == [["version"]]
+    assert invalid_source
+
+
+def test_parallel_rejects_validator():
+    sources = [{ "version": "0.3.2", "data": { "trips": [] } }]
+    validator = SchemaValidator("trips", { "type": "object" })
+
+    with pytest.raises(ValueError):
+        validation.validate("trips", sources, validation.mds.Version("0.3.2"), validator=validator, workers=2)
+
+
+TRIP = {
+    "type": "object",
+    "required": ["trip_id", "trip_duration"],
+    "properties": {
+        "trip_id": { "type": "string", "pattern": "^t" },
+        "trip_duration": { "type": "integer", "minimum": 0 },
+        "mode": { "enum": ["a", "b"] },
+        "route": { "type": "object", "required": ["type"] }
+    },
+    "additionalProperties": False
+}
+
+
+class Schema():
+    """
+    A stand-in for mds.Schema, with trips records matching TRIP.
+    """
+
+    def __init__(self, record_type, version=None):
+        self.data_key = record_type
+        self.schema = _schema(record_type, TRIP)
+
+
+def test_prevalidate_matches_full_validation(monkeypatch):
+    monkeypatch.setattr(prevalidation.mds, "Schema", Schema)
+    check = prevalidation.PageCheck("trips", "0.3.2")
+    monkeypatch.setattr(validation, "_page_check", lambda record_type, ref: check)
+
+    def trip(i, **kwargs):
+        return { "trip_id": f"t{i}", "trip_duration": i, "mode": "a", "route": { "type": "x" }, **kwargs }
+
+    pages = [
+        [trip(i) for i in range(5)],
+        [trip(0), trip(1), trip(2, trip_duration=-1), trip(3), trip(4, extra=1), { "trip_duration": 5 }, trip(6, mode="c")],
+        [trip(0), "not a record", trip(2, trip_duration="x")],
+        [trip(0, route={}), trip(1), trip(2, trip_id="x2")]
+    ]
+    payloads = [{ "version": "0.3.2", "data": { "trips": records } } for records in pages]
+    version = validation.mds.Version("0.3.2")
+    validator = SchemaValidator("trips", TRIP)
+
+    full = validation.validate("trips", copy.deepcopy(payloads), version, validator=validator)
+    fast = validation.validate("trips", copy.deepcopy(payloads), version, validator=validator, prevalidate=True)
+
+    assert fast[0] == full[0]
+    assert [(list(e.path), e.message) for e in fast[1]] == [(list(e.path), e.message) for e in full[1]]
+    assert fast[2] == full[2]
+    assert (check.pages, check.passed) == (4, 1)
+
+
+def test_sampler_rate():
+    sampler = validation.Sampler(0.25, seed=1)
+    records = [{ "i": i } for i in range(10)]
+
+    chosen = sampler.choose(records)
+
+    assert len(chosen) == 3 and chosen == sorted(set(chosen))
+    assert validation.Sampler(0.25, seed=1).choose(records) == chosen
+    assert sampler.choose([]) == []
+    assert (sampler.records, sampler.sampled) == (10, 3)
+
+
+def test_sampler_strata():
+    sampler = validation.Sampler(0.1, strata="vehicle_type", seed=1)
+    records = [{ "vehicle_type": "scooter" } for _ in range(20)] + [{ "vehicle_type": "bicycle" }, {}]
+
+    chosen = sampler.choose(records)
+
+    # each stratum is sampled at the rate, with at least one record
+    assert len([idx for idx in chosen if idx < 20]) == 2
+    assert 20 in chosen and 21 in chosen
+
+
+def _sampled(monkeypatch, pages, workers=None):
+    """
+    Validate pages of trips with a sampler of every other record, checking every record with workers,
+    in this process as a pool would (on copies of the payloads).
+    """
+    validator = SchemaValidator("trips", TRIP)
+    monkeypatch.setattr(validation, "_validator", lambda record_type, version: validator)
+    monkeypatch.setattr(validation, "_pool", lambda workers: types.SimpleNamespace(map=map))
+    monkeypatch.setattr(validation, "_validate_chunk", lambda args: validation._validate_source(validator, copy.deepcopy(args[2])))
+
+    sampler = validation.Sampler(0.5)
+    monkeypatch.setattr(sampler, "_choose", lambda indices: indices[::2])
+
+    payloads = [{ "version": "0.3.2", "data": { "trips": records } } for records in pages]
+    result = validation.validate("trips", payloads, validation.mds.Version("0.3.2"), sampler=sampler, workers=workers)
+
+    return sampler, result
+
+
+def _trip(i, **kwargs):
+    return { "trip_id": f"t{i}", "trip_duration": i, **kwargs }
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_sampling_strips_unexpected_properties_without_escalating(monkeypatch, workers):
+    sampler, (valid, errors, removed) = _sampled(monkeypatch, [[_trip(0, extra=1), _trip(1, extra=1)]], workers=workers)
+
+    assert not sampler.escalated
+    assert valid[0]["data"]["trips"] == [_trip(0), _trip(1, extra=1)]
+    assert len(errors) == 1
+    assert removed == []
+
+
+def test_sampling_escalates_on_failed_record(monkeypatch):
+    sampler, (valid, errors, removed) = _sampled(monkeypatch, [[_trip(0, trip_duration=-1), _trip(1), _trip(2)]])
+
+    assert sampler.escalated
+    assert valid[0]["data"]["trips"] == [_trip(1), _trip(2)]
+    assert removed[0]["data"]["trips"] == [_trip(0, trip_duration=-1)]
+
+
+def test_sampling_assumes_unsampled_records_valid(monkeypatch):
+    sampler, (valid, errors, removed) = _sampled(monkeypatch, [[_trip(0), _trip(1, trip_duration=-1)]])
+
+    assert not sampler.escalated
+    assert valid[0]["data"]["trips"] == [_trip(0), _trip(1, trip_duration=-1)]
+    assert errors == [] and removed == []
@@ -0,0 +1,52 @@
+"""
+Tests for loading on a background writer thread.
+"""
+
+import threading
+
+import pytest
+
+pytest.importorskip("mds")
+pytest.importorskip("sqlalchemy")
+
+import writer
+
+
+def test_done_after_commit(monkeypatch):
+    loaded, committed, events = threading.Event(), threading.Event(), []
+
+    def _load(payloads, record_type, provider, **kwargs):
+        loaded.set()
+        committed.wait(5)
+        events.append(("load", len(payloads)))
+
+    monkeypatch.setattr(writer, "load", _load)
+
+    background = writer.Writer("trips", "provider", max_records=2)
+    background.put([{}], 1, done=lambda: events.append("first"))
+    background.put([{}], 1, done=lambda: events.append("second"))
+
+    assert loaded.wait(5)
+    assert events == []
+
+    committed.set()
+    background.close()
+
+    assert events == [("load", 2), "first", "second"]
+
+
+def test_not_done_after_failed_load(monkeypatch):
+    events = []
+
+    def _load(payloads, record_type, provider, **kwargs):
+        raise RuntimeError("load failed")
+
+    monkeypatch.setattr(writer, "load", _load)
+
+    background = writer.Writer("trips", "provider")
+    background.put([{}], 1, done=lambda: events.append("done"))
+
+    with pytest.raises(RuntimeError):
+        background.close()
+
+    assert events == []
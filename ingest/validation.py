@@ -2,29 +2,95 @@
 Validate MDS provider data against the published JSON schemas.
 """
 
+import concurrent.futures
 import datetime
-import os
+import functools
+import math
 import pathlib
+import random
 import re
+import threading
 
 import mds
 
 import common
+import prevalidation
+import profiling
 
 
-_FILTER_EXCEPTIONS = [
-    re.compile("Item error")
-]
+@functools.lru_cache(maxsize=None)
+def _pattern(pattern):
+    """
+    The compiled regex of a patternProperties pattern, compiled once per pattern.
+    """
+    return re.compile(pattern)
+
+
+def _unexpected_property(error):
+    """
+    The single unexpected property of an additionalProperties error's instance, or None.
+    """
+    if not isinstance(error.instance, dict) or not isinstance(error.schema, dict):
+        return None
 
-_KEEP_EXCEPTIONS = [
-    re.compile("Item error in status_changes\[\d+\]\s+\{(?!.*'associated_trip').+\} is not valid under any of the given schemas"),
-    re.compile("valid under each of \{'required': \['associated_trip'\]\}")
-]
+    properties = error.schema.get("properties", {})
+    patterns = [_pattern(p) for p in error.schema.get("patternProperties", {})]
+    extras = [p for p in error.instance if p not in properties and not any([r.search(p) for r in patterns])]
 
-_UNEXPECTED_PROP = re.compile("\('(\w+)' was unexpected\)")
+    return extras[0] if len(extras) == 1 else None
 
 
-def _validator(record_type, ref):
+def _missing_associated_trip(error):
+    """
+    A status_changes item matched none of the given schemas, and has no associated_trip.
+    """
+    path = list(error.path)
+    return all([
+        len(error.context) > 0,
+        len(path) >= 2 and path[-2] == mds.STATUS_CHANGES and isinstance(path[-1], int),
+        isinstance(error.instance, dict) and "associated_trip" not in error.instance
+    ])
+
+
+def _ambiguous_associated_trip(error):
+    """
+    An item matched more than one of the given schemas, one of which only requires associated_trip.
+    """
+    return all([
+        len(error.context) == 0,
+        isinstance(error.validator_value, list) and { "required": ["associated_trip"] } in error.validator_value
+    ])
+
+
+# errors for records that should be kept, by validator keyword
+_KEEP_RULES = {
+    "anyOf": [_missing_associated_trip],
+    "oneOf": [_missing_associated_trip, _ambiguous_associated_trip]
+}
+
+
+def _original(error):
+    """
+    The jsonschema ValidationError underlying an error.
+    """
+    return getattr(error, "original_error", error)
+
+
+# DataValidator instances by (record_type, version), shared by the whole process
+_VALIDATORS = {}
+_VALIDATORS_LOCK = threading.Lock()
+
+# prevalidation.PageCheck instances by (record_type, version)
+_CHECKS = {}
+
+# process pools for parallel validation, by number of workers
+_POOLS = {}
+
+# locks by id() of each shared validator and page check, whose schema ref resolution is not thread-safe
+_LOCKS = {}
+
+
+def _new_validator(record_type, ref):
     """
     Create a DataValidator instance.
     """
@@ -40,33 +106,106 @@ def _validator(record_type, ref):
         raise ValueError(f"Invalid record_type: {record_type}")
 
 
+def _validator(record_type, ref):
+    """
+    Get the cached DataValidator instance for the record_type and version, creating it on first use.
+    """
+    key = (record_type, str(ref))
+
+    with _VALIDATORS_LOCK:
+        if key not in _VALIDATORS:
+            _VALIDATORS[key] = _new_validator(record_type, ref)
+        return _VALIDATORS[key]
+
+
+def _page_check(record_type, ref):
+    """
+    Get the cached PageCheck instance for the record_type and version, creating it on first use.
+    """
+    key = (record_type, str(ref))
+
+    with _VALIDATORS_LOCK:
+        if key not in _CHECKS:
+            _CHECKS[key] = prevalidation.PageCheck(record_type, ref)
+        return _CHECKS[key]
+
+
+def _lock(instance):
+    """
+    Get the lock serializing use of a shared validator or page check, creating it on first use.
+    """
+    with _VALIDATORS_LOCK:
+        return _LOCKS.setdefault(id(instance), threading.Lock())
+
+
+def warm_validators(version, record_types=None):
+    """
+    Create and cache the DataValidator instances for version up front, so later validation doesn't pay for them.
+
+    By default, warms all of the record types supported by version.
+    """
+    version = mds.Version(version)
+
+    if record_types is None:
+        record_types = [mds.STATUS_CHANGES, mds.TRIPS]
+        if version >= common.VERSION_040:
+            record_types.append(mds.EVENTS)
+        if version >= mds.Version._041_():
+            record_types.append(mds.VEHICLES)
+
+    for record_type in record_types:
+        _validator(record_type, version)
+
+
 def _failure(error):
     """
     Determine if the error is a real schema validation error that should cause a validation failure.
+
+    Errors are classified by their validator keyword, path and schema:
+
+    - a single unexpected property is removed from the instance, and the error ignored;
+      only for the error itself, never for errors within the branches of a oneOf/anyOf
+    - some errors for status_changes with(out) associated_trip are ignored, keeping the record
+    - any other error within a data item causes that item to be removed
+    - everything else is a failure
     """
-    # describing an error returns a list of messages, so join with a linesep
-    description = os.linesep.join(error.describe())
+    original = _original(error)
 
     # check for and remove unexpected data
-    unexpected_prop = _UNEXPECTED_PROP.search(description)
-    if unexpected_prop:
-        prop = unexpected_prop.group(1)
-        del error.instance[prop]
-        return False, None
+    if original.validator == "additionalProperties":
+        prop = _unexpected_property(original)
+        if prop is not None:
+            del original.instance[prop]
+            return False, None
 
     # check for exceptions for records that should be kept
-    if any([ex.search(description) for ex in _KEEP_EXCEPTIONS]):
+    if any([rule(original) for rule in _KEEP_RULES.get(original.validator, [])]):
         return False, None
 
-    # check for exceptions for records that should be removed
-    if any([ex.search(description) for ex in _FILTER_EXCEPTIONS]):
-        idx = list(filter(lambda i: isinstance(i, int), error.path))[0]
-        return False, idx
+    # check for errors within a data item, that should be removed
+    idx = [i for i in error.path if isinstance(i, int)]
+    if len(idx) > 0:
+        return False, idx[0]
 
     # no exceptions met => failure
     return True, None
 
 
+def _partition(records, invalid_idx):
+    """
+    Partition records into a tuple of (valid, invalid) lists, by position, in a single pass.
+    """
+    valid, invalid = [], []
+
+    for idx, record in enumerate(records):
+        if idx in invalid_idx:
+            invalid.append(record)
+        else:
+            valid.append(record)
+
+    return valid, invalid
+
+
 def _validate_provider(provider, **kwargs):
     """
     Validate the feeds for a provider.
@@ -117,7 +256,8 @@ def _validate(**kwargs):
     version = kwargs["version"]
 
     for record_type in mds.SCHEMA_TYPES:
-        datasource = common.get_data(record_type, **kwargs)
+        with profiling.stage("fetch"):
+            datasource = common.get_data(record_type, **kwargs)
 
         if len(datasource) > 0:
             versions = set([d["version"] for d in datasource])
@@ -131,7 +271,15 @@ def _validate(**kwargs):
             version = mds.Version(version or versions.pop())
 
             try:
-                valid, errors, removed = validate(record_type, datasource, version)
+                with profiling.stage("validate"):
+                    valid, errors, removed = validate(
+                        record_type,
+                        datasource,
+                        version,
+                        workers=kwargs.get("validation_workers"),
+                        chunk_size=kwargs.get("validation_chunk_size"),
+                        prevalidate=kwargs.get("prevalidate")
+                    )
                 results.append((record_type, version, datasource, valid, errors, removed))
             except mds.versions.UnexpectedVersionError as unexpected_version:
                 results.append((record_type, version, datasource, [], [unexpected_version], []))
@@ -139,6 +287,213 @@ def _validate(**kwargs):
     return results
 
 
+class Sampler():
+    """
+    Choose a sample of the records in each page to validate, until a sampled record fails validation.
+
+    Errors that don't fail a record (e.g. an unexpected property, which is stripped) don't count as failures.
+    """
+
+    def __init__(self, rate, strata=None, seed=None):
+        """
+        Initialize a new `Sampler` instance.
+
+        Required positional arguments:
+
+        :rate: The portion of records in each page to validate, between 0 and 1.
+
+        Optional keyword arguments:
+
+        :strata: The name of a field (e.g. vehicle_type) to stratify the sample by;
+        each value of the field is sampled at rate, with at least one record.
+
+        :seed: Seed for the random number generator.
+        """
+        if not 0 < rate <= 1:
+            raise ValueError(f"Sample rate must be between 0 and 1, got {rate}.")
+
+        self.rate = rate
+        self.strata = strata
+        self.random = random.Random(seed)
+        self.escalated = False
+        self.records = 0
+        self.sampled = 0
+        self.lock = threading.Lock()
+
+    @property
+    def achieved_rate(self):
+        """
+        The portion of records seen that were sampled for validation.
+        """
+        return self.sampled / self.records if self.records > 0 else 0
+
+    def _choose(self, indices):
+        count = min(len(indices), max(1, math.ceil(self.rate * len(indices))))
+        return self.random.sample(indices, count)
+
+    def choose(self, records):
+        """
+        Choose a sample of records, returning the sorted positions of those chosen.
+        """
+        with self.lock:
+            if self.strata:
+                strata = {}
+                for idx, record in enumerate(records):
+                    strata.setdefault(str(record.get(self.strata)), []).append(idx)
+                chosen = [idx for indices in strata.values() for idx in self._choose(indices)]
+            else:
+                chosen = self._choose(list(range(len(records)))) if len(records) > 0 else []
+
+            self.records += len(records)
+            self.sampled += len(chosen)
+
+        return sorted(chosen)
+
+    def sample(self, source, data_key):
+        """
+        Get a copy of the source payload with a sample of its records.
+        """
+        records = source["data"][data_key]
+        return { **source, "data": { data_key: [records[idx] for idx in self.choose(records)] } }
+
+    def escalate(self):
+        """
+        Switch to full validation for the rest of the run.
+        """
+        with self.lock:
+            if not self.escalated:
+                print("Sampled records failed validation, switching to full validation")
+            self.escalated = True
+
+
+def _record_index(error):
+    """
+    The position in its path of the index of the record an error is within, or None for errors outside of the records.
+    """
+    for i, p in enumerate(error.path):
+        if isinstance(p, int):
+            return i
+    return None
+
+
+def _reindex(error, index):
+    """
+    Replace the record index i in an error's path with index(i), so it refers to the position within the whole source.
+    """
+    pos = _record_index(error)
+    for path in { id(p): p for p in [error.path, _original(error).path] }.values():
+        path[pos] = index(path[pos])
+
+
+def _validate_source(validator, source, page_check=None):
+    """
+    Validate a single source payload.
+
+    With a page_check, only the records failing its columnar checks go through full schema validation.
+
+    Returns a tuple (valid_records, invalid_records, errors, invalid_source).
+    """
+    records = list(source.get("data", {}).get(validator.data_key, []))
+
+    # the positions in source of the records validated, when only some of them are
+    flagged = None
+
+    if page_check is not None:
+        with _lock(page_check):
+            flagged = page_check.flagged(source)
+        if flagged is not None and len(flagged) == 0:
+            return records, [], [], False
+        if flagged is not None:
+            source = { **source, "data": { **source["data"], validator.data_key: [records[idx] for idx in flagged] } }
+
+    errors = []
+    invalid_source = False
+    invalid_idx = set()
+
+    # schema validation
+    with _lock(validator):
+        source_errors = list(validator.validate(source))
+
+    for error in source_errors:
+        if flagged is not None and _record_index(error) is not None:
+            _reindex(error, flagged.__getitem__)
+
+        errors.append(error)
+        failure, idx = _failure(error)
+        invalid_source = invalid_source or failure
+
+        # this was a problem with a single item, mark it for removal
+        if not failure and isinstance(idx, int):
+            invalid_idx.add(idx)
+
+    # filter invalid items if the overall payload was OK
+    if len(invalid_idx) > 0:
+        valid_records, invalid_records = _partition(records, invalid_idx)
+    else:
+        valid_records, invalid_records = records, []
+
+    return valid_records, invalid_records, errors, invalid_source
+
+
+def _validate_chunk(args):
+    """
+    Validate a single source payload in a worker process, using that process's cached validator.
+    """
+    record_type, version, source, prevalidate = args
+    version = mds.Version(version)
+    page_check = _page_check(record_type, version) if prevalidate else None
+    return _validate_source(_validator(record_type, version), source, page_check)
+
+
+def _pool(workers):
+    """
+    Get the process pool for validation with the given number of workers, creating it on first use.
+    """
+    with _VALIDATORS_LOCK:
+        if workers not in _POOLS:
+            _POOLS[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        return _POOLS[workers]
+
+
+def _validate_parallel(record_type, sources, version, data_key, workers, chunk_size=None, prevalidate=False):
+    """
+    Validate sources across a pool of worker processes.
+
+    With chunk_size, sources are split into chunks of (at most) chunk_size records, validated independently.
+    Error paths are offset to refer to positions within the source, and errors outside of the records
+    (repeated by every chunk of a source) are reported once.
+
+    Returns a list of (valid_records, invalid_records, errors, invalid_source), one per source, in order.
+    """
+    chunks, owners = [], []
+
+    for idx, source in enumerate(sources):
+        records = source.get("data", {}).get(data_key, [])
+        size = chunk_size or len(records) or 1
+        for start in range(0, max(len(records), 1), size):
+            chunk = { **source, "data": { data_key: records[start:start + size] } }
+            chunks.append((record_type, str(version), chunk, prevalidate))
+            owners.append((idx, start))
+
+    results = [([], [], [], [False]) for _ in sources]
+
+    for (idx, start), (valid_records, invalid_records, errors, invalid_source) in zip(owners, _pool(workers).map(_validate_chunk, chunks)):
+        _valid, _invalid, _errors, _invalid_source = results[idx]
+        _valid.extend(valid_records)
+        _invalid.extend(invalid_records)
+        _invalid_source[0] = _invalid_source[0] or invalid_source
+
+        for error in errors:
+            if _record_index(error) is not None:
+                if start > 0:
+                    _reindex(error, lambda i: i + start)
+                _errors.append(error)
+            elif start == 0:
+                _errors.append(error)
+
+    return [(v, i, e, invalid_source[0]) for v, i, e, invalid_source in results]
+
+
 def validate(record_type, sources, version, **kwargs):
     """
     Partition sources into a tuple of (valid, errors, failures)
@@ -146,6 +501,17 @@ def validate(record_type, sources, version, **kwargs):
         - valid: the sources with remaining valid data records
         - errors: a list of mds.schemas.DataValidationError
         - removed: the sources with invalid data records
+
+    With workers > 1, sources (or chunks of chunk_size records) are validated in parallel by a pool of processes,
+    each with its own validator; a validator can't be given.
+
+    With prevalidate, records passing cheap columnar checks of the schema's constraints skip full validation.
+    The results are the same either way.
+
+    With a sampler, only a sample of each source's records is validated, and the rest are assumed valid.
+    Once a sampled record (or a source) fails validation, the sampler escalates to full validation;
+    errors that are ignored, like unexpected properties, don't escalate. Unexpected properties are only stripped
+    from the sampled records, the rest are kept as they are.
     """
     if not all([isinstance(d, dict) and "data" in d for d in sources]):
         raise TypeError("Sources appears to be the wrong data type. Expected a list of payload dicts.")
@@ -158,33 +524,54 @@ def validate(record_type, sources, version, **kwargs):
     valid = []
     errors = []
     removed = []
-    validator = kwargs.get("validator", _validator(record_type, version))
-    data_key = validator.data_key
+    workers = kwargs.get("workers") or 1
+    if kwargs.get("validator") is not None and workers > 1:
+        raise ValueError("A validator can't be used with workers > 1, each worker process uses its own.")
 
-    for source in sources:
-        records = list(source.get("data", {}).get(data_key, []))
-        invalid_records = []
-        invalid_source = False
-        invalid_idx = set()
-
-        # schema validation
-        for error in validator.validate(source):
-            errors.append(error)
-            failure, idx = _failure(error)
-            invalid_source = invalid_source or failure
-
-            # this was a problem with a single item, mark it for removal
-            if not failure and isinstance(idx, int):
-                invalid_idx.add(idx)
+    validator = kwargs.get("validator") or _validator(record_type, version)
+    data_key = validator.data_key
+    prevalidate = kwargs.get("prevalidate", False)
+
+    sampler = kwargs.get("sampler")
+
+    def _results(payloads):
+        if workers > 1:
+            return _validate_parallel(
+                record_type, payloads, version, data_key, workers, kwargs.get("chunk_size"), prevalidate
+            )
+        else:
+            page_check = _page_check(record_type, version) if prevalidate else None
+            return [_validate_source(validator, payload, page_check) for payload in payloads]
+
+    results = None
+
+    if sampler is not None and not sampler.escalated:
+        chosen = [sampler.choose(source["data"][data_key]) for source in sources]
+        samples = [
+            { **source, "data": { data_key: [source["data"][data_key][idx] for idx in idxs] } }
+            for source, idxs in zip(sources, chosen)
+        ]
+        sample_results = _results(samples)
+
+        if any([len(i) > 0 or invalid for _, i, _, invalid in sample_results]):
+            sampler.escalate()
+        else:
+            results = []
+            for source, idxs, (sampled, _, sample_errors, _) in zip(sources, chosen, sample_results):
+                # take the validated copies of the sampled records, stripped of unexpected properties even by a worker process
+                records = list(source["data"][data_key])
+                for idx, record in zip(idxs, sampled):
+                    records[idx] = record
+                results.append((records, [], sample_errors, False))
+
+    if results is None:
+        results = _results(sources)
+
+    for source, (valid_records, invalid_records, source_errors, invalid_source) in zip(sources, results):
+        errors.extend(source_errors)
 
         # filter invalid items if the overall payload was OK
         if not invalid_source:
-            if len(invalid_idx) > 0:
-                valid_records = [r for r in records if records.index(r) not in invalid_idx]
-                invalid_records = [r for r in records if records.index(r) in invalid_idx]
-            else:
-                valid_records = records
-
             if len(valid_records) > 0:
                 # create a copy to preserve the original payload
                 payload = { **source, "data": { data_key: valid_records } }
@@ -241,6 +628,12 @@ if __name__ == "__main__":
 
     print(f"Starting validation run: {now.isoformat()}")
 
+    if args.profile:
+        profiling.configure(args.profile)
+
+    with profiling.stage("warm"):
+        warm_validators(args.version)
+
     for source in kwargs.pop("source"):
         print()
         print(f"Validating {source} @ {args.version}")
@@ -286,13 +679,15 @@ if __name__ == "__main__":
                 print()
                 print(f"Writing {record_type} to {args.output}")
 
-                f = mds.DataFile(record_type, args.output)
+                with profiling.stage("dump"):
+                    f = mds.DataFile(record_type, args.output)
 
-                f.dump_payloads(original, file_name=f"{source}_{record_type}_original.json")
-                f.dump_payloads(valid, file_name=f"{source}_{record_type}_valid.json")
+                    f.dump_payloads(original, file_name=f"{source}_{record_type}_original.json")
+                    f.dump_payloads(valid, file_name=f"{source}_{record_type}_valid.json")
 
-                if len(invalid) > 0:
-                    f.dump_payloads(invalid, file_name=f"{source}_{record_type}_invalid.json")
+                    if len(invalid) > 0:
+                        f.dump_payloads(invalid, file_name=f"{source}_{record_type}_invalid.json")
 
     print()
+    profiling.report()
     print(f"Finished validation ({common.count_seconds(now)}s)")
@@ -0,0 +1,81 @@
+"""
+Persistent per-provider, per-record type ingestion watermarks, for incremental polling.
+
+A watermark records the time up to which a provider's records were last successfully loaded,
+and the largest sequence_id of the provider's records loaded up to that point.
+"""
+
+import datetime
+
+import sqlalchemy
+
+import database
+
+
+_GET = """
+SELECT last_time, sequence_id, updated FROM ingest_watermarks WHERE provider = :provider AND record_type = :record_type
+"""
+
+_SEQUENCE = """
+SELECT max(sequence_id) FROM {table}
+WHERE provider_id = CAST(:provider_id AS uuid) AND {time_column} BETWEEN :start_time AND :end_time
+"""
+
+_ADVANCE = """
+INSERT INTO ingest_watermarks (provider, record_type, last_time, sequence_id, updated)
+VALUES (:provider, :record_type, :last_time, :sequence_id, now())
+ON CONFLICT (provider, record_type) DO UPDATE
+SET last_time = GREATEST(ingest_watermarks.last_time, EXCLUDED.last_time),
+    sequence_id = GREATEST(ingest_watermarks.sequence_id, EXCLUDED.sequence_id),
+    updated = now()
+"""
+
+
+def utc(ts):
+    """
+    Get ts as an aware UTC datetime, assuming naive datetimes are in UTC.
+    """
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.astimezone(datetime.timezone.utc)
+
+
+def get(provider, record_type, engine):
+    """
+    Get the watermark of a provider's record_type as a dict { last_time, sequence_id, updated }, or None.
+    """
+    with engine.connect() as connection:
+        row = connection.execute(sqlalchemy.text(_GET), provider=provider, record_type=record_type).fetchone()
+
+    if row is None:
+        return None
+
+    return dict(last_time=utc(row[0]), sequence_id=row[1], updated=row[2])
+
+
+def advance(provider, provider_id, record_type, start_time, end_time, engine):
+    """
+    Advance the watermark of a provider's record_type to end_time, once the range from start_time was loaded,
+    and its sequence_id to that of the provider's last record in the range.
+
+    Watermarks never move backwards.
+    """
+    table, time_column = record_type, database.TIME_COLUMNS[record_type]
+
+    with engine.begin() as connection:
+        sequence_id = connection.execute(
+            sqlalchemy.text(_SEQUENCE.format(table=table, time_column=time_column)),
+            provider_id=str(provider_id),
+            start_time=utc(start_time),
+            end_time=utc(end_time)
+        ).scalar()
+
+        connection.execute(
+            sqlalchemy.text(_ADVANCE),
+            provider=provider,
+            record_type=record_type,
+            last_time=utc(end_time),
+            sequence_id=sequence_id
+        )
+
+    print(f"Advanced the {provider} {record_type} watermark to {utc(end_time).isoformat()}")
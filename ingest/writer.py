@@ -0,0 +1,178 @@
+"""
+Load validated records into the database on a background thread, coalescing small batches into larger loads.
+"""
+
+import queue
+import threading
+import time
+
+import database
+import metrics
+import profiling
+
+
+# defaults for coalescing batches: load once this many records are waiting, or the oldest has waited this long
+WRITER_RECORDS = 50000
+WRITER_SECONDS = 5.0
+
+# default number of batches waiting to be coalesced before putting more blocks
+WRITER_QUEUE = 8
+
+_DONE = object()
+
+
+def load(payloads, record_type, provider, **kwargs):
+    """
+    Load payloads with `database.load()`, recording the load (and the steps of the copy load engine) in the metrics.
+
+    Returns the result of `database.load()`.
+    """
+    with profiling.stage("load"):
+        result = database.load(payloads, record_type, **kwargs)
+
+    if "stage_seconds" in result:
+        metrics.record("stage", provider, record_type, result["stage_seconds"], result["staged"])
+        metrics.record("merge", provider, record_type, result["merge_seconds"], result["merged"])
+    if result["skip_seconds"] > 0:
+        metrics.record("skip_existing", provider, record_type, result["skip_seconds"], result["skipped"])
+    metrics.record("load", provider, record_type, result["seconds"], result["records"])
+
+    return result
+
+
+class Writer():
+    """
+    Load batches of validated payloads on a background thread, so the flow doesn't wait on the database.
+
+    Batches are put on a bounded queue, and coalesced into one load once max_records records are waiting,
+    or max_seconds after the first of them arrived. When the queue is full, put() blocks until the writer catches up.
+
+    An error loading is raised by the next put(), or by close().
+    Each batch's done callback is called on the writer's thread once the load including it is committed.
+    """
+
+    def __init__(self, record_type, provider, max_records=WRITER_RECORDS, max_seconds=WRITER_SECONDS, queue_size=WRITER_QUEUE, **kwargs):
+        """
+        Initialize a new `Writer` instance, and start its thread.
+
+        Required positional arguments:
+
+        :record_type: The type of MDS records being loaded.
+
+        :provider: The name of the provider of the records, for the metrics.
+
+        Optional keyword arguments:
+
+        :max_records: Load once at least this many records are waiting.
+
+        :max_seconds: Load once the oldest waiting records have waited this long.
+
+        :queue_size: The maximum number of batches waiting to be coalesced.
+
+        All other keyword arguments are passed to `database.load()`.
+        """
+        self.record_type = record_type
+        self.provider = provider
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.kwargs = kwargs
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.error = None
+        self.loads = 0
+        self.records = 0
+        self.max_batch = 0
+        self.load_seconds = 0.0
+        self.max_load_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_depth = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, payloads, records, done=None):
+        """
+        Queue a batch of payloads holding records records to be loaded.
+
+        With done, a function called (without arguments) once the batch's load is committed.
+        """
+        if self.error is not None:
+            raise self.error
+
+        start = time.perf_counter()
+        self.queue.put((payloads, records, done))
+        self.wait_seconds += time.perf_counter() - start
+
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        metrics.METRICS.gauge("mds_ingest_writer_queue_depth", depth, provider=self.provider, record_type=self.record_type)
+
+    def _run(self):
+        buffer, records, callbacks, started = [], 0, [], None
+        done = False
+
+        while not done:
+            timeout = None if started is None else max(started + self.max_seconds - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _DONE:
+                done = True
+            elif item is not None and self.error is None:
+                payloads, count, callback = item
+                buffer.extend(payloads)
+                records += count
+                if callback is not None:
+                    callbacks.append(callback)
+                if started is None:
+                    started = time.monotonic()
+
+            if len(buffer) == 0:
+                continue
+
+            if done or records >= self.max_records or time.monotonic() - started >= self.max_seconds:
+                try:
+                    self._load(buffer, records)
+                    for callback in callbacks:
+                        callback()
+                except Exception as error:
+                    # keep draining the queue so put() never blocks, and raise in the flow
+                    self.error = error
+                buffer, records, callbacks, started = [], 0, [], None
+
+    def _load(self, payloads, records):
+        start = time.perf_counter()
+        load(payloads, self.record_type, self.provider, **self.kwargs)
+        seconds = time.perf_counter() - start
+
+        self.loads += 1
+        self.records += records
+        self.max_batch = max(self.max_batch, records)
+        self.load_seconds += seconds
+        self.max_load_seconds = max(self.max_load_seconds, seconds)
+
+    def close(self):
+        """
+        Load any waiting records and stop the thread, raising any error loading.
+        """
+        self.queue.put(_DONE)
+        self.thread.join()
+
+        labels = dict(provider=self.provider, record_type=self.record_type)
+        metrics.METRICS.gauge("mds_ingest_writer_queue_depth_max", self.max_depth, **labels)
+        metrics.METRICS.gauge("mds_ingest_writer_batch_records_max", self.max_batch, **labels)
+        metrics.METRICS.gauge("mds_ingest_writer_load_seconds_max", round(self.max_load_seconds, 3), **labels)
+        metrics.record("writer_wait", self.provider, self.record_type, self.wait_seconds)
+
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        """
+        Get a line summarizing the loads, batch sizes, commit latency and queue.
+        """
+        average = self.records / self.loads if self.loads > 0 else 0
+        latency = self.load_seconds / self.loads if self.loads > 0 else 0
+        return f"Writer: {self.loads} loads of {average:.0f} records on average ({self.max_batch} max)," \
+            f" {latency:.2f}s per load ({self.max_load_seconds:.2f}s max)," \
+            f" queue depth {self.max_depth} max, flow waited {self.wait_seconds:.2f}s"
@@ -0,0 +1,175 @@
+"""
+Opt-in profiling of the stages of a run, with cProfile and tracemalloc.
+
+Unless configure() is called, stage() and iterate() do no profiling work.
+"""
+
+import contextlib
+import cProfile
+import pathlib
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+class Profiler():
+    """
+    Profile named stages of a run, accumulating CPU profiles, wall time and peak memory per stage.
+    """
+
+    def __init__(self, directory, top=10):
+        """
+        Initialize a new `Profiler` instance, and start tracing memory allocations.
+
+        Required positional arguments:
+
+        :directory: Path to a directory to write a `<stage>.pstats` file per stage to.
+
+        Optional keyword arguments:
+
+        :top: The number of hotspots to report.
+        """
+        self.directory = pathlib.Path(directory)
+        self.top = top
+        self.profiles = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Profile the enclosed block as the named stage.
+
+        Only one stage per thread is CPU profiled at a time: nested stages, and stages on other threads
+        where the interpreter allows only one active profiler, are timed and memory traced only.
+        """
+        profile = None
+        if not getattr(self.local, "active", False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self.local.active = True
+            except ValueError:
+                profile = None
+
+        memory = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.local.active = False
+
+            elapsed = time.perf_counter() - start
+            # without reset_peak (Python < 3.9) this is the peak since tracing started
+            peak = max(tracemalloc.get_traced_memory()[1] - memory, 0)
+
+            with self.lock:
+                total = self.totals.setdefault(name, dict(calls=0, seconds=0.0, peak=0))
+                total["calls"] += 1
+                total["seconds"] += elapsed
+                total["peak"] = max(total["peak"], peak)
+                if profile is not None:
+                    self.profiles.setdefault(name, []).append(profile)
+
+    def _stats(self, name):
+        stats = None
+        for profile in self.profiles.get(name, []):
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # nothing was collected by this profile
+                continue
+        return stats
+
+    def report(self):
+        """
+        Write the per-stage .pstats files, and print a summary of the stages and the top hotspots.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        print("Profile:")
+
+        hotspots = []
+
+        with self.lock:
+            for name, total in self.totals.items():
+                print(f"  {name}: {total['calls']}x, {total['seconds']:.2f}s, peak memory {total['peak'] / 2**20:.1f} MiB")
+
+                stats = self._stats(name)
+                if stats is None:
+                    continue
+
+                path = pathlib.Path(self.directory, f"{name}.pstats")
+                stats.dump_stats(str(path))
+
+                for func, (_, calls, tottime, cumtime, _) in stats.stats.items():
+                    hotspots.append((tottime, cumtime, calls, name, func))
+
+        print(f"Top {self.top} hotspots by own time (stage, calls, own s, cumulative s, function):")
+        for tottime, cumtime, calls, name, func in sorted(hotspots, key=lambda h: h[0], reverse=True)[:self.top]:
+            print(f"  {name:<10} {calls:>9} {tottime:>8.3f} {cumtime:>8.3f}  {pstats.func_std_string(func)}")
+
+        print(f"Wrote per-stage profiles to {self.directory}")
+
+
+# the profiler for this process, see configure()
+PROFILER = None
+
+
+def configure(directory, top=10):
+    """
+    Turn on profiling for this process, writing per-stage profiles to directory.
+    """
+    global PROFILER
+    PROFILER = Profiler(directory, top=top)
+    return PROFILER
+
+
+def stage(name):
+    """
+    Profile a block as the named stage, if profiling is on.
+    """
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.stage(name)
+
+
+def iterate(name, iterable):
+    """
+    Profile getting each item of iterable as the named stage, if profiling is on.
+    """
+    if PROFILER is None:
+        return iterable
+    return _iterate(name, iterable)
+
+
+def _iterate(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with PROFILER.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def report():
+    """
+    Report on the stages profiled, if profiling is on.
+    """
+    if PROFILER is not None:
+        PROFILER.report()
@@ -0,0 +1,14 @@
+"""
+Modules shared by the services, installed into the base image.
+"""
+
+from setuptools import setup
+
+
+setup(
+    name="mds-provider-services-shared",
+    version="0.1.0",
+    description="Modules shared by the mds-provider-services services.",
+    py_modules=["profiling"],
+    python_requires=">=3.7"
+)